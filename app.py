@@ -8,18 +8,37 @@ import re
 import io
 import json
 import sys
+import time
+import math
+import click
 import requests
-import google.generativeai as genai
-from PIL import Image
+from google.ai import generativelanguage as glm
+from google.api_core import exceptions as google_exceptions
+from PIL import Image, ImageChops, ImageOps
+import numpy as np
 import base64
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+import unicodedata
+import hashlib
+import hmac
+import tempfile
+import shutil
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, abort, send_from_directory, after_this_request, has_request_context, send_file
+from markupsafe import Markup, escape
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func, case, or_, text
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import func, case, or_, and_, text, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from functools import wraps
-from collections import defaultdict, deque
+from urllib.parse import urljoin
+from collections import Counter, defaultdict, deque, namedtuple
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 from datetime import datetime, timedelta
 from itertools import product, combinations
 from datetime import date
@@ -80,7 +99,7 @@ class Team(db.Model):
 class Player(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    team_id = db.Column(db.Integer, db.ForeignKey('team.id'), nullable=False)
+    team_id = db.Column(db.Integer, db.ForeignKey('team.id', ondelete='CASCADE'), nullable=False)
     is_active = db.Column(db.Boolean, default=True)
     image_url = db.Column(db.String(255), nullable=True)
 
@@ -89,9 +108,11 @@ class Game(db.Model):
     season_id = db.Column(db.Integer, db.ForeignKey('season.id'), nullable=True)
     game_date = db.Column(db.String(50))
     start_time = db.Column(db.String(20), nullable=True)
+    # game_date + start_time を日時型にしたもの (範囲検索・並び替え用。set_schedule で同時に更新する)
+    game_datetime = db.Column(db.DateTime, nullable=True)
     game_password = db.Column(db.String(50), nullable=True)
-    home_team_id = db.Column(db.Integer, db.ForeignKey('team.id'), nullable=False)
-    away_team_id = db.Column(db.Integer, db.ForeignKey('team.id'), nullable=False)
+    home_team_id = db.Column(db.Integer, db.ForeignKey('team.id', ondelete='CASCADE'), nullable=False)
+    away_team_id = db.Column(db.Integer, db.ForeignKey('team.id', ondelete='CASCADE'), nullable=False)
     home_score = db.Column(db.Integer, default=0)
     away_score = db.Column(db.Integer, default=0)
     is_finished = db.Column(db.Boolean, default=False)
@@ -105,11 +126,23 @@ class Game(db.Model):
     home_team = db.relationship('Team', foreign_keys=[home_team_id])
     away_team = db.relationship('Team', foreign_keys=[away_team_id])
     season = db.relationship('Season')
+    # 日程表・チーム成績・次の試合・期間集計の検索用 (既存DBには migrate-db で作成)
+    __table_args__ = (
+        db.Index('ix_game_season_datetime', 'season_id', 'game_datetime'),
+        db.Index('ix_game_season_finished_datetime', 'season_id', 'is_finished', 'game_datetime'),
+        db.Index('ix_game_datetime', 'game_datetime'),
+        db.Index('ix_game_home_team', 'home_team_id', 'season_id'),
+        db.Index('ix_game_away_team', 'away_team_id', 'season_id'),
+    )
+
+    def set_schedule(self, game_date, start_time):
+        self.game_date = game_date; self.start_time = start_time
+        self.game_datetime = parse_game_datetime(game_date, start_time)
 
 class PlayerStat(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    game_id = db.Column(db.Integer, db.ForeignKey('game.id'), nullable=False)
-    player_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=False)
+    game_id = db.Column(db.Integer, db.ForeignKey('game.id', ondelete='CASCADE'), nullable=False)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='CASCADE'), nullable=False)
     pts=db.Column(db.Integer, default=0); ast=db.Column(db.Integer, default=0)
     reb=db.Column(db.Integer, default=0); stl=db.Column(db.Integer, default=0)
     blk=db.Column(db.Integer, default=0); foul=db.Column(db.Integer, default=0)
@@ -122,6 +155,10 @@ class PlayerStat(db.Model):
     
     player = db.relationship('Player')
     game = db.relationship('Game')
+    __table_args__ = (
+        db.Index('ix_player_stat_game_player', 'game_id', 'player_id'),
+        db.Index('ix_player_stat_player_game', 'player_id', 'game_id'),
+    )
 
 class News(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -136,8 +173,8 @@ class PlayoffMatch(db.Model):
     league = db.Column(db.String(20))
     round_name = db.Column(db.String(20))
     match_index = db.Column(db.Integer)
-    team1_id = db.Column(db.Integer, db.ForeignKey('team.id'), nullable=True)
-    team2_id = db.Column(db.Integer, db.ForeignKey('team.id'), nullable=True)
+    team1_id = db.Column(db.Integer, db.ForeignKey('team.id', ondelete='SET NULL'), nullable=True)
+    team2_id = db.Column(db.Integer, db.ForeignKey('team.id', ondelete='SET NULL'), nullable=True)
     team1_wins = db.Column(db.Integer, default=0)
     team2_wins = db.Column(db.Integer, default=0)
     schedule_note = db.Column(db.String(50), nullable=True)
@@ -162,26 +199,30 @@ class VoteConfig(db.Model):
 
 class Vote(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    vote_config_id = db.Column(db.Integer, db.ForeignKey('vote_config.id'), nullable=False)
+    vote_config_id = db.Column(db.Integer, db.ForeignKey('vote_config.id', ondelete='CASCADE'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    player_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=False)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='CASCADE'), nullable=False)
     category = db.Column(db.String(50))
     rank_value = db.Column(db.Integer, default=1)
     user = db.relationship('User')
     player = db.relationship('Player')
+    __table_args__ = (db.Index('ix_vote_config_user', 'vote_config_id', 'user_id'),
+                      # 1人1票の枠 (awards は同じカテゴリに 1st / 2nd / 3rd があるので点数まで含める)
+                      db.Index('uq_vote_ballot', 'vote_config_id', 'user_id', 'category', 'rank_value', unique=True))
 
 class VoteResult(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    vote_config_id = db.Column(db.Integer, db.ForeignKey('vote_config.id'), nullable=False)
+    vote_config_id = db.Column(db.Integer, db.ForeignKey('vote_config.id', ondelete='CASCADE'), nullable=False)
     category = db.Column(db.String(50))
-    player_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=False)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='CASCADE'), nullable=False)
     score = db.Column(db.Integer)
     rank = db.Column(db.Integer)
     player = db.relationship('Player')
+    __table_args__ = (db.Index('ix_vote_result_config', 'vote_config_id', 'category', 'rank'),)
 
 class MVPCandidate(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    player_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=False)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='CASCADE'), nullable=False)
     score = db.Column(db.Float, default=0.0)
     avg_pts = db.Column(db.Float, default=0.0); avg_reb = db.Column(db.Float, default=0.0)
     avg_ast = db.Column(db.Float, default=0.0); avg_stl = db.Column(db.Float, default=0.0)
@@ -202,6 +243,66 @@ class DailyAccess(db.Model):
     date = db.Column(db.Date, unique=True, nullable=False)
     count = db.Column(db.Integer, default=0)
 
+class TeamSeasonStanding(db.Model):
+    """ シーズン×チームの順位表集計 (試合結果の更新時に再計算して保存する) """
+    id = db.Column(db.Integer, primary_key=True)
+    season_id = db.Column(db.Integer, db.ForeignKey('season.id', ondelete='CASCADE'), nullable=False)
+    team_id = db.Column(db.Integer, db.ForeignKey('team.id', ondelete='CASCADE'), nullable=False)
+    wins = db.Column(db.Integer, default=0); losses = db.Column(db.Integer, default=0)
+    points = db.Column(db.Integer, default=0); valid_games = db.Column(db.Integer, default=0)
+    pf = db.Column(db.Integer, default=0); pa = db.Column(db.Integer, default=0)
+    ast=db.Column(db.Integer, default=0); reb=db.Column(db.Integer, default=0)
+    stl=db.Column(db.Integer, default=0); blk=db.Column(db.Integer, default=0)
+    turnover=db.Column(db.Integer, default=0); foul=db.Column(db.Integer, default=0)
+    fgm=db.Column(db.Integer, default=0); fga=db.Column(db.Integer, default=0)
+    three_pm=db.Column(db.Integer, default=0); three_pa=db.Column(db.Integer, default=0)
+    ftm=db.Column(db.Integer, default=0); fta=db.Column(db.Integer, default=0)
+    # 連勝/連敗の状態と直近5試合 (古い順に 'W'/'L' を連結)
+    streak_type = db.Column(db.String(1), default='')
+    streak_count = db.Column(db.Integer, default=0)
+    form = db.Column(db.String(5), default='')
+    __table_args__ = (db.UniqueConstraint('season_id', 'team_id', name='uq_team_season_standing'),)
+
+class PlayerSeasonTotals(db.Model):
+    """ シーズン×選手のスタッツ合計 (出場試合数と各項目の素の合計。平均・成功率は読み出し時に計算) """
+    id = db.Column(db.Integer, primary_key=True)
+    season_id = db.Column(db.Integer, db.ForeignKey('season.id', ondelete='CASCADE'), nullable=False)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='CASCADE'), nullable=False)
+    games_played = db.Column(db.Integer, default=0)
+    pts=db.Column(db.Integer, default=0); ast=db.Column(db.Integer, default=0)
+    reb=db.Column(db.Integer, default=0); stl=db.Column(db.Integer, default=0)
+    blk=db.Column(db.Integer, default=0); foul=db.Column(db.Integer, default=0)
+    turnover=db.Column(db.Integer, default=0); fgm=db.Column(db.Integer, default=0)
+    fga=db.Column(db.Integer, default=0); three_pm=db.Column(db.Integer, default=0)
+    three_pa=db.Column(db.Integer, default=0); ftm=db.Column(db.Integer, default=0)
+    fta=db.Column(db.Integer, default=0)
+    __table_args__ = (db.UniqueConstraint('season_id', 'player_id', name='uq_player_season_totals'),)
+
+class AnalysisJob(db.Model):
+    """ スタッツ画像解析のジョブ (受付時に作成し、ワーカースレッドが進捗と結果を書き込む) """
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'))
+    game_id = db.Column(db.Integer, db.ForeignKey('game.id', ondelete='SET NULL'))
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued / running / done / error
+    stage = db.Column(db.String(100), default='')
+    image_count = db.Column(db.Integer, default=0)
+    image_urls = db.Column(db.Text, default='')  # アップロード済みの画像URL (カンマ区切り。途中経過として返す)
+    result = db.Column(db.Text)  # 解析結果のJSON
+    error = db.Column(db.Text)
+    timings = db.Column(db.Text)  # 工程ごとの所要秒数のJSON (preprocess / inference / upload / total)
+    batch_id = db.Column(db.String(32), index=True)  # 試合日の一括取り込みでまとめて登録したジョブ
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class AnalysisCache(db.Model):
+    """ 画像解析結果のキャッシュ (キーは画像の内容ハッシュ + プロンプトの版 + モデル名) """
+    key = db.Column(db.String(64), primary_key=True)
+    result = db.Column(db.Text, nullable=False)  # players / debug_raw_text のJSON
+    image_url = db.Column(db.Text, default='')
+    hits = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
 # --- 4. 権限管理とヘルパー関数 ---
 Team_Home = db.aliased(Team, name='team_home') 
 Team_Away = db.aliased(Team, name='team_away')
@@ -217,6 +318,24 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def parse_game_datetime(game_date, start_time=None):
+    """ 'YYYY-MM-DD' と 'HH:MM' から日時を作る。日付が読めなければ None、時刻が読めなければ 0:00 """
+    try: day = datetime.strptime((game_date or '').strip(), '%Y-%m-%d')
+    except ValueError: return None
+    for fmt in ('%H:%M', '%H:%M:%S'):
+        try:
+            t = datetime.strptime((start_time or '').strip(), fmt)
+            return day.replace(hour=t.hour, minute=t.minute, second=t.second)
+        except ValueError: continue
+    return day
+
+def game_period_clause(start_date, end_date):
+    """ start_date〜end_date (両端の日を含む) の試合の条件。日付が読めない場合は従来の文字列比較 """
+    start = parse_game_datetime(start_date); end = parse_game_datetime(end_date)
+    if start is None or end is None:
+        return and_(Game.game_date >= start_date, Game.game_date <= end_date)
+    return and_(Game.game_datetime >= start, Game.game_datetime < end + timedelta(days=1))
+
 def allowed_file(filename): return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'png', 'jpg', 'jpeg', 'gif'}
 def generate_password(length=4): return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
 
@@ -234,6 +353,32 @@ def get_view_season_id():
     if sid: return sid
     return get_current_season().id
 
+# --- シーズン集計のキャッシュ ---
+# 試合結果が変わるたびにシーズンごとの「集計バージョン」をDBで更新し、
+# キャッシュはバージョンをキーに含めることで複数ワーカー間でも古い結果を返さないようにする
+_season_cache = {}
+SEASON_CACHE_MAX_ENTRIES = 256
+
+def get_stats_version(season_id):
+    setting = SystemSetting.query.get(f'stats_version_{season_id}')
+    return setting.value if setting else '0'
+
+def bump_stats_version(season_id):
+    """ シーズンの集計バージョンを更新する (コミットは呼び出し側で行う) """
+    if season_id is None: return
+    key = f'stats_version_{season_id}'; token = os.urandom(8).hex()
+    setting = SystemSetting.query.get(key)
+    if not setting: db.session.add(SystemSetting(key=key, value=token))
+    else: setting.value = token
+
+def season_cached(name, season_id, args, builder):
+    """ builder() の結果を (name, season_id, 集計バージョン, args) ごとにキャッシュする """
+    cache_key = (name, season_id, get_stats_version(season_id), args)
+    if cache_key not in _season_cache:
+        if len(_season_cache) >= SEASON_CACHE_MAX_ENTRIES: _season_cache.clear()
+        _season_cache[cache_key] = builder()
+    return _season_cache[cache_key]
+
 @app.context_processor
 def inject_seasons():
     return dict(
@@ -242,149 +387,361 @@ def inject_seasons():
         view_season_id=get_view_season_id()
     )
 
-def calculate_standings(season_id, league_filter=None):
-    # 1. チーム一覧取得
-    query = Team.query
-    if league_filter:
-        query = query.filter(Team.league == league_filter)
-    teams = query.all()
+# 順位表で合計するスタッツ列
+STANDINGS_STAT_COLUMNS = ('ast', 'reb', 'stl', 'blk', 'turnover', 'foul', 'fgm', 'fga', 'three_pm', 'three_pa', 'ftm', 'fta')
 
-    standings = []
+def _new_team_record():
+    return {'wins': 0, 'losses': 0, 'points': 0, 'pf': 0, 'pa': 0, 'valid_games': 0,
+            'form_history': [], 'streak_type': '', 'streak_count': 0}
 
-    for team in teams:
-        # 2. このチームの終了済み全試合を取得
-        team_games = Game.query.filter(
-            Game.season_id == season_id,
-            Game.is_finished == True,
-            or_(Game.home_team_id == team.id, Game.away_team_id == team.id)
-        ).order_by(Game.game_date.asc()).all()
-        
-        # --- 集計用変数の初期化 ---
-        wins = 0; losses = 0
-        points = 0  # 勝ち点
-        valid_game_ids = []
-        form_history = []
-        streak_type = ""; streak_count = 0
-        pf = 0; pa = 0 # 総得点、総失点
-
-        # --- A. 試合ごとの勝敗・勝ち点計算 ---
-        for g in team_games:
-            is_home = (g.home_team_id == team.id)
-            
-            # 勝敗判定
-            if g.winner_id is not None:
-                is_win = (g.winner_id == team.id)
-            else:
-                my_score = g.home_score if is_home else g.away_score
-                opp_score = g.away_score if is_home else g.home_score
-                is_win = (my_score > opp_score)
+def _tally_team_games(season_id, team_ids=None):
+    """ シーズンの終了済み試合を1回のクエリで読み込み、チームごとの勝敗・勝ち点・連勝/敗・得失点を集計する """
+    query = Game.query.filter(Game.season_id == season_id, Game.is_finished == True)
+    if team_ids is not None:
+        query = query.filter(or_(Game.home_team_id.in_(team_ids), Game.away_team_id.in_(team_ids)))
+    games = query.order_by(Game.game_datetime.asc(), Game.id.asc()).all()
 
-            flag_forfeit = getattr(g, 'is_forfeit', False)
-            score_zero_forfeit = (g.home_score == 0 and g.away_score == 0)
-            is_treat_as_forfeit = (flag_forfeit or score_zero_forfeit)
+    records = defaultdict(_new_team_record)
+    for g in games:
+        # 不戦試合 (フラグ or 0-0) は勝ち点1を与えず、得失点・スタッツにも含めない
+        is_treat_as_forfeit = (getattr(g, 'is_forfeit', False) or (g.home_score == 0 and g.away_score == 0))
+        for team_id, is_home in ((g.home_team_id, True), (g.away_team_id, False)):
+            if team_ids is not None and team_id not in team_ids: continue
+            rec = records[team_id]
+            my_score = g.home_score if is_home else g.away_score
+            opp_score = g.away_score if is_home else g.home_score
+
+            # 勝敗判定 (winner_idがあれば優先、なければスコア)
+            if g.winner_id is not None: is_win = (g.winner_id == team_id)
+            else: is_win = (my_score > opp_score)
 
-            # 勝ち点計算
             if is_win:
-                wins += 1
-                points += 3
-                form_history.append('W')
-                current_result = "W"
+                rec['wins'] += 1; rec['points'] += 3; current_result = 'W'
             else:
-                losses += 1
-                form_history.append('L')
-                current_result = "L"
-                if is_treat_as_forfeit: points += 0
-                else: points += 1
+                rec['losses'] += 1; current_result = 'L'
+                if not is_treat_as_forfeit: rec['points'] += 1
+            rec['form_history'].append(current_result)
 
-            if streak_type == current_result: streak_count += 1
-            else: streak_type = current_result; streak_count = 1
+            if rec['streak_type'] == current_result: rec['streak_count'] += 1
+            else: rec['streak_type'] = current_result; rec['streak_count'] = 1
 
             if not is_treat_as_forfeit:
-                valid_game_ids.append(g.id)
-                if is_home: pf += g.home_score; pa += g.away_score
-                else: pf += g.away_score; pa += g.home_score
-
-        # --- B. 詳細スタッツの一括集計 ---
-        t_ast = 0; t_reb = 0; t_stl = 0; t_blk = 0; t_to = 0; t_foul = 0
-        t_fgm = 0; t_fga = 0; t_3pm = 0; t_3pa = 0; t_ftm = 0; t_fta = 0
-
-        if valid_game_ids:
-            stats_data = db.session.query(
-                func.sum(PlayerStat.ast).label('ast'), func.sum(PlayerStat.reb).label('reb'),
-                func.sum(PlayerStat.stl).label('stl'), func.sum(PlayerStat.blk).label('blk'),
-                func.sum(PlayerStat.turnover).label('to'), func.sum(PlayerStat.foul).label('foul'),
-                func.sum(PlayerStat.fgm).label('fgm'), func.sum(PlayerStat.fga).label('fga'),
-                func.sum(PlayerStat.three_pm).label('3pm'), func.sum(PlayerStat.three_pa).label('3pa'),
-                func.sum(PlayerStat.ftm).label('ftm'), func.sum(PlayerStat.fta).label('fta')
-            ).join(Player, PlayerStat.player_id == Player.id)\
-             .filter(PlayerStat.game_id.in_(valid_game_ids), Player.team_id == team.id).first()
-
-            if stats_data:
-                t_ast = stats_data.ast or 0; t_reb = stats_data.reb or 0
-                t_stl = stats_data.stl or 0; t_blk = stats_data.blk or 0
-                t_to  = stats_data.to  or 0; t_foul= stats_data.foul or 0
-                t_fgm = stats_data.fgm or 0; t_fga = stats_data.fga or 0
-                t_3pm = stats_data[8] or 0;  t_3pa = stats_data[9] or 0
-                t_ftm = stats_data.ftm or 0; t_fta = stats_data.fta or 0
-
-        # --- C. 最終計算 ---
-        total_games_played = wins + losses
-        valid_games_count = len(valid_game_ids)
-        
-        if not team.is_active and total_games_played == 0: continue
-
-        # ★★★ 修正点：ここを得失点差「合計」に戻します ★★★
-        diff = pf - pa
-
-        # その他の項目は「平均」のままでOK
-        if valid_games_count > 0:
-            avg_pf = round(pf / valid_games_count, 1)
-            avg_pa = round(pa / valid_games_count, 1)
-            avg_ast = round(t_ast / valid_games_count, 1)
-            avg_reb = round(t_reb / valid_games_count, 1)
-            avg_stl = round(t_stl / valid_games_count, 1)
-            avg_blk = round(t_blk / valid_games_count, 1)
-            avg_to  = round(t_to  / valid_games_count, 1)
-            avg_foul= round(t_foul/ valid_games_count, 1)
-        else:
-            avg_pf = 0; avg_pa = 0; avg_ast = 0; avg_reb = 0; avg_stl = 0; avg_blk = 0; avg_to = 0; avg_foul = 0
-
-        fg_pct = (t_fgm / t_fga * 100) if t_fga > 0 else 0
-        three_p_pct = (t_3pm / t_3pa * 100) if t_3pa > 0 else 0
-        ft_pct = (t_ftm / t_fta * 100) if t_fta > 0 else 0
-
-        form_str = "-".join(reversed(form_history[-5:]))
-        streak_str = f"{streak_type}{streak_count}" if total_games_played > 0 else "-"
-
-        standings.append({
-            'team': team, 'team_name': team.name, 'league': team.league,
-            'wins': wins, 'losses': losses, 'points': points,
-            'avg_pf': avg_pf, 'avg_pa': avg_pa,
-            'diff': diff,  # ★ここが合計値になります
-            'form': form_str, 'streak': streak_str,
-            'avg_ast': avg_ast, 'avg_reb': avg_reb, 'avg_stl': avg_stl,
-            'avg_blk': avg_blk, 'avg_turnover': avg_to, 'avg_foul': avg_foul,
-            'fg_pct': fg_pct, 'three_p_pct': three_p_pct, 'ft_pct': ft_pct
-        })
+                rec['valid_games'] += 1
+                rec['pf'] += my_score; rec['pa'] += opp_score
+    return records
+
+def _valid_game_clause():
+    """ スタッツ集計の対象となる試合 (不戦試合・0-0 を除く) のSQL条件 """
+    return and_(
+        or_(Game.is_forfeit == False, Game.is_forfeit.is_(None)),
+        or_(Game.home_score != 0, Game.away_score != 0)
+    )
+
+def _sum_team_stats(season_id, team_ids=None):
+    """ 各チームの有効試合における所属選手スタッツ合計を、GROUP BY 1回で取得する """
+    query = db.session.query(
+        Player.team_id, *[func.sum(getattr(PlayerStat, col)) for col in STANDINGS_STAT_COLUMNS]
+    ).join(Player, PlayerStat.player_id == Player.id)\
+     .join(Game, PlayerStat.game_id == Game.id)\
+     .filter(
+         Game.season_id == season_id, Game.is_finished == True, _valid_game_clause(),
+         or_(Game.home_team_id == Player.team_id, Game.away_team_id == Player.team_id)
+     )
+    if team_ids is not None:
+        query = query.filter(Player.team_id.in_(team_ids))
+    totals = {}
+    for row in query.group_by(Player.team_id).all():
+        totals[row[0]] = {col: (row[i + 1] or 0) for i, col in enumerate(STANDINGS_STAT_COLUMNS)}
+    return totals
+
+def _build_standing_row(team, rec, totals):
+    """ 集計値から順位表1行分の辞書を組み立てる (チームが対象外なら None) """
+    wins = rec['wins']; losses = rec['losses']; pf = rec['pf']; pa = rec['pa']
+    total_games_played = wins + losses
+    valid_games_count = rec['valid_games']
+
+    if not team.is_active and total_games_played == 0: return None
+
+    t = totals or {}
+    t_ast = t.get('ast', 0); t_reb = t.get('reb', 0); t_stl = t.get('stl', 0); t_blk = t.get('blk', 0)
+    t_to = t.get('turnover', 0); t_foul = t.get('foul', 0)
+    t_fgm = t.get('fgm', 0); t_fga = t.get('fga', 0); t_3pm = t.get('three_pm', 0); t_3pa = t.get('three_pa', 0)
+    t_ftm = t.get('ftm', 0); t_fta = t.get('fta', 0)
+
+    # 得失点差は「合計」、その他の項目は「平均」
+    diff = pf - pa
+    if valid_games_count > 0:
+        avg_pf = round(pf / valid_games_count, 1)
+        avg_pa = round(pa / valid_games_count, 1)
+        avg_ast = round(t_ast / valid_games_count, 1)
+        avg_reb = round(t_reb / valid_games_count, 1)
+        avg_stl = round(t_stl / valid_games_count, 1)
+        avg_blk = round(t_blk / valid_games_count, 1)
+        avg_to  = round(t_to  / valid_games_count, 1)
+        avg_foul= round(t_foul/ valid_games_count, 1)
+    else:
+        avg_pf = 0; avg_pa = 0; avg_ast = 0; avg_reb = 0; avg_stl = 0; avg_blk = 0; avg_to = 0; avg_foul = 0
 
+    fg_pct = (t_fgm / t_fga * 100) if t_fga > 0 else 0
+    three_p_pct = (t_3pm / t_3pa * 100) if t_3pa > 0 else 0
+    ft_pct = (t_ftm / t_fta * 100) if t_fta > 0 else 0
+
+    form_str = "-".join(reversed(rec['form_history'][-5:]))
+    streak_str = f"{rec['streak_type']}{rec['streak_count']}" if total_games_played > 0 else "-"
+
+    return {
+        'team': team, 'team_name': team.name, 'league': team.league,
+        'wins': wins, 'losses': losses, 'points': rec['points'],
+        'avg_pf': avg_pf, 'avg_pa': avg_pa,
+        'diff': diff,
+        'form': form_str, 'streak': streak_str,
+        'avg_ast': avg_ast, 'avg_reb': avg_reb, 'avg_stl': avg_stl,
+        'avg_blk': avg_blk, 'avg_turnover': avg_to, 'avg_foul': avg_foul,
+        'fg_pct': fg_pct, 'three_p_pct': three_p_pct, 'ft_pct': ft_pct
+    }
+
+def sort_standings(standings):
     # 並び替え: 勝ち点 > 得失点差(合計) > 平均得点
     standings.sort(key=lambda x: (x['points'], x['diff'], x['avg_pf']), reverse=True)
     return standings
 
+def compute_standings(season_id, league_filter=None):
+    """
+    試合結果の生データからシーズン順位表を計算する (検証・再構築用の低速パス)。
+    チーム数に関係なく「チーム一覧・試合一覧・スタッツ集計」の3クエリで全チーム分を求める。
+    """
+    query = Team.query
+    if league_filter:
+        query = query.filter(Team.league == league_filter)
+    teams = query.all()
+
+    team_ids = [t.id for t in teams] if league_filter else None
+    records = _tally_team_games(season_id, team_ids)
+    totals = _sum_team_stats(season_id, team_ids)
+
+    standings = []
+    for team in teams:
+        row = _build_standing_row(team, records.get(team.id, _new_team_record()), totals.get(team.id))
+        if row is not None: standings.append(row)
+    return sort_standings(standings)
+
+def refresh_team_standings(season_id, team_ids=None):
+    """
+    指定チーム (省略時は全チーム) の TeamSeasonStanding を生データから再計算して書き込む。
+    試合結果を変更したルートから呼び、同じトランザクションでコミットする。
+    """
+    if season_id is None: return
+    bump_stats_version(season_id)
+    if team_ids is None: team_ids = [t.id for t in Team.query.all()]
+    team_ids = sorted({tid for tid in team_ids if tid is not None})
+    if not team_ids: return
+
+    records = _tally_team_games(season_id, team_ids)
+    totals = _sum_team_stats(season_id, team_ids)
+    existing = {r.team_id: r for r in TeamSeasonStanding.query.filter(
+        TeamSeasonStanding.season_id == season_id, TeamSeasonStanding.team_id.in_(team_ids)).all()}
+
+    for tid in team_ids:
+        rec = records.get(tid, _new_team_record()); t = totals.get(tid, {})
+        row = existing.get(tid)
+        if row is None:
+            row = TeamSeasonStanding(season_id=season_id, team_id=tid)
+            db.session.add(row)
+        row.wins = rec['wins']; row.losses = rec['losses']; row.points = rec['points']
+        row.valid_games = rec['valid_games']; row.pf = rec['pf']; row.pa = rec['pa']
+        for col in STANDINGS_STAT_COLUMNS: setattr(row, col, t.get(col, 0))
+        row.streak_type = rec['streak_type']; row.streak_count = rec['streak_count']
+        row.form = ''.join(rec['form_history'][-5:])
+
+def refresh_all_standings():
+    """ 全シーズンの TeamSeasonStanding を作り直す (チーム削除などシーズンをまたぐ変更用) """
+    for (sid,) in db.session.query(Season.id).all():
+        refresh_team_standings(sid)
+
+def _standing_record(row):
+    """ TeamSeasonStanding の行を _build_standing_row が受け取る集計形式に戻す """
+    rec = {'wins': row.wins, 'losses': row.losses, 'points': row.points, 'pf': row.pf, 'pa': row.pa,
+           'valid_games': row.valid_games, 'form_history': list(row.form or ''),
+           'streak_type': row.streak_type or '', 'streak_count': row.streak_count}
+    return rec, {col: getattr(row, col) for col in STANDINGS_STAT_COLUMNS}
+
+def calculate_standings(season_id, league_filter=None):
+    """
+    シーズン順位表を返す。保存済みの TeamSeasonStanding を1クエリで読むだけ (GET では書き込まない)。
+    集計の無い既存シーズンは起動時の build_missing_season_aggregates で作成する。存在しないシーズンは空。
+    """
+    if season_id is not None and db.session.get(Season, season_id) is None: return []
+    query = db.session.query(Team, TeamSeasonStanding).outerjoin(
+        TeamSeasonStanding,
+        and_(TeamSeasonStanding.team_id == Team.id, TeamSeasonStanding.season_id == season_id)
+    )
+    if league_filter:
+        query = query.filter(Team.league == league_filter)
+    rows = query.all()
+
+    standings = []
+    for team, st in rows:
+        if st is None: rec, totals = _new_team_record(), None
+        else: rec, totals = _standing_record(st)
+        row = _build_standing_row(team, rec, totals)
+        if row is not None: standings.append(row)
+    return sort_standings(standings)
+
+def partition_standings(standings):
+    """ 総合順位表をリーグごとに分割する (並び順は総合順位のまま、各行は総合と同じ辞書を共有する) """
+    by_league = {}
+    for row in standings:
+        if row['league']: by_league.setdefault(row['league'], []).append(row)
+    return dict(sorted(by_league.items()))
+
+def calculate_league_standings(season_id):
+    """ 総合順位表と全リーグ分の順位表を1回の集計で返す: (overall, {リーグ名: [行, ...]}) """
+    overall = calculate_standings(season_id)
+    return overall, partition_standings(overall)
+
 def calculate_team_stats(season_id): return calculate_standings(season_id)
 
+# PlayerSeasonTotals に保存するスタッツ列
+PLAYER_STAT_COLUMNS = ('pts', 'ast', 'reb', 'stl', 'blk', 'foul', 'turnover', 'fgm', 'fga', 'three_pm', 'three_pa', 'ftm', 'fta')
+
+def refresh_player_totals(season_id, player_ids=None):
+    """
+    指定選手 (省略時はシーズン全選手) の PlayerSeasonTotals を PlayerStat から再計算する。
+    スタッツが無くなった選手の行は削除する。コミットは呼び出し側で行う。
+    """
+    if season_id is None: return
+    bump_stats_version(season_id)
+    if player_ids is not None:
+        player_ids = sorted({pid for pid in player_ids if pid is not None})
+        if not player_ids: return
+
+    query = db.session.query(
+        PlayerStat.player_id, func.count(PlayerStat.game_id),
+        *[func.sum(getattr(PlayerStat, col)) for col in PLAYER_STAT_COLUMNS]
+    ).join(Game, PlayerStat.game_id == Game.id).filter(Game.season_id == season_id)
+    existing_query = PlayerSeasonTotals.query.filter(PlayerSeasonTotals.season_id == season_id)
+    if player_ids is not None:
+        query = query.filter(PlayerStat.player_id.in_(player_ids))
+        existing_query = existing_query.filter(PlayerSeasonTotals.player_id.in_(player_ids))
+
+    existing = {r.player_id: r for r in existing_query.all()}
+    for row in query.group_by(PlayerStat.player_id).all():
+        totals = existing.pop(row[0], None)
+        if totals is None:
+            totals = PlayerSeasonTotals(season_id=season_id, player_id=row[0])
+            db.session.add(totals)
+        totals.games_played = row[1]
+        for i, col in enumerate(PLAYER_STAT_COLUMNS): setattr(totals, col, row[i + 2] or 0)
+    for stale in existing.values(): db.session.delete(stale)
+
+def season_stat_player_ids(season_id=None, game_ids=None):
+    """ スタッツを持つ選手IDの集合 (試合の削除・再入力の前に影響範囲を取るため) """
+    query = db.session.query(PlayerStat.player_id).distinct()
+    if game_ids is not None: query = query.filter(PlayerStat.game_id.in_(game_ids))
+    if season_id is not None: query = query.join(Game, PlayerStat.game_id == Game.id).filter(Game.season_id == season_id)
+    return {pid for (pid,) in query.all()}
+
+# --- 関連データごとの一括削除 ---
+# どれも件数によらず数本の DELETE ... WHERE ... IN (サブクエリ) で済ませる。コミットは呼び出し側で行う。
+# (PostgreSQL では外部キーにも ON DELETE を付けてあるが、SQLite は外部キー制約を強制しないため明示的に消す)
+def delete_games_cascade(condition):
+    """ condition に当てはまる試合をスタッツごと削除し、削除した試合数を返す """
+    game_ids = db.select(Game.id).where(condition)
+    PlayerStat.query.filter(PlayerStat.game_id.in_(game_ids)).delete(synchronize_session=False)
+    return Game.query.filter(condition).delete(synchronize_session=False)
+
+def delete_players_cascade(condition):
+    """ condition に当てはまる選手を、スタッツ・シーズン合計・MVP候補・投票・投票結果ごと削除する """
+    player_ids = db.select(Player.id).where(condition)
+    for model in (PlayerStat, PlayerSeasonTotals, MVPCandidate, Vote, VoteResult):
+        model.query.filter(model.player_id.in_(player_ids)).delete(synchronize_session=False)
+    return Player.query.filter(condition).delete(synchronize_session=False)
+
+def delete_team_cascade(team_id):
+    """ チームを所属選手・関わった試合・順位表の行ごと削除する (プレイオフ表からは外すだけ) """
+    PlayoffMatch.query.filter(PlayoffMatch.team1_id == team_id).update({PlayoffMatch.team1_id: None, PlayoffMatch.team1_wins: 0}, synchronize_session=False)
+    PlayoffMatch.query.filter(PlayoffMatch.team2_id == team_id).update({PlayoffMatch.team2_id: None, PlayoffMatch.team2_wins: 0}, synchronize_session=False)
+    delete_players_cascade(Player.team_id == team_id)
+    delete_games_cascade(or_(Game.home_team_id == team_id, Game.away_team_id == team_id))
+    TeamSeasonStanding.query.filter_by(team_id=team_id).delete(synchronize_session=False)
+    return Team.query.filter_by(id=team_id).delete(synchronize_session=False)
+
+def _totals_avg(col, label):
+    return (getattr(PlayerSeasonTotals, col) * 1.0 / PlayerSeasonTotals.games_played).label(label)
+
+def _totals_pct(made, attempted, label):
+    made = getattr(PlayerSeasonTotals, made); attempted = getattr(PlayerSeasonTotals, attempted)
+    return case((attempted > 0, (made * 100.0 / attempted)), else_=0).label(label)
+
+# --- リーダーボード ---
+# kind: 'avg' = 1試合平均, 'pct' = 成功率(%)。reverse=True は値が小さいほど上位
+LEADERBOARD_CATEGORIES = {
+    'pts': {'label': '平均得点', 'title': '得点王', 'kind': 'avg', 'col': 'pts'},
+    'ast': {'label': '平均アシスト', 'title': 'アシスト王', 'kind': 'avg', 'col': 'ast'},
+    'reb': {'label': '平均リバウンド', 'title': 'リバウンド王', 'kind': 'avg', 'col': 'reb'},
+    'stl': {'label': '平均スティール', 'title': 'スティール王', 'kind': 'avg', 'col': 'stl'},
+    'blk': {'label': '平均ブロック', 'title': 'ブロック王', 'kind': 'avg', 'col': 'blk'},
+    'turnover': {'label': '平均ターンオーバー', 'kind': 'avg', 'col': 'turnover'},
+    'foul': {'label': '平均ファウル', 'kind': 'avg', 'col': 'foul'},
+    'fg_pct': {'label': 'FG%', 'kind': 'pct', 'made': 'fgm', 'attempted': 'fga'},
+    'three_p_pct': {'label': '3P%', 'kind': 'pct', 'made': 'three_pm', 'attempted': 'three_pa'},
+    'ft_pct': {'label': 'FT%', 'kind': 'pct', 'made': 'ftm', 'attempted': 'fta'},
+}
+# トップページのスタッツリーダーに表示するカテゴリ (表示順)
+HOME_LEADER_CATEGORIES = ('pts', 'ast', 'reb', 'stl', 'blk')
+
+LeaderEntry = namedtuple('LeaderEntry', ['name', 'value', 'player_id', 'rank'])
+
+def _leaderboard_select(season_id, key, min_games):
+    """ 1カテゴリ分の (category, player_id, value, sort_key) を返す SELECT """
+    config = LEADERBOARD_CATEGORIES[key]
+    T = PlayerSeasonTotals
+    if config['kind'] == 'pct':
+        made = getattr(T, config['made']); attempted = getattr(T, config['attempted'])
+        value = case((attempted > 0, made * 100.0 / attempted), else_=0)
+    else:
+        value = getattr(T, config['col']) * 1.0 / T.games_played
+    sort_key = -value if config.get('reverse') else value
+    return db.select(
+        db.cast(db.literal(key), db.String(20)).label('category'), T.player_id.label('player_id'),
+        value.label('value'), sort_key.label('sort_key')
+    ).where(T.season_id == season_id, T.games_played >= max(min_games, 1))
+
+def _query_leaderboards(season_id, categories, limit, offset, min_games):
+    ranked_source = db.union_all(*[_leaderboard_select(season_id, key, min_games) for key in categories]).subquery()
+    ranked = db.select(
+        ranked_source.c.category, ranked_source.c.player_id, ranked_source.c.value,
+        func.row_number().over(partition_by=ranked_source.c.category,
+                               order_by=(ranked_source.c.sort_key.desc(), ranked_source.c.player_id)).label('row_num'),
+        func.rank().over(partition_by=ranked_source.c.category, order_by=ranked_source.c.sort_key.desc()).label('rank_num')
+    ).subquery()
+    rows = db.session.execute(
+        db.select(ranked.c.category, Player.name, ranked.c.value, ranked.c.player_id, ranked.c.rank_num)
+        .join(Player, Player.id == ranked.c.player_id)
+        .where(ranked.c.row_num > offset, ranked.c.row_num <= offset + limit)
+        .order_by(ranked.c.category, ranked.c.row_num)
+    ).all()
+    boards = {key: [] for key in categories}
+    for category, name, value, player_id, rank_num in rows:
+        boards[category].append(LeaderEntry(name, float(value or 0), player_id, rank_num))
+    return boards
+
+def get_leaderboards(season_id, categories=None, limit=5, offset=0, min_games=1):
+    """
+    指定カテゴリのリーダーボードを {カテゴリ: [LeaderEntry, ...]} で返す。
+    全カテゴリを UNION ALL + ROW_NUMBER()/RANK() の1クエリで順位付けし、
+    結果はシーズンの試合結果が更新されるまでキャッシュする。
+    """
+    categories = tuple(categories or LEADERBOARD_CATEGORIES.keys())
+    unknown = [key for key in categories if key not in LEADERBOARD_CATEGORIES]
+    if unknown: raise ValueError(f'未対応のカテゴリです: {unknown}')
+    return season_cached('leaderboards', season_id, (categories, limit, offset, min_games),
+                         lambda: _query_leaderboards(season_id, categories, limit, offset, min_games))
+
 def get_stats_leaders(season_id):
-    leaders = {}
-    stat_fields = {'pts': '平均得点', 'ast': '平均アシスト', 'reb': '平均リバウンド', 'stl': '平均スティール', 'blk': '平均ブロック'}
-    for field_key, field_name in stat_fields.items():
-        avg_stat = func.avg(getattr(PlayerStat, field_key)).label('avg_value')
-        query_result = db.session.query(Player.name, avg_stat, Player.id)\
-            .join(PlayerStat, PlayerStat.player_id == Player.id)\
-            .join(Game, PlayerStat.game_id == Game.id)\
-            .filter(Game.is_finished == True, Game.season_id == season_id, Game.is_forfeit == False)\
-            .group_by(Player.id).order_by(db.desc('avg_value')).limit(5).all()
-        leaders[field_name] = query_result
-    return leaders
+    """ トップページ用: {表示名: [(選手名, 平均値, 選手ID), ...]} (各Top5) """
+    boards = get_leaderboards(season_id, HOME_LEADER_CATEGORIES, limit=5)
+    return {LEADERBOARD_CATEGORIES[key]['label']: boards[key] for key in HOME_LEADER_CATEGORIES}
 
 def generate_round_robin_rounds(team_list, reverse_fixtures=False):
     if not team_list or len(team_list) < 2: return []
@@ -405,98 +762,649 @@ def generate_round_robin_rounds(team_list, reverse_fixtures=False):
         all_rounds_games.append(current_round_games); rotating_teams.rotate(1)
     return all_rounds_games
 
-def analyze_stats(target_id, all_data, id_key, fields_config, limit=5):
-    result = {}
-    data_list = []
-    for item in all_data:
-        entry = {}
-        if isinstance(item, dict):
-            current_id = item.get('team').id if 'team' in item else item.get(id_key)
-            for field in fields_config.keys(): entry[field] = item.get(field, 0) or 0
+class StatRankingMatrix:
+    """
+    シーズン全体の (エンティティ × 指標) 行列から、全員分の順位・パーセンタイル・リーグ平均・色分けを
+    NumPy で一括計算して保持する。ページ表示時は lookup() で1行を取り出すだけ。
+    """
+    def __init__(self, ids, raw_rows, fields_config, limit=5):
+        self.fields_config = fields_config
+        self.fields = list(fields_config.keys())
+        self.limit = limit
+        self.raw_rows = raw_rows
+        self.index = {}
+        for i, eid in enumerate(ids): self.index.setdefault(eid, i)
+
+        n = len(raw_rows); f = len(self.fields)
+        self.matrix = np.array([[float(v) for v in row] for row in raw_rows], dtype=float).reshape(n, f)
+        self.reverse = np.array([bool(config.get('reverse', False)) for config in fields_config.values()], dtype=bool)
+        self.avg = self.matrix.mean(axis=0) if n else np.zeros(f)
+        self.sorted_cols = np.sort(self.matrix, axis=0)
+        self.ranks = self._rank_values(self.matrix)
+        self.percentiles = np.round(100.0 * (n - self.ranks + 1) / n, 1) if n else np.zeros((0, f))
+        self.color_classes = self._color_classes(self.matrix, self.ranks)
+
+    @classmethod
+    def from_records(cls, all_data, id_key, fields_config, limit=5):
+        """ 辞書 (順位表の行) または属性を持つ行 (クエリ結果) のリストから作る """
+        ids = []; raw_rows = []
+        for item in all_data:
+            if isinstance(item, dict):
+                ids.append(item.get('team').id if 'team' in item else item.get(id_key))
+                raw_rows.append([item.get(field, 0) or 0 for field in fields_config])
+            else:
+                ids.append(getattr(item, id_key))
+                raw_rows.append([getattr(item, field, 0) or 0 for field in fields_config])
+        return cls(ids, raw_rows, fields_config, limit)
+
+    def _rank_values(self, values):
+        """ 同値は同順位 (上位の人数 + 1)。values は (k, 指標数) の行列 """
+        n = self.matrix.shape[0]
+        ranks = np.empty(values.shape, dtype=int)
+        for j in range(len(self.fields)):
+            col = self.sorted_cols[:, j]
+            if self.reverse[j]: better = np.searchsorted(col, values[:, j], side='left')
+            else: better = n - np.searchsorted(col, values[:, j], side='right')
+            ranks[:, j] = better + 1
+        return ranks
+
+    def _color_classes(self, values, ranks):
+        good = np.where(self.reverse, values <= self.avg, values >= self.avg)
+        return np.where(ranks <= self.limit, 'stat-top', np.where(good, 'stat-good', 'stat-avg'))
+
+    def row_values(self, target_id):
+        i = self.index.get(target_id)
+        return None if i is None else dict(zip(self.fields, self.raw_rows[i]))
+
+    def lookup(self, target_id):
+        """ analyze_stats と同じ形式 {指標: {value, rank, avg, color_class, label, percentile}} を返す """
+        n = self.matrix.shape[0]
+        i = self.index.get(target_id)
+        if i is not None:
+            raw = self.raw_rows[i]; ranks = self.ranks[i]; colors = self.color_classes[i]; percentiles = self.percentiles[i]
         else:
-            current_id = getattr(item, id_key)
-            for field in fields_config.keys(): entry[field] = getattr(item, field, 0) or 0
-        entry['id'] = current_id
-        data_list.append(entry)
-
-    for field, config in fields_config.items():
-        values = [d[field] for d in data_list]
-        avg_val = sum(values) / len(values) if values else 0
-        target_val = next((d[field] for d in data_list if d['id'] == target_id), 0)
-        reverse_sort = not config.get('reverse', False)
-        sorted_values = sorted(values, reverse=reverse_sort)
-        try: rank = sorted_values.index(target_val) + 1
-        except ValueError: rank = len(values)
-        if rank <= limit: color_class = 'stat-top' 
-        elif (not config.get('reverse', False) and target_val >= avg_val) or (config.get('reverse', False) and target_val <= avg_val): color_class = 'stat-good' 
-        else: color_class = 'stat-avg' 
-        result[field] = {'value': target_val, 'rank': rank, 'avg': avg_val, 'color_class': color_class, 'label': config['label']}
-    return result
+            # 対象がいない場合は値0として扱う (0の人がいなければ最下位)
+            raw = [0] * len(self.fields)
+            zero = np.zeros((1, len(self.fields)))
+            ranks = np.where((self.matrix == 0).any(axis=0), self._rank_values(zero)[0], n) if n else np.zeros(len(self.fields), dtype=int)
+            colors = self._color_classes(zero, ranks[np.newaxis, :])[0]
+            percentiles = np.zeros(len(self.fields))
+        result = {}
+        for j, (field, config) in enumerate(self.fields_config.items()):
+            result[field] = {
+                'value': raw[j], 'rank': int(ranks[j]), 'avg': float(self.avg[j]),
+                'color_class': str(colors[j]), 'label': config['label'], 'percentile': float(percentiles[j])
+            }
+        return result
+
+def analyze_stats(target_id, all_data, id_key, fields_config, limit=5):
+    return StatRankingMatrix.from_records(all_data, id_key, fields_config, limit).lookup(target_id)
 
 # =========================================================
 # 5. ルーティング
 # =========================================================
 
+# --- マイグレーション ---
+# (バージョン, 説明, 適用関数) を古い順に並べる。適用済みバージョンは SystemSetting 'schema_version' に記録。
+# 各関数は途中まで適用済みのDBに再実行しても壊れないように書く (存在チェックしてから追加する)。
+SCHEMA_VERSION_KEY = 'schema_version'
+
+def _add_column_if_missing(conn, table, column, ddl):
+    """ カラムが無ければ追加する (SQLite は ADD COLUMN IF NOT EXISTS 非対応のため先に確認) """
+    columns = {c['name'] for c in inspect(conn).get_columns(table)}
+    if column in columns: return False
+    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+    return True
+
+# 旧 /admin/fix_db_schema, /admin/fix_db_image, 起動時 ALTER で足していたカラムと、
+# 初期のDBに無かった後付けカラム (テーブル名, カラム名, 型とデフォルト)
+LEGACY_COLUMNS = [
+    ('player_stat', 'sort_order', 'INTEGER DEFAULT 0'),
+    ('player', 'image_url', 'VARCHAR(255)'),
+    ('player', 'is_active', 'BOOLEAN DEFAULT TRUE'),
+    ('team', 'is_active', 'BOOLEAN DEFAULT TRUE'),
+    ('news', 'image_url', 'VARCHAR(255)'),
+    ('game', 'is_forfeit', 'BOOLEAN DEFAULT FALSE'),
+    ('game', 'season_id', 'INTEGER REFERENCES season (id)'),
+    ('game', 'result_input_time', 'TIMESTAMP'),
+    ('game', 'result_image_url', 'VARCHAR(500)'),
+    ('mvp_candidate', 'fg_pct', 'FLOAT DEFAULT 0'),
+    ('mvp_candidate', 'three_pt_pct', 'FLOAT DEFAULT 0'),
+    ('mvp_candidate', 'candidate_type', "VARCHAR(20) DEFAULT 'weekly'"),
+    ('mvp_candidate', 'team_wins', 'INTEGER DEFAULT 0'),
+    ('mvp_candidate', 'team_losses', 'INTEGER DEFAULT 0'),
+]
+
+def _migration_legacy_columns(conn):
+    for table, column, ddl in LEGACY_COLUMNS:
+        _add_column_if_missing(conn, table, column, ddl)
+
+def _create_index_if_missing(conn, name, table, columns):
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"))
+
+# v2 時点の検索用インデックス (モデル側の宣言は後のバージョンで変わるため、ここでは固定で持つ)
+SEARCH_INDEXES_V2 = [
+    ('ix_game_season_date', 'game', ['season_id', 'game_date', 'start_time']),
+    ('ix_game_season_finished', 'game', ['season_id', 'is_finished', 'game_date']),
+    ('ix_game_home_team', 'game', ['home_team_id', 'season_id']),
+    ('ix_game_away_team', 'game', ['away_team_id', 'season_id']),
+    ('ix_player_stat_game_player', 'player_stat', ['game_id', 'player_id']),
+    ('ix_player_stat_player_game', 'player_stat', ['player_id', 'game_id']),
+    ('ix_vote_config_user', 'vote', ['vote_config_id', 'user_id']),
+    ('ix_vote_result_config', 'vote_result', ['vote_config_id', 'category', 'rank']),
+]
+
+def _migration_search_indexes(conn):
+    """ 検索用の複合インデックス (既にあれば何もしない) """
+    for name, table, columns in SEARCH_INDEXES_V2:
+        _create_index_if_missing(conn, name, table, columns)
+
+def _migration_game_datetime(conn):
+    """ Game.game_datetime を追加して既存の文字列日時から埋め、日付系インデックスを日時型に張り替える """
+    _add_column_if_missing(conn, 'game', 'game_datetime', 'TIMESTAMP')
+    game_table = Game.__table__
+    rows = conn.execute(db.select(game_table.c.id, game_table.c.game_date, game_table.c.start_time)
+                        .where(game_table.c.game_datetime.is_(None))).all()
+    updates = [{'gid': r.id, 'dt': parse_game_datetime(r.game_date, r.start_time)} for r in rows]
+    updates = [u for u in updates if u['dt'] is not None]
+    if updates:
+        conn.execute(game_table.update().where(game_table.c.id == db.bindparam('gid')).values(game_datetime=db.bindparam('dt')), updates)
+    if len(updates) < len(rows): print(f"game_datetime: 日付を解釈できない試合 {len(rows) - len(updates)} 件は未設定のままです")
+    # 同日の試合順 (直近5試合・連勝) が開始時刻順に変わるため、保存済み順位表は消して run_migrations の最後に作り直す
+    conn.execute(TeamSeasonStanding.__table__.delete())
+    conn.execute(text("DROP INDEX IF EXISTS ix_game_season_date"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_game_season_finished"))
+    _create_index_if_missing(conn, 'ix_game_season_datetime', 'game', ['season_id', 'game_datetime'])
+    _create_index_if_missing(conn, 'ix_game_season_finished_datetime', 'game', ['season_id', 'is_finished', 'game_datetime'])
+    _create_index_if_missing(conn, 'ix_game_datetime', 'game', ['game_datetime'])
+
+# v4 で ON DELETE を付け直す外部キー (テーブル, カラム, 参照先テーブル, ルール)
+FOREIGN_KEY_RULES_V4 = [
+    ('player', 'team_id', 'team', 'CASCADE'),
+    ('game', 'home_team_id', 'team', 'CASCADE'),
+    ('game', 'away_team_id', 'team', 'CASCADE'),
+    ('player_stat', 'game_id', 'game', 'CASCADE'),
+    ('player_stat', 'player_id', 'player', 'CASCADE'),
+    ('playoff_match', 'team1_id', 'team', 'SET NULL'),
+    ('playoff_match', 'team2_id', 'team', 'SET NULL'),
+    ('vote', 'vote_config_id', 'vote_config', 'CASCADE'),
+    ('vote', 'player_id', 'player', 'CASCADE'),
+    ('vote_result', 'vote_config_id', 'vote_config', 'CASCADE'),
+    ('vote_result', 'player_id', 'player', 'CASCADE'),
+    ('mvp_candidate', 'player_id', 'player', 'CASCADE'),
+    ('team_season_standing', 'season_id', 'season', 'CASCADE'),
+    ('team_season_standing', 'team_id', 'team', 'CASCADE'),
+    ('player_season_totals', 'season_id', 'season', 'CASCADE'),
+    ('player_season_totals', 'player_id', 'player', 'CASCADE'),
+]
+
+def _migration_foreign_key_rules(conn):
+    """ 既存の外部キーに ON DELETE を付け直す (SQLite は制約を変更できず強制もしないため何もしない) """
+    if conn.dialect.name != 'postgresql': return
+    inspector = inspect(conn)
+    for table, column, referred_table, rule in FOREIGN_KEY_RULES_V4:
+        for fk in inspector.get_foreign_keys(table):
+            if fk['constrained_columns'] != [column] or fk['referred_table'] != referred_table: continue
+            if (fk.get('options') or {}).get('ondelete', '').upper() == rule: continue
+            name = fk['name'] or f'{table}_{column}_fkey'
+            conn.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT {name}, '
+                              f'ADD CONSTRAINT {name} FOREIGN KEY ({column}) REFERENCES {referred_table} (id) ON DELETE {rule}'))
+
+def _migration_analysis_job_timings(conn):
+    _add_column_if_missing(conn, 'analysis_job', 'timings', 'TEXT')
+
+def _migration_analysis_job_batch(conn):
+    _add_column_if_missing(conn, 'analysis_job', 'batch_id', 'VARCHAR(32)')
+    _create_index_if_missing(conn, 'ix_analysis_job_batch_id', 'analysis_job', ['batch_id'])
+
+def _migration_vote_ballot_unique(conn):
+    # 同時送信で重複した行は最後の1行だけ残す
+    conn.execute(text(
+        "DELETE FROM vote WHERE id NOT IN (SELECT MAX(id) FROM vote GROUP BY vote_config_id, user_id, category, rank_value)"))
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_vote_ballot ON vote (vote_config_id, user_id, category, rank_value)"))
+
+MIGRATIONS = [
+    (1, '後付けカラムの追加 (sort_order, image_url, is_forfeit ほか)', _migration_legacy_columns),
+    (2, '検索用複合インデックス (game, player_stat, vote, vote_result)', _migration_search_indexes),
+    (3, 'Game.game_datetime の追加・既存試合の埋め戻し・日時インデックス', _migration_game_datetime),
+    (4, '外部キーに ON DELETE (CASCADE / SET NULL) を付与 (PostgreSQL)', _migration_foreign_key_rules),
+    (5, 'AnalysisJob.timings (解析の工程別所要時間) の追加', _migration_analysis_job_timings),
+    (6, 'AnalysisJob.batch_id (試合日の一括取り込み) の追加', _migration_analysis_job_batch),
+    (7, 'Vote の一意制約 (投票イベント・ユーザー・カテゴリ・点数)', _migration_vote_ballot_unique),
+]
+LATEST_SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version():
+    setting = db.session.get(SystemSetting, SCHEMA_VERSION_KEY)
+    return int(setting.value) if setting and setting.value else 0
+
+def run_migrations():
+    """ 未適用のマイグレーションを順に適用し、適用したバージョンのリストを返す """
+    db.create_all()
+    applied = []
+    current = get_schema_version()
+    db.session.close()
+    for version, description, migrate in MIGRATIONS:
+        if version <= current: continue
+        # 1バージョンずつ DDL とバージョン記録を同じトランザクションで確定させる
+        with db.engine.begin() as conn:
+            migrate(conn)
+            updated = conn.execute(SystemSetting.__table__.update()
+                                   .where(SystemSetting.key == SCHEMA_VERSION_KEY)
+                                   .values(value=str(version))).rowcount
+            if not updated:
+                conn.execute(SystemSetting.__table__.insert().values(key=SCHEMA_VERSION_KEY, value=str(version)))
+        applied.append((version, description))
+    build_missing_season_aggregates()
+    return applied
+
+def build_missing_season_aggregates():
+    """ 試合があるのに TeamSeasonStanding / PlayerSeasonTotals が無いシーズン (集計テーブル導入前のデータ) の集計を作成する。
+        複数ワーカーが同時に作成した場合は一意制約で負けた側が取り消すだけ """
+    has_games = Season.id.in_(db.select(Game.season_id))
+    for model, refresh in ((TeamSeasonStanding, refresh_team_standings), (PlayerSeasonTotals, refresh_player_totals)):
+        missing = db.session.query(Season.id).filter(has_games, Season.id.notin_(db.select(model.season_id)))
+        for (season_id,) in missing.all():
+            try:
+                refresh(season_id)
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+
 # --- マイグレーション（起動時） ---
 with app.app_context():
-    db.create_all()
     try:
-        with db.engine.connect() as conn:
-            trans = conn.begin()
-            try:
-                # ★ここが強力な自動修正機能です
-                # PostgreSQL等の場合、IF NOT EXISTS をつけると「無ければ作る、あれば無視する」という安全な挙動になります
-                conn.execute(text("ALTER TABLE player_stat ADD COLUMN IF NOT EXISTS sort_order INTEGER DEFAULT 0"))
-                
-                # ついでに他の重要なカラムも念の為チェック
-                conn.execute(text("ALTER TABLE player ADD COLUMN IF NOT EXISTS image_url VARCHAR(255)"))
-                conn.execute(text("ALTER TABLE game ADD COLUMN IF NOT EXISTS is_forfeit BOOLEAN DEFAULT FALSE"))
-                
-                trans.commit()
-                print("データベースの自動更新が完了しました (sort_order 等を確認済み)")
-            except Exception as e:
-                # すでにカラムがある場合など、エラーが出てもアプリを止めないようにする
-                print(f"マイグレーション スキップ: {e}")
-                trans.rollback()
+        for version, description in run_migrations():
+            print(f"マイグレーション v{version} を適用しました: {description}")
     except Exception as e:
-        print(f"起動時DB接続エラー: {e}")
+        # 複数ワーカーが同時に起動した場合など、エラーが出てもアプリを止めないようにする
+        db.session.rollback()
+        print(f"マイグレーション スキップ: {e}")
 
-# --- ★重要: DBメンテナンス用ルート（エラー解消用） ---
+# --- DBメンテナンス用ルート (旧URL互換: マイグレーションを実行するだけ) ---
 @app.route('/admin/fix_db_schema')
 @login_required
 @admin_required
 def fix_db_schema():
     try:
-        with db.engine.connect() as conn:
-            # sort_order カラムがない場合に備えて強制追加
-            try:
-                conn.execute(text("ALTER TABLE player_stat ADD COLUMN sort_order INTEGER DEFAULT 0"))
-                flash("sort_orderカラムを追加しました。")
-            except Exception:
-                flash("sort_orderカラムは既に存在します。")
-                
-            try:
-                conn.execute(text("ALTER TABLE player ADD COLUMN image_url VARCHAR(255)"))
-                flash("image_urlカラムを追加しました。")
-            except Exception:
-                flash("image_urlカラムは既に存在します。")
-                
-            db.session.commit()
-            return redirect(url_for('index'))
+        applied = run_migrations()
     except Exception as e:
+        db.session.rollback()
         return f"DB Error: {e}"
+    if applied:
+        for version, description in applied: flash(f"マイグレーション v{version} を適用しました: {description}")
+    else:
+        flash(f"スキーマは最新です (v{LATEST_SCHEMA_VERSION})。")
+    # v3 で日付を解釈できなかった試合は日程表の末尾の別枠にしか出ないので、直すよう知らせる
+    undated = Game.query.filter(Game.game_datetime.is_(None)).order_by(Game.id).all()
+    if undated:
+        flash(f"日時が未設定の試合が {len(undated)} 件あります (日程表の末尾から日程変更で直せます): "
+              + ", ".join(f"ID {g.id} ({g.game_date or '日付なし'} {g.start_time or ''})".replace(' )', ')') for g in undated[:20])
+              + (" ほか" if len(undated) > 20 else ""))
+    return redirect(url_for('index'))
+
+# --- 画像の保存先 ---
+# 保存先は Cloudinary かローカルディスク (MEDIA_STORAGE)。Cloudinary への保存は通常リクエスト内で行う。
+# MEDIA_ROOT に全インスタンスで共有される永続ディスクを指定した場合だけ、リクエスト内ではローカルに置くだけにして
+# プレースホルダーURL (/media/pending/...) を返し、本保存はバックグラウンドで行って完了後に行のURLを差し替える
+MEDIA_ROOT = os.environ.get('MEDIA_ROOT') or os.path.join(basedir, 'media')
+MEDIA_URL_PATH = '/media'
+MEDIA_PENDING_FOLDER = 'pending'
+MEDIA_UPLOAD_WORKERS = int(os.environ.get('MEDIA_UPLOAD_WORKERS', 2))
+MEDIA_UPLOAD_QUEUE_SIZE = 32  # 実行中 + 待ちの上限。超えたらリクエスト内で保存する
+MEDIA_UPLOAD_RETRIES = 3
+MEDIA_UPLOAD_RETRY_SECONDS = 2  # 2秒, 4秒 と倍に延ばす
+MEDIA_EXTENSIONS = ((b'\x89PNG', '.png'), (b'\xff\xd8\xff', '.jpg'), (b'GIF8', '.gif'), (b'RIFF', '.webp'))
+# 'cloudinary' / 'local'。テストでは保存先のインスタンスを直接入れてもよい
+app.config.setdefault('MEDIA_STORAGE', os.environ.get('MEDIA_STORAGE') or ('cloudinary' if os.environ.get('CLOUDINARY_CLOUD_NAME') else 'local'))
+# プレースホルダーのファイルと再試行の待ち行列はそのインスタンスにしか無いので、MEDIA_ROOT (共有の永続ディスク) を
+# 明示していなければリクエスト内で本保存まで行う。サーバーレス環境は応答後にスレッドが止まるので常にリクエスト内
+app.config.setdefault('MEDIA_UPLOADS_INLINE', bool(os.environ.get('MEDIA_UPLOADS_INLINE') or os.environ.get('VERCEL')
+                                                   or not os.environ.get('MEDIA_ROOT')))
+
+MediaUploadTask = namedtuple('MediaUploadTask', ['placeholder', 'folder', 'max_width', 'columns', 'replaces'])
+
+class CloudinaryStorage:
+    """ Cloudinary に保存する。max_width は Cloudinary 側で縮小する (crop=limit) """
+    name = 'cloudinary'
+    url_pattern = re.compile(r'res\.cloudinary\.com/.+?/image/upload/(?:v\d+/)?(.+?)(?:\.\w+)?$')
+
+    def save(self, fileobj, folder=None, max_width=None):
+        options = {'resource_type': 'image'}
+        if folder: options['folder'] = folder
+        if max_width: options.update(width=max_width, crop='limit')
+        return cloudinary.uploader.upload_large(fileobj, **options)['secure_url']
+
+    def delete(self, url):
+        m = self.url_pattern.search(url or '')
+        if m: cloudinary.uploader.destroy(m.group(1))
+
+class LocalStorage:
+    """ MEDIA_ROOT 以下に保存し、/media/... のURLを返す (media_file で配信する) """
+    name = 'local'
+
+    def __init__(self, root=None): self.root = root or MEDIA_ROOT
+
+    def path_for(self, url):
+        if not (url or '').startswith(MEDIA_URL_PATH + '/'): return None
+        return safe_join(self.root, url[len(MEDIA_URL_PATH) + 1:])
+
+    def save(self, fileobj, folder=None, max_width=None):
+        head = fileobj.read(12); fileobj.seek(0)
+        ext = next((e for sig, e in MEDIA_EXTENSIONS if head.startswith(sig)), '.bin')
+        rel = '/'.join(filter(None, [folder, uuid.uuid4().hex + ext]))
+        path = safe_join(self.root, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        img = Image.open(fileobj) if max_width else None
+        if img is not None and img.width > max_width:
+            fmt = img.format
+            img.resize((max_width, max(1, round(img.height * max_width / img.width))), Image.LANCZOS).save(path, fmt)
+        else:
+            fileobj.seek(0)
+            with open(path, 'wb') as out: shutil.copyfileobj(fileobj, out, 64 * 1024)
+        return f'{MEDIA_URL_PATH}/{rel}'
+
+    def delete(self, url):
+        path = self.path_for(url)
+        # 本保存待ちのファイルはアップロードが読むので消さない
+        if path and f'/{MEDIA_PENDING_FOLDER}/' not in url and os.path.exists(path): os.remove(path)
+
+MEDIA_STORAGES = {'cloudinary': CloudinaryStorage, 'local': LocalStorage}
+_media_storages = {}
+
+def get_media_storage():
+    storage = app.config['MEDIA_STORAGE']
+    if not isinstance(storage, str): return storage
+    if storage not in _media_storages: _media_storages[storage] = MEDIA_STORAGES[storage]()
+    return _media_storages[storage]
+
+def delete_media(url):
+    """ 保存先に関係なく、URLの持ち主 (Cloudinary / ローカル) から消す。失敗しても処理は続ける """
+    try:
+        for storage in (CloudinaryStorage(), LocalStorage()): storage.delete(url)
+    except Exception as e: print(f"画像削除エラー {url}: {e}")
+
+_media_upload_executor = None
+_media_upload_lock = threading.Lock()
+_media_upload_slots = threading.BoundedSemaphore(MEDIA_UPLOAD_QUEUE_SIZE)
+
+def get_media_upload_executor():
+    global _media_upload_executor
+    with _media_upload_lock:
+        if _media_upload_executor is None:
+            _media_upload_executor = ThreadPoolExecutor(max_workers=MEDIA_UPLOAD_WORKERS, thread_name_prefix='media-upload')
+        return _media_upload_executor
+
+def save_media(fileobj, folder=None, max_width=None, columns=(), replaces=None):
+    """ 画像を保存してURLを返す。columns は URL を書き込む (モデル, カラム名)、replaces は置き換えで不要になる古いURL。
+        バックグラウンドで保存する場合はプレースホルダーURLを返し、完了後に columns の中のURLを差し替える """
+    storage = get_media_storage()
+    if storage.name == 'local' or app.config['MEDIA_UPLOADS_INLINE']:
+        url = storage.save(fileobj, folder, max_width)
+        if replaces: delete_media(replaces)
+        return url
+    task = MediaUploadTask(LocalStorage().save(fileobj, MEDIA_PENDING_FOLDER), folder, max_width, tuple(columns), replaces)
+    if has_request_context():
+        # 行のコミットが済んでから積む (先に完了すると差し替える行がまだ無い)
+        @after_this_request
+        def _submit(response):
+            submit_media_upload(task)
+            return response
+    else:
+        submit_media_upload(task)
+    return task.placeholder
+
+def submit_media_upload(task):
+    if not _media_upload_slots.acquire(blocking=False):
+        # 待ちが上限を超えたら取りこぼさないよう呼び出し元で保存する
+        _run_media_upload(task)
+        return
+    future = get_media_upload_executor().submit(_run_media_upload, task)
+    future.add_done_callback(lambda f: _media_upload_slots.release())
+
+def _run_media_upload(task):
+    """ 本保存 (失敗したら間隔を延ばして再試行) → 行のURLの差し替え → プレースホルダーを転送に切り替え """
+    storage = get_media_storage()
+    path = LocalStorage().path_for(task.placeholder)
+    for attempt in range(MEDIA_UPLOAD_RETRIES):
+        try:
+            with open(path, 'rb') as f: url = storage.save(f, task.folder, task.max_width)
+            break
+        except Exception as e:
+            print(f"画像アップロード失敗 ({attempt + 1}/{MEDIA_UPLOAD_RETRIES}) {task.placeholder}: {e}")
+            # 最後まで失敗したらプレースホルダー (共有ディスク上の画像) のまま残す
+            if attempt + 1 == MEDIA_UPLOAD_RETRIES: return None
+            time.sleep(MEDIA_UPLOAD_RETRY_SECONDS * 2 ** attempt)
+    with app.app_context():
+        try:
+            for model, column in task.columns:
+                col = getattr(model, column)
+                model.query.filter(col.contains(task.placeholder))\
+                    .update({col: func.replace(col, task.placeholder, url)}, synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"画像URL差し替えエラー {task.placeholder}: {e}")
+    # 共有済み (ツイートなど) のプレースホルダーURLは以後 本保存先へ転送する
+    with open(path + '.url', 'w') as f: f.write(url)
+    os.remove(path)
+    if task.replaces: delete_media(task.replaces)
+    return url
+
+@app.route('/media/<path:filename>')
+def media_file(filename):
+    """ ローカル保存の画像を配信する。本保存が済んだプレースホルダーは保存先へ転送する """
+    path = safe_join(MEDIA_ROOT, filename)
+    if path is None: abort(404)
+    if not os.path.exists(path) and os.path.exists(path + '.url'):
+        with open(path + '.url') as f: return redirect(f.read().strip(), code=301)
+    pending = filename.startswith(MEDIA_PENDING_FOLDER + '/')
+    return send_from_directory(MEDIA_ROOT, filename, max_age=0 if pending else 7 * 24 * 3600)
+
+# --- 画像の縮小版 ---
+# Cloudinary の画像は Cloudinary の変換URL (w_<幅>,f_auto,q_auto) をそのまま使う。
+# ローカルの画像 (/static, /media) は表示サイズに合わせた縮小版を初回のリクエストで作ってディスクに置き、以後はそれを返す。
+# WebP に対応したブラウザには WebP、それ以外には JPEG (透過のある画像は PNG)。
+# URL には元画像とその版 (更新日時とサイズ) を含めて署名するので、元画像が変わればURLも変わる → 無期限にキャッシュさせる。
+# 縮小版の置き場所に書き込めない環境 (Vercel など) では元画像のURLのまま返す
+IMAGE_VARIANT_ROOT = os.environ.get('IMAGE_VARIANT_ROOT') or os.path.join(MEDIA_ROOT, 'variants')
+IMAGE_VARIANT_VERSION = 1  # 縮小・変換の処理を変えたら上げる (保存済みの縮小版を使わなくなる)
+IMAGE_VARIANT_MAX_WIDTH = 2048
+IMAGE_VARIANT_DENSITIES = (1, 2, 3)  # 固定サイズの表示で用意する倍率 (高解像度の画面向け)
+IMAGE_VARIANT_FLUID_WIDTHS = (320, 480, 640, 960, 1280)  # 幅が可変の表示で用意する幅
+IMAGE_VARIANT_MAX_BYTES = int(os.environ.get('IMAGE_VARIANT_MAX_BYTES', 200 * 1024 * 1024))  # 超えたら最後に使われたのが古い順に消す
+IMAGE_VARIANT_SOURCE_MAX_BYTES = 10 * 1024 * 1024
+IMAGE_VARIANT_MAX_AGE = 365 * 24 * 3600
+
+def _image_variant_signature(src, version, width):
+    message = f'{src}|{version}|{width}'.encode()
+    return hmac.new(str(app.config['SECRET_KEY']).encode(), message, hashlib.sha256).hexdigest()[:20]
+
+_image_variant_root_writable = None
+
+def image_variant_root_writable():
+    """ 縮小版の置き場所に書き込めるか (プロセスごとに1回だけ確かめる) """
+    global _image_variant_root_writable
+    if _image_variant_root_writable is None:
+        try:
+            os.makedirs(IMAGE_VARIANT_ROOT, exist_ok=True)
+            _image_variant_root_writable = os.access(IMAGE_VARIANT_ROOT, os.W_OK)
+        except OSError:
+            _image_variant_root_writable = False
+    return _image_variant_root_writable
+
+_CLOUDINARY_UPLOAD_PATH = re.compile(r'^(https?://res\.cloudinary\.com/[^/]+/image/upload/)(.+)$')
+
+def _local_image_path(src):
+    """ /static/... と /media/... の画像はディスク上のパス。それ以外は None """
+    if src.startswith('/static/'): return safe_join(app.static_folder, src[len('/static/'):])
+    return LocalStorage().path_for(src)
+
+def image_variant_url(src, width):
+    """ src を幅 width px に縮小した画像のURL。縮小できないもの (外部のURL・data: URL・本保存待ちの画像など) は src のまま """
+    if not src or width > IMAGE_VARIANT_MAX_WIDTH: return src
+    m = _CLOUDINARY_UPLOAD_PATH.match(src)
+    if m: return f'{m.group(1)}w_{width},c_limit,f_auto,q_auto/{m.group(2)}'
+    if src.startswith(('http://', 'https://', f'{MEDIA_URL_PATH}/{MEDIA_PENDING_FOLDER}/')): return src
+    path = _local_image_path(src)
+    if not path or not os.path.isfile(path) or not image_variant_root_writable(): return src
+    st = os.stat(path)
+    version = f'{st.st_mtime_ns:x}-{st.st_size:x}'
+    return url_for('image_variant', width=width, sig=_image_variant_signature(src, version, width), src=src, v=version)
+
+@app.template_global()
+def image_srcset(src, width, sizes=None):
+    """ <img> の src / srcset 属性を返す。width は表示する幅 (px)。
+        sizes を渡した場合は幅が可変の表示として、width 以下の幅の候補を w 指定で並べる """
+    if image_variant_url(src, width) == src: return Markup(f'src="{escape(src or "")}"')  # 縮小版が無いものは元画像だけ
+    if sizes:
+        widths = [w for w in IMAGE_VARIANT_FLUID_WIDTHS if w < width] + [width]
+        candidates = [f'{image_variant_url(src, w)} {w}w' for w in widths]
+        attrs = [('src', image_variant_url(src, width)), ('srcset', ', '.join(candidates)), ('sizes', sizes)]
+    else:
+        candidates = [f'{image_variant_url(src, width * d)} {d}x' for d in IMAGE_VARIANT_DENSITIES]
+        attrs = [('src', image_variant_url(src, width)), ('srcset', ', '.join(candidates))]
+    return Markup(' '.join(f'{name}="{escape(value)}"' for name, value in attrs))
+
+def _read_image_source(src):
+    path = _local_image_path(src) if not src.startswith(('http://', 'https://')) else None
+    if not path or not os.path.isfile(path): raise ValueError(f'元画像がありません: {src}')
+    if os.path.getsize(path) > IMAGE_VARIANT_SOURCE_MAX_BYTES: raise ValueError('元画像が大きすぎます')
+    with open(path, 'rb') as f: return f.read()
+
+_image_variant_bytes = None  # 保存済みの縮小版の合計サイズ (プロセスごとの概算。初回の保存時に数え直す)
+_image_variant_lock = threading.Lock()
+
+def _record_image_variant(size):
+    """ 合計が上限を超えたら、最後に使われた (返した) のが古い順に上限の9割まで消す """
+    global _image_variant_bytes
+    with _image_variant_lock:
+        if _image_variant_bytes is None:
+            _image_variant_bytes = sum(e.stat().st_size for d in os.scandir(IMAGE_VARIANT_ROOT) if d.is_dir()
+                                       for e in os.scandir(d.path) if e.is_file())
+        else:
+            _image_variant_bytes += size
+        if _image_variant_bytes <= IMAGE_VARIANT_MAX_BYTES: return
+        files = sorted((e.stat().st_mtime, e.stat().st_size, e.path) for d in os.scandir(IMAGE_VARIANT_ROOT) if d.is_dir()
+                       for e in os.scandir(d.path) if e.is_file())
+        for _, file_size, path in files:
+            if _image_variant_bytes <= IMAGE_VARIANT_MAX_BYTES * 0.9: break
+            try: os.remove(path)
+            except OSError: continue
+            _image_variant_bytes -= file_size
+
+def get_image_variant(src, version, width, webp):
+    """ 縮小版のパスと MIME タイプ。無ければ作る (保存名は元画像・版・幅・形式のハッシュ) """
+    material = f'v{IMAGE_VARIANT_VERSION}|{src}|{version}|{width}|{"webp" if webp else "fallback"}'
+    key = hashlib.sha256(material.encode()).hexdigest()
+    base = os.path.join(IMAGE_VARIANT_ROOT, key[:2], key)
+    for ext, mimetype in (('.webp', 'image/webp'), ('.jpg', 'image/jpeg'), ('.png', 'image/png')):
+        if os.path.exists(base + ext):
+            os.utime(base + ext)  # 最後に使った時刻 (消す順番に使う)
+            return base + ext, mimetype
+
+    img = Image.open(io.BytesIO(_read_image_source(src)))
+    img.draft('RGB', (width, width))
+    img = ImageOps.exif_transpose(img)
+    if img.width > width: img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+    alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+    if webp:
+        ext, mimetype, fmt, options = '.webp', 'image/webp', 'WEBP', {'quality': 80, 'method': 4}
+        img = img.convert('RGBA' if alpha else 'RGB')
+    elif alpha:
+        ext, mimetype, fmt, options = '.png', 'image/png', 'PNG', {'optimize': True}
+        img = img.convert('RGBA')
+    else:
+        ext, mimetype, fmt, options = '.jpg', 'image/jpeg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}
+        img = img.convert('RGB')
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    tmp = f'{base}.{uuid.uuid4().hex}.tmp'  # 同じ縮小版を同時に作っても壊れた画像を返さないよう、書き終えてから置き換える
+    img.save(tmp, fmt, **options)
+    os.replace(tmp, base + ext)
+    _record_image_variant(os.path.getsize(base + ext))
+    return base + ext, mimetype
+
+@app.route('/img/<int:width>/<sig>')
+def image_variant(width, sig):
+    src = request.args.get('src', ''); version = request.args.get('v', '')
+    if not hmac.compare_digest(sig, _image_variant_signature(src, version, width)): abort(404)
+    try:
+        path, mimetype = get_image_variant(src, version, width, 'image/webp' in request.headers.get('Accept', ''))
+    except Exception as e:
+        # 作れなければ元画像へ (表示は崩さない)
+        print(f"縮小版の作成エラー {src}: {e}")
+        return redirect(src)
+    response = send_file(path, mimetype=mimetype, max_age=IMAGE_VARIANT_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add('Accept')
+    return response
+
+# --- カード画像のアップロード ---
+# 本文 (multipart の image フィールド、または画像そのもの) をチャンクごとに読み、上限を超えた時点で打ち切る。
+# メモリには CARD_UPLOAD_SPOOL_BYTES までしか載せず、それを超えた分は一時ファイル経由で保存先 (save_media) に渡す
+CARD_UPLOAD_MAX_BYTES = 4 * 1024 * 1024  # Vercel の本文上限 (4.5MB) より小さく
+CARD_UPLOAD_CHUNK_BYTES = 64 * 1024
+CARD_UPLOAD_SPOOL_BYTES = 512 * 1024
+CARD_IMAGE_SIGNATURES = (b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff', b'RIFF')  # PNG / JPEG / WebP
+CARD_UPLOAD_FOLDER = "nba2k_jpl_cards"
+
+def spool_upload_stream(stream, limit=CARD_UPLOAD_MAX_BYTES):
+    """ stream をチャンクごとに一時ファイルへ書き写す。limit を超えたら RequestEntityTooLarge """
+    spool = tempfile.SpooledTemporaryFile(max_size=CARD_UPLOAD_SPOOL_BYTES)
+    size = 0
+    while True:
+        chunk = stream.read(CARD_UPLOAD_CHUNK_BYTES)
+        if not chunk: break
+        size += len(chunk)
+        if size > limit:
+            spool.close()
+            raise RequestEntityTooLarge()
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+def store_card_image(fileobj):
+    """ 先頭のバイト列で画像か確かめてから保存し、共有用の絶対URLを返す (fileobj は閉じる) """
+    with fileobj:
+        head = fileobj.read(12); fileobj.seek(0)
+        if not head.startswith(CARD_IMAGE_SIGNATURES) or (head.startswith(b'RIFF') and head[8:12] != b'WEBP'):
+            raise ValueError('画像ファイルではありません')
+        url = save_media(fileobj, CARD_UPLOAD_FOLDER)
+    return urljoin(request.host_url, url)
+
+@app.route('/api/card_image', methods=['POST'])
+def upload_card_image():
+    """ カード画像を multipart (image フィールド) か、本文そのまま (Content-Type: image/*) で受け取る """
+    request.max_content_length = CARD_UPLOAD_MAX_BYTES + CARD_UPLOAD_CHUNK_BYTES  # multipart の区切り分の余裕
+    try:
+        if request.mimetype == 'multipart/form-data':
+            file = request.files.get('image')
+            if not file or file.filename == '': return jsonify({'error': 'No image data'}), 400
+            source = file.stream  # multipart は Werkzeug が max_content_length を見ながら一時ファイルに書き出している
+        elif request.mimetype.startswith('image/'):
+            source = spool_upload_stream(request.stream)
+        else:
+            return jsonify({'error': 'multipart/form-data か image/* で送ってください'}), 415
+        return jsonify({'url': store_card_image(source)})
+    except RequestEntityTooLarge:
+        return jsonify({'error': f'画像が大きすぎます (上限 {CARD_UPLOAD_MAX_BYTES // (1024 * 1024)}MB)'}), 413
+    except ValueError as e: return jsonify({'error': str(e)}), 400
+    except Exception as e: return jsonify({'error': str(e)}), 500
 
 @app.route('/api/upload_card', methods=['POST'])
 def upload_card():
-    data = request.json
-    image_data = data.get('image')
+    """ 旧形式 (JSON の base64 data URL) の互換用。デコードして upload_card_image と同じ保存処理に渡す """
+    request.max_content_length = CARD_UPLOAD_MAX_BYTES * 4 // 3 + CARD_UPLOAD_CHUNK_BYTES  # base64 で 4/3 倍になる
+    try:
+        image_data = (request.get_json(silent=True) or {}).get('image')
+    except RequestEntityTooLarge:
+        return jsonify({'error': f'画像が大きすぎます (上限 {CARD_UPLOAD_MAX_BYTES // (1024 * 1024)}MB)'}), 413
     if not image_data: return jsonify({'error': 'No image data'}), 400
-    if 'data:image/png;base64,' in image_data: image_data = image_data.replace('data:image/png;base64,', '')
     try:
-        import base64
-        image_binary = base64.b64decode(image_data)
-        upload_result = cloudinary.uploader.upload(io.BytesIO(image_binary), resource_type="image", folder="nba2k_jpl_cards")
-        return jsonify({'url': upload_result['secure_url']})
+        image_binary = base64.b64decode(image_data.split(',', 1)[1] if image_data.startswith('data:') else image_data)
+        return jsonify({'url': store_card_image(io.BytesIO(image_binary))})
+    except ValueError as e: return jsonify({'error': str(e)}), 400
     except Exception as e: return jsonify({'error': str(e)}), 500
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -600,8 +1508,7 @@ def admin_news():
                 file = request.files['news_image']
                 if file and file.filename != '' and allowed_file(file.filename):
                     try:
-                        upload_result = cloudinary.uploader.upload(file)
-                        image_url = upload_result.get('secure_url')
+                        image_url = save_media(file.stream, columns=[(News, 'image_url')])
                     except Exception as e:
                         flash(f"画像アップロードに失敗しました: {e}")
                         return redirect(url_for('admin_news'))
@@ -687,8 +1594,7 @@ def get_team_record_in_period(team_id, start_date, end_date):
     """ 指定期間におけるチームの勝敗数を計算する """
     games = Game.query.filter(
         Game.is_finished == True,
-        Game.game_date >= start_date,
-        Game.game_date <= end_date,
+        game_period_clause(start_date, end_date),
         or_(Game.home_team_id == team_id, Game.away_team_id == team_id)
     ).all()
     
@@ -759,8 +1665,7 @@ def mvp_selector():
                       .join(Team, Player.team_id == Team.id)\
                       .join(Game, PlayerStat.game_id == Game.id)\
                       .filter(
-                          Game.game_date >= start_date, 
-                          Game.game_date <= end_date, 
+                          game_period_clause(start_date, end_date),
                           Team.league == league_name
                       )\
                       .group_by(Player.id, Team.id)\
@@ -869,7 +1774,7 @@ def roster():
                 file = request.files['logo_image']
                 if file and file.filename != '' and allowed_file(file.filename):
                     try:
-                        upload_result = cloudinary.uploader.upload(file); logo_url = upload_result.get('secure_url')
+                        logo_url = save_media(file.stream, columns=[(Team, 'logo_image')])
                     except Exception as e: flash(f"画像アップロードに失敗しました: {e}"); return redirect(url_for('roster'))
             if team_name and league:
                 if not Team.query.filter_by(name=team_name).first():
@@ -916,8 +1821,11 @@ def roster():
             player_id = request.form.get('player_id', type=int); new_team_id = request.form.get('new_team_id', type=int)
             player = Player.query.get(player_id); new_team = Team.query.get(new_team_id)
             if player and new_team:
-                old_team_name = player.team.name
-                player.team_id = new_team_id; db.session.commit()
+                old_team_name = player.team.name; old_team_id = player.team_id
+                player.team_id = new_team_id
+                # 選手のスタッツは所属チームの集計に入るため、移籍元・移籍先を全シーズン再計算
+                for (sid,) in db.session.query(Season.id).all(): refresh_team_standings(sid, [old_team_id, new_team_id])
+                db.session.commit()
                 flash(f'選手「{player.name}」を{old_team_name}から{new_team.name}に移籍させました。')
 
         # 6. ロゴ更新
@@ -928,10 +1836,7 @@ def roster():
                 file = request.files['logo_image']
                 if file and file.filename != '' and allowed_file(file.filename):
                     try:
-                        if team.logo_image:
-                            public_id = os.path.splitext(team.logo_image.split('/')[-1])[0]
-                            cloudinary.uploader.destroy(public_id)
-                        upload_result = cloudinary.uploader.upload(file); logo_url = upload_result.get('secure_url')
+                        logo_url = save_media(file.stream, columns=[(Team, 'logo_image')], replaces=team.logo_image)
                         team.logo_image = logo_url; db.session.commit(); flash(f'チーム「{team.name}」のロゴを更新しました。')
                     except Exception as e: flash(f"ロゴの更新に失敗しました: {e}")
                 elif file.filename != '': flash('許可されていないファイル形式です。')
@@ -959,32 +1864,15 @@ def roster():
                 t = Team.query.get(request.form.get('team_id'))
                 if t:
                     try:
-                        # 1. プレイオフのマッチアップからこのチームを外す (削除せず空にする)
-                        # これをやらないと外部キーエラーになります
-                        PlayoffMatch.query.filter(PlayoffMatch.team1_id == t.id).update({PlayoffMatch.team1_id: None, PlayoffMatch.team1_wins: 0}, synchronize_session=False)
-                        PlayoffMatch.query.filter(PlayoffMatch.team2_id == t.id).update({PlayoffMatch.team2_id: None, PlayoffMatch.team2_wins: 0}, synchronize_session=False)
-
-                        # 2. このチームに関連する選手データを全て削除
-                        players = Player.query.filter_by(team_id=t.id).all()
-                        for p in players:
-                            # 選手に紐づくスタッツ、MVP候補、投票データなどを先に消す
-                            PlayerStat.query.filter_by(player_id=p.id).delete()
-                            MVPCandidate.query.filter_by(player_id=p.id).delete()
-                            Vote.query.filter_by(player_id=p.id).delete()
-                            VoteResult.query.filter_by(player_id=p.id).delete()
-                            db.session.delete(p)
-
-                        # 3. このチームが関わる試合データを削除
-                        games = Game.query.filter(or_(Game.home_team_id == t.id, Game.away_team_id == t.id)).all()
-                        for g in games:
-                            # 試合に紐づくスタッツを消してから試合を消す
-                            PlayerStat.query.filter_by(game_id=g.id).delete()
-                            db.session.delete(g)
-
-                        # 4. 最後にチーム自体を削除
-                        db.session.delete(t)
+                        # プレイオフ表からは外し、選手・試合・スタッツ・投票などは一括で削除
+                        team_name = t.name
+                        delete_team_cascade(t.id)
+
+                        # 対戦相手の順位表と、削除された試合に出ていた選手の合計を作り直す
+                        refresh_all_standings()
+                        for (sid,) in db.session.query(Season.id).all(): refresh_player_totals(sid)
                         db.session.commit()
-                        flash(f'チーム「{t.name}」を関連データごと完全削除しました。')
+                        flash(f'チーム「{team_name}」を関連データごと完全削除しました。')
                     
                     except Exception as e:
                         db.session.rollback()
@@ -999,8 +1887,10 @@ def roster():
             if request.form.get('confirm_delete') == 'delete':
                 p = Player.query.get(request.form.get('player_id'))
                 if p:
-                    PlayerStat.query.filter_by(player_id=p.id).delete()
-                    db.session.delete(p); db.session.commit(); flash(f'選手「{p.name}」を完全削除しました。')
+                    player_name = p.name; team_id = p.team_id
+                    delete_players_cascade(Player.id == p.id)
+                    for (sid,) in db.session.query(Season.id).all(): refresh_team_standings(sid, [team_id])
+                    db.session.commit(); flash(f'選手「{player_name}」を完全削除しました。')
             else: flash('確認コードが一致しません。削除をキャンセルしました。')
 
         # ★追加: チームのリーグ個別変更
@@ -1048,10 +1938,10 @@ def add_schedule():
         season = get_current_season()
         new_game = Game(
             season_id=season.id,
-            game_date=request.form['game_date'], start_time=request.form['start_time'], 
             home_team_id=request.form['home_team_id'], away_team_id=request.form['away_team_id'], 
             game_password=request.form.get('game_password')
         )
+        new_game.set_schedule(request.form['game_date'], request.form['start_time'])
         db.session.add(new_game); db.session.commit()
         flash("新しい試合日程が追加されました。"); return redirect(url_for('schedule'))
     teams = Team.query.filter_by(is_active=True).all()
@@ -1118,11 +2008,13 @@ def create_inter_league_schedule(teams_a, teams_b):
     
     rounds = []
     # シンプルにリストをずらして対戦させる
-    # Aのチーム数分（またはBのチーム数分）のラウンドができる
+    # 多い方のリーグのチーム数分のラウンドができる
     
-    # チーム数が違う場合の調整（少ない方に合わせるか、Noneで埋めるかだが、今回は16チーム想定でそのまま）
-    list_a = list(teams_a)
-    deque_b = deque(teams_b)
+    # チーム数が違う場合は少ない方を None (休み) で埋める。
+    # (埋めないと少ない側のチームが同じラウンドで2試合組まれてしまう)
+    size = max(len(teams_a), len(teams_b))
+    list_a = list(teams_a) + [None] * (size - len(teams_a))
+    deque_b = deque(list(teams_b) + [None] * (size - len(teams_b)))
     
     max_rounds = len(deque_b) # 相手チームの数だけラウンドがある
     
@@ -1130,6 +2022,7 @@ def create_inter_league_schedule(teams_a, teams_b):
         current_round = []
         for i, team_a in enumerate(list_a):
             team_b = deque_b[i % len(deque_b)]
+            if team_a is None or team_b is None: continue
             
             # H/Aのバランス調整: 
             # ラウンド偶数回はAホーム、奇数回はBホームにする等で分散
@@ -1144,6 +2037,262 @@ def create_inter_league_schedule(teams_a, teams_b):
     return rounds
 
 
+# --- 日程の最適化 (焼きなまし法) ---
+# 各項目の重み。値が大きいほどその偏りを強く避ける
+SCHEDULE_PENALTY_WEIGHTS = {
+    'streak': 3.0,        # 同じホーム/アウェイが3試合以上続いた分 (続いた長さ - 2)
+    'home_balance': 5.0,  # チームごとのホーム数とアウェイ数の差が1を超えた分
+    'slot_fairness': 1.0, # チームごとの時間枠別試合数のばらつき (平均からの差の2乗和)
+    'back_to_back': 2.0,  # 連続した日 (前日も試合) に試合がある回数
+}
+
+class ScheduleOptimizer:
+    """
+    ラウンド単位の日程 (1ラウンド = 1つの開催日・時間枠) を焼きなまし法で改善する。
+    操作は「同じフェーズ内のラウンドの入れ替え」と「対戦のホーム/アウェイ反転
+    (前半戦・後半戦で対になる対戦は両方まとめて反転)」だけなので、対戦カードと試合数は変わらない。
+    """
+    def __init__(self, rounds, phases, slots, weights=None, seed=None):
+        self.teams = {}
+        for round_matches in rounds:
+            for home, away in round_matches: self.teams[home.id] = home; self.teams[away.id] = away
+        # 対戦は [ホームID, アウェイID] の可変リストで持つ (反転はリストの中身を入れ替える)
+        self.fixtures = [[[home.id, away.id] for home, away in round_matches] for round_matches in rounds]
+        self.phases = list(phases)
+        self.slots = slots
+        self.weights = dict(SCHEDULE_PENALTY_WEIGHTS, **(weights or {}))
+        self.rng = random.Random(seed)
+        self.n_times = max((time_index for _, time_index in slots), default=0) + 1
+        self.order = list(range(len(rounds)))  # 位置 → ラウンド番号
+        self.position = list(range(len(rounds)))  # ラウンド番号 → 位置
+        self.phase_positions = defaultdict(list)
+        for pos, phase in enumerate(self.phases): self.phase_positions[phase].append(pos)
+
+        # チームごとの出場試合 (ラウンド番号, 試合番号)
+        self.team_games = defaultdict(list)
+        for r, round_fixtures in enumerate(self.fixtures):
+            for g, (home_id, away_id) in enumerate(round_fixtures):
+                self.team_games[home_id].append((r, g)); self.team_games[away_id].append((r, g))
+
+        # 前半戦の対戦と、後半戦でホーム/アウェイが逆になった同じカードを対にする
+        second_leg = {}
+        for r, round_fixtures in enumerate(self.fixtures):
+            if self.phases[r] != 'leg2': continue
+            for g, (home_id, away_id) in enumerate(round_fixtures): second_leg.setdefault((home_id, away_id), (r, g))
+        self.flippable = []
+        for r, round_fixtures in enumerate(self.fixtures):
+            if self.phases[r] == 'leg2': continue
+            for g, (home_id, away_id) in enumerate(round_fixtures):
+                mirror = second_leg.get((away_id, home_id)) if self.phases[r] == 'leg1' else None
+                self.flippable.append(((r, g), mirror))
+
+        self.team_penalty = {team_id: self._team_penalty(team_id) for team_id in self.team_games}
+        self.total = sum(self._weighted(p) for p in self.team_penalty.values())
+        self.initial_report = self.report()
+
+    def _team_penalty(self, team_id):
+        """ 1チーム分の (streak, home_balance, slot_fairness, back_to_back) """
+        games = sorted((self.position[r], self.fixtures[r][g][0] == team_id) for r, g in self.team_games[team_id])
+        streak = 0; run = 0; previous = None; homes = 0
+        slot_counts = [0] * self.n_times
+        dates = set()
+        for pos, is_home in games:
+            run = run + 1 if is_home == previous else 1
+            if run >= 3: streak += 1
+            previous = is_home; homes += is_home
+            slot_date, time_index = self.slots[pos]
+            slot_counts[time_index] += 1; dates.add(slot_date)
+        home_balance = max(0, abs(homes * 2 - len(games)) - 1)
+        mean = len(games) / self.n_times
+        slot_fairness = sum((c - mean) ** 2 for c in slot_counts)
+        back_to_back = sum(1 for d in dates if d - timedelta(days=1) in dates)
+        return (streak, home_balance, slot_fairness, back_to_back)
+
+    def _weighted(self, penalty):
+        w = self.weights
+        return (w['streak'] * penalty[0] + w['home_balance'] * penalty[1]
+                + w['slot_fairness'] * penalty[2] + w['back_to_back'] * penalty[3])
+
+    def _rescore(self, team_ids):
+        """ 指定チームのペナルティを再計算し、(総合点の変化, 元に戻すための旧値) を返す """
+        old = {t: self.team_penalty[t] for t in team_ids}
+        delta = 0.0
+        for t in team_ids:
+            self.team_penalty[t] = self._team_penalty(t)
+            delta += self._weighted(self.team_penalty[t]) - self._weighted(old[t])
+        return delta, old
+
+    def _swap_rounds(self, pos_a, pos_b):
+        r_a, r_b = self.order[pos_a], self.order[pos_b]
+        self.order[pos_a], self.order[pos_b] = r_b, r_a
+        self.position[r_a], self.position[r_b] = pos_b, pos_a
+        return r_a, r_b
+
+    def _flip(self, fixture, mirror):
+        for r, g in filter(None, (fixture, mirror)):
+            pair = self.fixtures[r][g]; pair[0], pair[1] = pair[1], pair[0]
+
+    def _random_move(self):
+        """ ランダムな操作を1つ適用し、(影響を受けるチーム, 元に戻す関数) を返す """
+        if self.flippable and (self.rng.random() < 0.5 or len(self.order) < 2):
+            fixture, mirror = self.rng.choice(self.flippable)
+            self._flip(fixture, mirror)
+            r, g = fixture
+            return set(self.fixtures[r][g]), lambda: self._flip(fixture, mirror)
+        candidates = [p for p in self.phase_positions.values() if len(p) >= 2]
+        if not candidates: return set(), lambda: None
+        pos_a, pos_b = self.rng.sample(self.rng.choice(candidates), 2)
+        r_a, r_b = self._swap_rounds(pos_a, pos_b)
+        affected = {t for r in (r_a, r_b) for pair in self.fixtures[r] for t in pair}
+        return affected, lambda: self._swap_rounds(pos_a, pos_b)
+
+    def optimize(self, time_budget=2.0, max_iterations=None, start_temperature=5.0, end_temperature=0.05):
+        """ time_budget 秒 (または max_iterations 回) まで焼きなましを行い、最良の状態を残す """
+        started = time.perf_counter()
+        best_total = self.total
+        best_state = (list(self.order), [[list(pair) for pair in rf] for rf in self.fixtures])
+        iterations = 0
+        while True:
+            elapsed = time.perf_counter() - started
+            if elapsed >= time_budget or (max_iterations is not None and iterations >= max_iterations): break
+            progress = elapsed / time_budget if time_budget else 1.0
+            temperature = start_temperature * (end_temperature / start_temperature) ** progress
+            iterations += 1
+
+            affected, undo = self._random_move()
+            delta, old = self._rescore(affected)
+            if delta <= 0 or self.rng.random() < math.exp(-delta / temperature):
+                self.total += delta
+                if self.total < best_total - 1e-9:
+                    best_total = self.total
+                    best_state = (list(self.order), [[list(pair) for pair in rf] for rf in self.fixtures])
+            else:
+                undo(); self.team_penalty.update(old)
+
+        # 最良の状態に戻す
+        self.order = best_state[0]; self.fixtures = best_state[1]
+        for pos, r in enumerate(self.order): self.position[r] = pos
+        self.team_penalty = {team_id: self._team_penalty(team_id) for team_id in self.team_games}
+        self.total = sum(self._weighted(p) for p in self.team_penalty.values())
+        self.iterations = iterations; self.elapsed = time.perf_counter() - started
+        return self.rounds()
+
+    def rounds(self):
+        """ 現在の順番・ホーム/アウェイでの (ホーム, アウェイ) のラウンドリスト """
+        return [[(self.teams[home_id], self.teams[away_id]) for home_id, away_id in self.fixtures[r]] for r in self.order]
+
+    def report(self):
+        """ 項目別のペナルティ合計と重み付き総合点 """
+        totals = [sum(p[i] for p in self.team_penalty.values()) for i in range(4)]
+        result = {name: round(value, 2) for name, value in zip(('streak', 'home_balance', 'slot_fairness', 'back_to_back'), totals)}
+        result['score'] = round(self.total, 2)
+        return result
+
+# 自動作成画面から指定できる最適化時間の上限 (gunicorn のタイムアウトより十分短くする)
+SCHEDULE_OPTIMIZE_MAX_SECONDS = 30.0
+
+# 自動作成した1試合分の行 (round_no はラウンド番号、それ以外は Game のカラム)
+ScheduledGame = namedtuple('ScheduledGame', ['round_no', 'season_id', 'game_date', 'start_time', 'game_datetime',
+                                             'home_team_id', 'away_team_id', 'game_password'])
+
+def build_season_rounds(league_a, league_b):
+    """
+    前半戦 (A・B同時進行) → 交流戦 → 後半戦 の順にラウンドを並べる。各ラウンドは (ホーム, アウェイ) のリスト。
+    (ラウンドのリスト, 各ラウンドのフェーズ名のリスト) を返す。
+    """
+    final_rounds = []; phases = []
+
+    # (1) 各リーグの日程を「前半・後半」に分けて取得
+    sched_a_leg1, sched_a_leg2 = create_intra_league_schedule(league_a)
+    sched_b_leg1, sched_b_leg2 = create_intra_league_schedule(league_b)
+    
+    # (2) 交流戦の日程を取得
+    inter_schedule = create_inter_league_schedule(league_a, league_b)
+
+    # --- 【フェーズ1】 同リーグ前半戦 (AとBをマージ) ---
+    max_leg1 = max(len(sched_a_leg1), len(sched_b_leg1))
+    for i in range(max_leg1):
+        combined_round = []
+        if i < len(sched_a_leg1): combined_round.extend(sched_a_leg1[i])
+        if i < len(sched_b_leg1): combined_round.extend(sched_b_leg1[i])
+        if combined_round: final_rounds.append(combined_round); phases.append('leg1')
+
+    # --- 【フェーズ2】 交流戦 (そのまま追加) ---
+    final_rounds.extend(inter_schedule); phases.extend(['inter'] * len(inter_schedule))
+
+    # --- 【フェーズ3】 同リーグ後半戦 (AとBをマージ) ---
+    max_leg2 = max(len(sched_a_leg2), len(sched_b_leg2))
+    for i in range(max_leg2):
+        combined_round = []
+        if i < len(sched_a_leg2): combined_round.extend(sched_a_leg2[i])
+        if i < len(sched_b_leg2): combined_round.extend(sched_b_leg2[i])
+        if combined_round: final_rounds.append(combined_round); phases.append('leg2')
+    return final_rounds, phases
+
+def schedule_slot_calendar(n_rounds, start_date, selected_weekdays, n_times):
+    """ ラウンド順に割り当てる (開催日, 時間枠の番号) のリスト。開催曜日の各日に時間枠の数だけラウンドを入れる """
+    slots = []
+    current_date = start_date
+    time_index = 0
+    for _ in range(n_rounds):
+        # 日付を進める
+        while current_date.weekday() not in selected_weekdays:
+            current_date += timedelta(days=1)
+        slots.append((current_date, time_index))
+        
+        # 時間枠を進める
+        time_index += 1
+        if time_index >= n_times:
+            time_index = 0
+            current_date += timedelta(days=1)
+    return slots
+
+def assign_schedule_slots(final_rounds, season_id, start_date, selected_weekdays, time_list):
+    """ ラウンドごとに開催日・時間枠を割り当て、ScheduledGame のリストを返す (DBには触らない) """
+    alphabet = 'abcdefghijklmnopqrstuvwxyz'
+    password_index = 0
+    rows = []
+    slots = schedule_slot_calendar(len(final_rounds), start_date, selected_weekdays, len(time_list))
+    
+    for round_no, (round_matches, (slot_date, time_index)) in enumerate(zip(final_rounds, slots), start=1):
+        assigned_date = slot_date.strftime('%Y-%m-%d')
+        assigned_time = time_list[time_index]
+        assigned_datetime = parse_game_datetime(assigned_date, assigned_time)
+
+        # ラウンド内の試合順をシャッフル
+        round_matches = list(round_matches)
+        random.shuffle(round_matches)
+
+        for (home_team, away_team) in round_matches:
+            game_password = (alphabet[password_index % len(alphabet)] * 6)
+            password_index += 1
+            rows.append(ScheduledGame(round_no, season_id, assigned_date, assigned_time, assigned_datetime,
+                                      home_team.id, away_team.id, game_password))
+    return rows
+
+def insert_scheduled_games(rows):
+    """ ScheduledGame のリストを1回の executemany でまとめて INSERT する (コミットは呼び出し側) """
+    if not rows: return 0
+    values = [{k: v for k, v in row._asdict().items() if k != 'round_no'} for row in rows]
+    db.session.execute(Game.__table__.insert(), values)
+    return len(values)
+
+def scheduled_games_preview(rows, teams):
+    """ 試運転 (dry run) 用に日程案をJSONにできる形へ変換する """
+    team_names = {t.id: t.name for t in teams}
+    return {
+        'total_games': len(rows),
+        'total_rounds': rows[-1].round_no if rows else 0,
+        'first_date': rows[0].game_date if rows else None,
+        'last_date': rows[-1].game_date if rows else None,
+        'games': [{
+            'round': row.round_no, 'date': row.game_date, 'start_time': row.start_time,
+            'home_team': {'id': row.home_team_id, 'name': team_names.get(row.home_team_id)},
+            'away_team': {'id': row.away_team_id, 'name': team_names.get(row.away_team_id)},
+            'game_password': row.game_password,
+        } for row in rows]
+    }
+
 @app.route('/auto_schedule', methods=['GET', 'POST'])
 @login_required
 @admin_required
@@ -1152,8 +2301,11 @@ def auto_schedule():
         start_date_str = request.form.get('start_date')
         weekdays = request.form.getlist('weekdays')
         times_str = request.form.get('times')
+        dry_run = bool(request.form.get('dry_run') or request.args.get('dry_run'))
+        time_list = [t.strip() for t in (times_str or '').split(',') if t.strip()]
         
-        if not all([start_date_str, weekdays, times_str]):
+        if not all([start_date_str, weekdays, time_list]):
+            if dry_run: return jsonify({'error': 'すべての項目を入力してください。'}), 400
             flash('すべての項目を入力してください。')
             return redirect(url_for('auto_schedule'))
             
@@ -1162,115 +2314,178 @@ def auto_schedule():
         league_b = [t for t in all_teams if t.league == 'Bリーグ']
         
         if not league_a or not league_b:
+            if dry_run: return jsonify({'error': 'チームがAリーグ・Bリーグに正しく設定されていません。'}), 400
             flash('チームがAリーグ・Bリーグに正しく設定されていません。')
             return redirect(url_for('auto_schedule'))
 
         # --- 1. スケジュール生成フェーズ ---
-        final_rounds = []
+        final_rounds, phases = build_season_rounds(league_a, league_b)
 
-        # (1) 各リーグの日程を「前半・後半」に分けて取得
-        sched_a_leg1, sched_a_leg2 = create_intra_league_schedule(league_a)
-        sched_b_leg1, sched_b_leg2 = create_intra_league_schedule(league_b)
-        
-        # (2) 交流戦の日程を取得
-        inter_schedule = create_inter_league_schedule(league_a, league_b)
-
-        # --- 【フェーズ1】 同リーグ前半戦 (AとBをマージ) ---
-        max_leg1 = max(len(sched_a_leg1), len(sched_b_leg1))
-        for i in range(max_leg1):
-            combined_round = []
-            if i < len(sched_a_leg1): combined_round.extend(sched_a_leg1[i])
-            if i < len(sched_b_leg1): combined_round.extend(sched_b_leg1[i])
-            if combined_round: final_rounds.append(combined_round)
-
-        # --- 【フェーズ2】 交流戦 (そのまま追加) ---
-        final_rounds.extend(inter_schedule)
-
-        # --- 【フェーズ3】 同リーグ後半戦 (AとBをマージ) ---
-        max_leg2 = max(len(sched_a_leg2), len(sched_b_leg2))
-        for i in range(max_leg2):
-            combined_round = []
-            if i < len(sched_a_leg2): combined_round.extend(sched_a_leg2[i])
-            if i < len(sched_b_leg2): combined_round.extend(sched_b_leg2[i])
-            if combined_round: final_rounds.append(combined_round)
-
-        # --- 2. 日時割り当てフェーズ ---
         start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
         selected_weekdays = [int(d) for d in weekdays]
-        time_list = [t.strip() for t in times_str.split(',') if t.strip()]
-        
-        current_date = start_date
-        time_index = 0
-        games_created_count = 0
-        
-        alphabet = 'abcdefghijklmnopqrstuvwxyz'
-        password_index = 0
+
+        # --- 1.5 最適化フェーズ (任意): 連続ホーム/アウェイ・時間枠の偏り・連日試合を減らす ---
+        optimization = None
+        if request.form.get('optimize'):
+            time_budget = min(max(request.form.get('optimize_seconds', 3.0, type=float), 0.1), SCHEDULE_OPTIMIZE_MAX_SECONDS)
+            slots = schedule_slot_calendar(len(final_rounds), start_date, selected_weekdays, len(time_list))
+            optimizer = ScheduleOptimizer(final_rounds, phases, slots)
+            final_rounds = optimizer.optimize(time_budget=time_budget)
+            optimization = {'before': optimizer.initial_report, 'after': optimizer.report(),
+                            'iterations': optimizer.iterations, 'seconds': round(optimizer.elapsed, 2)}
+
+        # --- 2. 日時割り当てフェーズ (行データを作るだけ) ---
         season = get_current_season()
+        rows = assign_schedule_slots(final_rounds, season.id, start_date, selected_weekdays, time_list)
+
+        # 試運転: DBには書かず日程案をそのまま返す
+        if dry_run: return jsonify(dict(scheduled_games_preview(rows, all_teams), optimization=optimization))
         
-        for round_matches in final_rounds:
-            # 日付を進める
-            while current_date.weekday() not in selected_weekdays:
-                current_date += timedelta(days=1)
-            
-            assigned_date = current_date.strftime('%Y-%m-%d')
-            assigned_time = time_list[time_index]
-            
-            # 時間枠を進める
-            time_index += 1
-            if time_index >= len(time_list):
-                time_index = 0
-                current_date += timedelta(days=1)
-
-            # ラウンド内の試合順をシャッフル
-            random.shuffle(round_matches)
-
-            for (home_team, away_team) in round_matches:
-                game_password = (alphabet[password_index % len(alphabet)] * 6)
-                password_index += 1
-                
-                new_game = Game(
-                    season_id=season.id,
-                    game_date=assigned_date,
-                    start_time=assigned_time,
-                    home_team_id=home_team.id,
-                    away_team_id=away_team.id,
-                    game_password=game_password
-                )
-                db.session.add(new_game)
-                games_created_count += 1
-        
+        # --- 3. 一括書き込み ---
+        games_created_count = insert_scheduled_games(rows)
         db.session.commit()
         flash(f'全{games_created_count}試合を作成しました。（順序: 前半戦→交流戦→後半戦）')
+        if optimization:
+            flash(f"日程を最適化しました (ペナルティ {optimization['before']['score']} → {optimization['after']['score']}、{optimization['seconds']}秒)")
         return redirect(url_for('schedule'))
         
     return render_template('auto_schedule.html')
+
+# 日程表1ページあたりの目安の試合数 (日の途中では区切らないため多少前後する)
+SCHEDULE_PAGE_SIZE = 40
+
 @app.route('/schedule')
 def schedule():
     view_sid = get_view_season_id()
     selected_team_id = request.args.get('team_id', type=int)
     selected_date = request.args.get('selected_date')
+    start_date = request.args.get('start')
     
-    # 日付順（昇順）
-    query = Game.query.filter(Game.season_id == view_sid).order_by(Game.game_date.asc(), Game.start_time.asc())
-    
-    if selected_team_id:
-        query = query.filter((Game.home_team_id == selected_team_id) | (Game.away_team_id == selected_team_id))
+    # 日付順（昇順）。チームは同じクエリで読み込む
+    query = schedule_games_query(view_sid, selected_team_id)
+    prev_start = None; next_start = None
     if selected_date:
-        query = query.filter(Game.game_date == selected_date)
+        query = query.filter(game_period_clause(selected_date, selected_date))
+    else:
+        # 日付単位のキーセットページング (start 以降の試合を約 SCHEDULE_PAGE_SIZE 件、日の途中では切らない)
+        start_dt = parse_game_datetime(start_date) if start_date else None
+        if start_dt:
+            query = query.filter(Game.game_datetime >= start_dt)
+            earlier = schedule_games_query(view_sid, selected_team_id).filter(Game.game_datetime < start_dt)\
+                .with_entities(Game.game_datetime).order_by(Game.game_datetime.desc(), Game.id.desc()).limit(SCHEDULE_PAGE_SIZE).all()
+            if earlier: prev_start = earlier[-1].game_datetime.strftime('%Y-%m-%d')
+        page_end = schedule_page_end(query)
+        if page_end:
+            query = query.filter(Game.game_datetime < page_end)
+            next_start = page_end.strftime('%Y-%m-%d')
         
-    games = query.all()
+    games = query.options(db.joinedload(Game.home_team), db.joinedload(Game.away_team))\
+        .order_by(Game.game_datetime.asc(), Game.id.asc()).all()
+    # 日付を解釈できなかった試合は最後のページの末尾に別枠で出す (日程変更で直せるように)
+    undated_games = [] if selected_date or next_start else undated_schedule_games(view_sid, selected_team_id)
     all_teams = Team.query.order_by(Team.name).all()
     
     # ★追加: 今日の日付を取得して渡す
     today_str = datetime.now().strftime('%Y-%m-%d')
     
     return render_template('schedule.html', 
-                           games=games, 
+                           games=games, undated_games=undated_games,
                            all_teams=all_teams, 
                            selected_team_id=selected_team_id, 
                            selected_date=selected_date,
+                           prev_start=prev_start, next_start=next_start,
                            today_str=today_str) # ←これを追加
 
+def schedule_games_query(season_id, team_id=None, dated=True):
+    """ 日程表・日程APIの共通条件 (シーズン、チーム指定時はそのチームの試合)。
+        dated=False は game_datetime が未設定 (日付を解釈できなかった) の試合、None は両方 """
+    query = Game.query.filter(Game.season_id == season_id)
+    if dated is not None:
+        query = query.filter(Game.game_datetime.isnot(None) if dated else Game.game_datetime.is_(None))
+    if team_id:
+        query = query.filter(or_(Game.home_team_id == team_id, Game.away_team_id == team_id))
+    return query
+
+def undated_schedule_games(season_id, team_id=None):
+    """ 日時が未設定の試合 (元の日付文字列順) """
+    return schedule_games_query(season_id, team_id, dated=False)\
+        .options(db.joinedload(Game.home_team), db.joinedload(Game.away_team))\
+        .order_by(Game.game_date.asc(), Game.id.asc()).all()
+
+def schedule_page_end(query, page_size=None):
+    """ ページの終端 (この日時より前を表示)。残りが1ページに収まる場合は None """
+    page_size = page_size or SCHEDULE_PAGE_SIZE
+    datetimes = [row.game_datetime for row in query.with_entities(Game.game_datetime)
+                 .order_by(Game.game_datetime.asc(), Game.id.asc()).limit(page_size + 1)]
+    if len(datetimes) <= page_size: return None
+    last_day = datetimes[page_size - 1].replace(hour=0, minute=0, second=0, microsecond=0)
+    return last_day + timedelta(days=1)
+
+@app.route('/api/schedule')
+def api_schedule():
+    """ カレンダー用の日程JSON (?from=2025-01-01&to=2025-01-31&team_id=3&season_id=1)。ETag で再取得を省略できる """
+    season_id = request.args.get('season_id', type=int) or get_view_season_id()
+    team_id = request.args.get('team_id', type=int)
+    date_from = request.args.get('from'); date_to = request.args.get('to')
+    start = parse_game_datetime(date_from) if date_from else None
+    end = parse_game_datetime(date_to) if date_to else None
+    if (date_from and start is None) or (date_to and end is None):
+        return jsonify({'error': '日付は YYYY-MM-DD 形式で指定してください。'}), 400
+
+    # 期間指定が無ければ日時未設定の試合も末尾に含める (datetime は null)
+    query = schedule_games_query(season_id, team_id, dated=True if start or end else None)
+    if start: query = query.filter(Game.game_datetime >= start)
+    if end: query = query.filter(Game.game_datetime < end + timedelta(days=1))
+    rows = query.join(Team_Home, Game.home_team_id == Team_Home.id).join(Team_Away, Game.away_team_id == Team_Away.id)\
+        .with_entities(Game.id, Game.game_date, Game.start_time, Game.game_datetime, Game.is_finished, Game.is_forfeit,
+                       Game.winner_id, Game.home_score, Game.away_score,
+                       Game.home_team_id, Team_Home.name.label('home_team_name'), Team_Home.logo_image.label('home_team_logo'),
+                       Game.away_team_id, Team_Away.name.label('away_team_name'), Team_Away.logo_image.label('away_team_logo'))\
+        .order_by(Game.game_datetime.is_(None), Game.game_datetime.asc(), Game.game_date.asc(), Game.id.asc()).all()
+
+    games = [{
+        'id': r.id, 'date': r.game_date, 'start_time': r.start_time,
+        'datetime': r.game_datetime.isoformat() if r.game_datetime else None,
+        'home_team': {'id': r.home_team_id, 'name': r.home_team_name, 'logo_image': r.home_team_logo},
+        'away_team': {'id': r.away_team_id, 'name': r.away_team_name, 'logo_image': r.away_team_logo},
+        'is_finished': bool(r.is_finished), 'is_forfeit': bool(r.is_forfeit), 'winner_id': r.winner_id,
+        'home_score': r.home_score if r.is_finished else None, 'away_score': r.away_score if r.is_finished else None,
+        'result_url': url_for('game_result', game_id=r.id) if r.is_finished else None,
+    } for r in rows]
+    response = jsonify({'season_id': season_id, 'team_id': team_id, 'from': date_from, 'to': date_to, 'games': games})
+    # 内容のハッシュを ETag にし、変化が無ければ 304 を返す (毎回再検証させる)
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+# 詳細ページの順位付け対象 (reverse=True は少ないほど良い指標)
+TEAM_RANKING_FIELDS = {
+    'points': {'label': '勝ち点'}, 'avg_pf': {'label': '平均得点'}, 'avg_pa': {'label': '平均失点', 'reverse': True}, 'diff': {'label': '得失点差'},
+    'fg_pct': {'label': 'FG%'}, 'three_p_pct': {'label': '3P%'}, 'ft_pct': {'label': 'FT%'},
+    'avg_reb': {'label': 'リバウンド'}, 'avg_ast': {'label': 'アシスト'}, 'avg_stl': {'label': 'スティール'},
+    'avg_blk': {'label': 'ブロック'}, 'avg_turnover': {'label': 'ターンオーバー', 'reverse': True}, 'avg_foul': {'label': 'ファウル', 'reverse': True},
+}
+PLAYER_RANKING_FIELDS = {
+    'avg_pts': {'label': '得点'}, 'fg_pct': {'label': 'FG%'}, 'three_p_pct': {'label': '3P%'},
+    'ft_pct': {'label': 'FT%'}, 'avg_reb': {'label': 'リバウンド'}, 'avg_ast': {'label': 'アシスト'},
+    'avg_stl': {'label': 'スティール'}, 'avg_blk': {'label': 'ブロック'},
+    'avg_turnover': {'label': 'TO', 'reverse': True}, 'avg_foul': {'label': 'FOUL', 'reverse': True},
+}
+
+def get_player_ranking_matrix(season_id):
+    """ シーズン全選手の順位行列 (試合結果が更新されるまでキャッシュ) """
+    def build():
+        all_players_stats = db.session.query(
+            PlayerSeasonTotals.player_id.label('player_id'),
+            _totals_avg('pts', 'avg_pts'), _totals_avg('reb', 'avg_reb'),
+            _totals_avg('ast', 'avg_ast'), _totals_avg('stl', 'avg_stl'),
+            _totals_avg('blk', 'avg_blk'), _totals_avg('turnover', 'avg_turnover'),
+            _totals_avg('foul', 'avg_foul'),
+            _totals_pct('fgm', 'fga', 'fg_pct'), _totals_pct('three_pm', 'three_pa', 'three_p_pct'), _totals_pct('ftm', 'fta', 'ft_pct')
+        ).filter(PlayerSeasonTotals.season_id == season_id).all()
+        return StatRankingMatrix.from_records(all_players_stats, 'player_id', PLAYER_RANKING_FIELDS, limit=10)
+    return season_cached('player_ranking', season_id, None, build)
+
 @app.route('/team/<int:team_id>')
 def team_detail(team_id):
     view_sid = get_view_season_id()
@@ -1295,54 +2510,34 @@ def team_detail(team_id):
         'wins': 0, 'losses': 0, 'points': 0, 'diff': 0, 'avg_pf': 0, 'avg_pa': 0, 'avg_reb': 0, 'avg_ast': 0, 'avg_stl': 0, 'avg_blk': 0, 'avg_turnover': 0, 'avg_foul': 0, 'fg_pct': 0, 'three_p_pct': 0, 'ft_pct': 0
     })
     
-    # レーダーチャート用データ
-    team_fields = {
-        'points': {'label': '勝ち点'}, 'avg_pf': {'label': '平均得点'}, 'avg_pa': {'label': '平均失点', 'reverse': True}, 'diff': {'label': '得失点差'},
-        'fg_pct': {'label': 'FG%'}, 'three_p_pct': {'label': '3P%'}, 'ft_pct': {'label': 'FT%'},
-        'avg_reb': {'label': 'リバウンド'}, 'avg_ast': {'label': 'アシスト'}, 'avg_stl': {'label': 'スティール'},
-        'avg_blk': {'label': 'ブロック'}, 'avg_turnover': {'label': 'ターンオーバー', 'reverse': True}, 'avg_foul': {'label': 'ファウル', 'reverse': True},
-    }
     # ここで渡す all_team_stats_data は既に「平均diff」に変換済みなので、レーダーチャートも正しくなります
-    analyzed_stats = analyze_stats(team_id, all_team_stats_data, 'none', team_fields, limit=5)
+    # 順位行列はシーズンごとにキャッシュ (チーム構成が変わった場合もキーが変わる)
+    team_ids_key = tuple(item['team'].id for item in all_team_stats_data)
+    ranking = season_cached('team_ranking', view_sid, team_ids_key,
+                            lambda: StatRankingMatrix.from_records(all_team_stats_data, 'none', TEAM_RANKING_FIELDS, limit=5))
+    analyzed_stats = ranking.lookup(team_id)
     
-    # --- 選手リスト取得ロジック (変更なし) ---
-    stats_sub = db.session.query(
-        PlayerStat.player_id,
-        func.count(PlayerStat.game_id).label('games_played'),
-        func.sum(PlayerStat.pts).label('total_pts'),
-        func.sum(PlayerStat.reb).label('total_reb'),
-        func.sum(PlayerStat.ast).label('total_ast'),
-        func.sum(PlayerStat.stl).label('total_stl'),
-        func.sum(PlayerStat.blk).label('total_blk'),
-        func.sum(PlayerStat.fgm).label('total_fgm'),
-        func.sum(PlayerStat.fga).label('total_fga'),
-        func.sum(PlayerStat.three_pm).label('total_3pm'),
-        func.sum(PlayerStat.three_pa).label('total_3pa'),
-        func.sum(PlayerStat.ftm).label('total_ftm'),
-        func.sum(PlayerStat.fta).label('total_fta')
-    ).join(Game, PlayerStat.game_id == Game.id)\
-     .filter(Game.season_id == view_sid)\
-     .group_by(PlayerStat.player_id).subquery()
-
+    # --- 選手リスト取得ロジック (シーズン合計テーブルから) ---
+    T = PlayerSeasonTotals
     player_stats_list = db.session.query(
         Player,
-        func.coalesce(stats_sub.c.games_played, 0).label('games_played'),
-        case((func.coalesce(stats_sub.c.games_played, 0) > 0, stats_sub.c.total_pts / stats_sub.c.games_played), else_=0).label('avg_pts'),
-        case((func.coalesce(stats_sub.c.games_played, 0) > 0, stats_sub.c.total_reb / stats_sub.c.games_played), else_=0).label('avg_reb'),
-        case((func.coalesce(stats_sub.c.games_played, 0) > 0, stats_sub.c.total_ast / stats_sub.c.games_played), else_=0).label('avg_ast'),
-        case((func.coalesce(stats_sub.c.games_played, 0) > 0, stats_sub.c.total_stl / stats_sub.c.games_played), else_=0).label('avg_stl'),
-        case((func.coalesce(stats_sub.c.games_played, 0) > 0, stats_sub.c.total_blk / stats_sub.c.games_played), else_=0).label('avg_blk'),
-        case((func.coalesce(stats_sub.c.total_fga, 0) > 0, stats_sub.c.total_fgm * 100.0 / stats_sub.c.total_fga), else_=0).label('fg_pct'),
-        case((func.coalesce(stats_sub.c.total_3pa, 0) > 0, stats_sub.c.total_3pm * 100.0 / stats_sub.c.total_3pa), else_=0).label('three_p_pct'),
-        case((func.coalesce(stats_sub.c.total_fta, 0) > 0, stats_sub.c.total_ftm * 100.0 / stats_sub.c.total_fta), else_=0).label('ft_pct')
-    ).outerjoin(stats_sub, Player.id == stats_sub.c.player_id)\
+        func.coalesce(T.games_played, 0).label('games_played'),
+        case((func.coalesce(T.games_played, 0) > 0, T.pts / T.games_played), else_=0).label('avg_pts'),
+        case((func.coalesce(T.games_played, 0) > 0, T.reb / T.games_played), else_=0).label('avg_reb'),
+        case((func.coalesce(T.games_played, 0) > 0, T.ast / T.games_played), else_=0).label('avg_ast'),
+        case((func.coalesce(T.games_played, 0) > 0, T.stl / T.games_played), else_=0).label('avg_stl'),
+        case((func.coalesce(T.games_played, 0) > 0, T.blk / T.games_played), else_=0).label('avg_blk'),
+        case((func.coalesce(T.fga, 0) > 0, T.fgm * 100.0 / T.fga), else_=0).label('fg_pct'),
+        case((func.coalesce(T.three_pa, 0) > 0, T.three_pm * 100.0 / T.three_pa), else_=0).label('three_p_pct'),
+        case((func.coalesce(T.fta, 0) > 0, T.ftm * 100.0 / T.fta), else_=0).label('ft_pct')
+    ).outerjoin(T, and_(T.player_id == Player.id, T.season_id == view_sid))\
      .filter(Player.team_id == team_id)\
      .order_by(Player.name.asc()).all()
      
     team_games = Game.query.filter(
         Game.season_id == view_sid,
         or_(Game.home_team_id == team_id, Game.away_team_id == team_id)
-    ).order_by(Game.game_date.asc(), Game.start_time.asc()).all()
+    ).order_by(Game.game_datetime.asc(), Game.id.asc()).all()
     
     players = Player.query.filter_by(team_id=team_id).all()
     
@@ -1353,31 +2548,12 @@ def player_detail(player_id):
     player = Player.query.get_or_404(player_id)
     
     # 1. 選手の通算スタッツ取得
-    all_players_stats = db.session.query(
-        Player.id.label('player_id'), func.count(PlayerStat.game_id).label('games_played'),
-        func.avg(PlayerStat.pts).label('avg_pts'), func.avg(PlayerStat.reb).label('avg_reb'),
-        func.avg(PlayerStat.ast).label('avg_ast'), func.avg(PlayerStat.stl).label('avg_stl'),
-        func.avg(PlayerStat.blk).label('avg_blk'), func.avg(PlayerStat.turnover).label('avg_turnover'),
-        func.avg(PlayerStat.foul).label('avg_foul'),
-        case((func.sum(PlayerStat.fga) > 0, (func.sum(PlayerStat.fgm) * 100.0 / func.sum(PlayerStat.fga))), else_=0).label('fg_pct'),
-        case((func.sum(PlayerStat.three_pa) > 0, (func.sum(PlayerStat.three_pm) * 100.0 / func.sum(PlayerStat.three_pa))), else_=0).label('three_p_pct'),
-        case((func.sum(PlayerStat.fta) > 0, (func.sum(PlayerStat.ftm) * 100.0 / func.sum(PlayerStat.fta))), else_=0).label('ft_pct')
-    ).join(PlayerStat, Player.id == PlayerStat.player_id)\
-      .join(Game, PlayerStat.game_id == Game.id)\
-      .filter(Game.season_id == view_sid)\
-      .group_by(Player.id).all()
-      
-    # スタッツ分析
-    player_fields = {
-        'avg_pts': {'label': '得点'}, 'fg_pct': {'label': 'FG%'}, 'three_p_pct': {'label': '3P%'},
-        'ft_pct': {'label': 'FT%'}, 'avg_reb': {'label': 'リバウンド'}, 'avg_ast': {'label': 'アシスト'},
-        'avg_stl': {'label': 'スティール'}, 'avg_blk': {'label': 'ブロック'},
-        'avg_turnover': {'label': 'TO', 'reverse': True}, 'avg_foul': {'label': 'FOUL', 'reverse': True},
-    }
-    analyzed_stats = analyze_stats(player_id, all_players_stats, 'player_id', player_fields, limit=10)
+    # スタッツ分析 (シーズン全選手の順位行列はキャッシュから)
+    ranking = get_player_ranking_matrix(view_sid)
+    analyzed_stats = ranking.lookup(player_id)
     
     # 対象選手の平均スタッツを取得
-    target_avg_stats = next((p for p in all_players_stats if p.player_id == player_id), None)
+    target_avg_stats = ranking.row_values(player_id)
 
     # --- ★修正箇所: データがない場合のダミーデータ作成 ---
     if target_avg_stats is None:
@@ -1398,7 +2574,7 @@ def player_detail(player_id):
       .join(Team_Home, Game.home_team_id == Team_Home.id)\
       .join(Team_Away, Game.away_team_id == Team_Away.id)\
       .filter(PlayerStat.player_id == player_id, Game.season_id == view_sid)\
-      .order_by(Game.game_date.desc()).all()
+      .order_by(Game.game_datetime.desc(), Game.id.desc()).all()
 
     # 3. 受賞歴 (Awards) の取得
     awards_query = db.session.query(VoteResult, VoteConfig, Season)\
@@ -1422,16 +2598,86 @@ def player_detail(player_id):
         if is_winner:
             player_awards.append({'title': award_name, 'type': award_type, 'date': conf.created_at.strftime('%Y-%m-%d')})
 
-    leaders = get_stats_leaders(view_sid) 
-    stat_titles = {'平均得点': '得点王', '平均リバウンド': 'リバウンド王', '平均アシスト': 'アシスト王', '平均スティール': 'スティール王', '平均ブロック': 'ブロック王'}
+    title_categories = [key for key, config in LEADERBOARD_CATEGORIES.items() if config.get('title')]
+    leaders = get_leaderboards(view_sid, title_categories, limit=1)
     for key, leader_list in leaders.items():
-        if leader_list and leader_list[0][2] == player_id:
-            award_title = stat_titles.get(key, key)
+        if leader_list and leader_list[0].player_id == player_id:
+            award_title = LEADERBOARD_CATEGORIES[key]['title']
             is_duplicate = any(a['title'].endswith(award_title) for a in player_awards)
             if not is_duplicate: player_awards.insert(0, {'title': f"Current {award_title}", 'type': 'stat_leader', 'date': 'Running'})
       
     return render_template('player_detail.html', player=player, stats=analyzed_stats, avg_stats=target_avg_stats, game_stats=game_stats, awards=player_awards)
 
+# --- ボックススコアの差分保存 ---
+BOX_SCORE_COLUMNS = PLAYER_STAT_COLUMNS + ('sort_order',)
+
+def parse_box_score_form(form, roster):
+    """ 試合結果フォームから {player_id: (team_id, {カラム: 値})} を作る。PTS欄がある選手 = 出場した選手 """
+    def get_val(key):
+        val = form.get(key)
+        if not val or val.strip() == '': return 0
+        try: return int(val)
+        except ValueError: return 0
+
+    submitted = {}
+    for player in roster:
+        if f'player_{player.id}_pts' not in form: continue
+        values = {col: get_val(f'player_{player.id}_{col}') for col in PLAYER_STAT_COLUMNS}
+        # ★並び順を保存
+        values['sort_order'] = get_val(f'player_{player.id}_index')
+        submitted[player.id] = (player.team_id, values)
+    return submitted
+
+def apply_box_score(game, submitted):
+    """
+    既存の PlayerStat と submitted の差分だけを反映する (変更行のみ UPDATE、新規はまとめて INSERT、消えた行はまとめて DELETE)。
+    試合のスコア・終了状態を更新し、影響のある順位表・シーズン合計だけ再計算する。コミットは呼び出し側で行う。
+    戻り値は {'inserted', 'updated', 'deleted'} の件数。
+    """
+    existing = {}; duplicate_ids = []
+    for row in db.session.query(PlayerStat.id, PlayerStat.player_id, *[getattr(PlayerStat, c) for c in BOX_SCORE_COLUMNS])\
+                         .filter(PlayerStat.game_id == game.id).order_by(PlayerStat.id).all():
+        if row.player_id in existing: duplicate_ids.append(row.id)
+        else: existing[row.player_id] = row
+
+    inserts = []; updates = []; changed_player_ids = set()
+    for player_id, (team_id, values) in submitted.items():
+        row = existing.pop(player_id, None)
+        if row is None:
+            inserts.append(dict(values, game_id=game.id, player_id=player_id)); changed_player_ids.add(player_id)
+            continue
+        changed = {col: v for col, v in values.items() if (getattr(row, col) or 0) != v}
+        if not changed: continue
+        updates.append(dict(changed, id=row.id))
+        if any(col in PLAYER_STAT_COLUMNS for col in changed): changed_player_ids.add(player_id)
+    delete_ids = [row.id for row in existing.values()] + duplicate_ids
+    changed_player_ids.update(existing.keys())
+
+    # 更新するカラムの組み合わせごとにまとめて executemany する
+    by_columns = defaultdict(list)
+    for values in updates: by_columns[tuple(sorted(values))].append(values)
+    for rows in by_columns.values(): db.session.execute(db.update(PlayerStat), rows)
+    if inserts: db.session.execute(db.insert(PlayerStat), inserts)
+    if delete_ids: PlayerStat.query.filter(PlayerStat.id.in_(delete_ids)).delete(synchronize_session=False)
+
+    home_total_score = sum(v['pts'] for team_id, v in submitted.values() if team_id == game.home_team_id)
+    away_total_score = sum(v['pts'] for team_id, v in submitted.values() if team_id != game.home_team_id)
+    previous_state = (game.home_score, game.away_score, game.is_finished, game.winner_id, game.loser_id)
+    game.home_score = home_total_score
+    game.away_score = away_total_score
+    game.is_finished = True
+    game.winner_id = None
+    game.loser_id = None
+    game.result_input_time = datetime.now()
+
+    # 勝敗・得点とチームスタッツ合計の両方が変わらなければ順位表はそのまま
+    state_changed = previous_state != (game.home_score, game.away_score, game.is_finished, game.winner_id, game.loser_id)
+    if state_changed or changed_player_ids:
+        refresh_team_standings(game.season_id, [game.home_team_id, game.away_team_id])
+    if changed_player_ids:
+        refresh_player_totals(game.season_id, changed_player_ids)
+    return {'inserted': len(inserts), 'updated': len(updates), 'deleted': len(delete_ids)}
+
 @app.route('/game/<int:game_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_game(game_id):
@@ -1445,55 +2691,9 @@ def edit_game(game_id):
         if result_image_url:
             game.result_image_url = result_image_url
 
-        # 既存のスタッツをリセット
-        PlayerStat.query.filter_by(game_id=game_id).delete()
-        
-        home_total_score = 0
-        away_total_score = 0
-        
-        def get_val(key):
-            val = request.form.get(key)
-            if not val or val.strip() == '': return 0
-            try: return int(val)
-            except ValueError: return 0
-
-        # ホーム・アウェイ両方の選手をループして保存
-        for team in [game.home_team, game.away_team]:
-            for player in team.players:
-                # PTSの入力欄が存在する = 試合に出場した選手
-                if f'player_{player.id}_pts' in request.form:
-                    stat = PlayerStat(game_id=game.id, player_id=player.id)
-                    db.session.add(stat)
-                    
-                    stat.pts = get_val(f'player_{player.id}_pts')
-                    stat.ast = get_val(f'player_{player.id}_ast')
-                    stat.reb = get_val(f'player_{player.id}_reb')
-                    stat.stl = get_val(f'player_{player.id}_stl')
-                    stat.blk = get_val(f'player_{player.id}_blk')
-                    stat.foul = get_val(f'player_{player.id}_foul')
-                    stat.turnover = get_val(f'player_{player.id}_turnover')
-                    stat.fgm = get_val(f'player_{player.id}_fgm')
-                    stat.fga = get_val(f'player_{player.id}_fga')
-                    stat.three_pm = get_val(f'player_{player.id}_three_pm')
-                    stat.three_pa = get_val(f'player_{player.id}_three_pa')
-                    stat.ftm = get_val(f'player_{player.id}_ftm')
-                    stat.fta = get_val(f'player_{player.id}_fta')
-                    
-                    # ★並び順を保存
-                    stat.sort_order = get_val(f'player_{player.id}_index')
-                    
-                    # チーム合計得点に加算
-                    if team.id == game.home_team_id:
-                        home_total_score += stat.pts
-                    else:
-                        away_total_score += stat.pts
-        
-        game.home_score = home_total_score
-        game.away_score = away_total_score
-        game.is_finished = True
-        game.winner_id = None
-        game.loser_id = None
-        game.result_input_time = datetime.now()
+        # 両チームの選手を1回で読み込み、フォームの内容と既存スタッツの差分だけを書き込む
+        roster = Player.query.filter(Player.team_id.in_([game.home_team_id, game.away_team_id])).all()
+        apply_box_score(game, parse_box_score_form(request.form, roster))
         
         db.session.commit()
         flash('試合結果が更新されました。')
@@ -1579,7 +2779,9 @@ def swap_teams(game_id):
         original_home_score = game.home_score; game.home_score = game.away_score; game.away_score = original_home_score
         original_youtube_home = game.youtube_url_home; original_youtube_away = game.youtube_url_away 
         game.youtube_url_home = original_youtube_away; game.youtube_url_away = original_youtube_home
-    try: db.session.commit(); flash(f'試合 (ID: {game.id}) のホームとアウェイを入れ替えました。')
+    try:
+        refresh_team_standings(game.season_id, [game.home_team_id, game.away_team_id])
+        db.session.commit(); flash(f'試合 (ID: {game.id}) のホームとアウェイを入れ替えました。')
     except Exception as e: db.session.rollback(); flash(f'入れ替え中にエラーが発生しました: {e}')
     return redirect(url_for('schedule'))
 
@@ -1592,7 +2794,9 @@ def update_game_date(game_id):
     if new_date and new_time: 
         try:
             datetime.strptime(new_date, '%Y-%m-%d'); datetime.strptime(new_time, '%H:%M') 
-            game.game_date = new_date; game.start_time = new_time 
+            game.set_schedule(new_date, new_time)
+            # 日付順が変わると直近5試合・連勝/敗も変わるため再計算
+            refresh_team_standings(game.season_id, [game.home_team_id, game.away_team_id])
             db.session.commit(); flash(f'試合 (ID: {game.id}) の日程を {new_date} {new_time} に変更しました。')
         except ValueError: flash('無効な日付または時間の形式です。')
     else: flash('新しい日付と時間の両方を指定してください。')
@@ -1604,8 +2808,11 @@ def update_game_date(game_id):
 def delete_game(game_id):
     if request.form.get('password') == 'delete':
         game_to_delete = Game.query.get_or_404(game_id)
-        PlayerStat.query.filter_by(game_id=game_id).delete()
-        db.session.delete(game_to_delete); db.session.commit()
+        affected_player_ids = season_stat_player_ids(game_ids=[game_id])
+        delete_games_cascade(Game.id == game_id)
+        refresh_team_standings(game_to_delete.season_id, [game_to_delete.home_team_id, game_to_delete.away_team_id])
+        refresh_player_totals(game_to_delete.season_id, affected_player_ids)
+        db.session.commit()
         flash('試合日程を削除しました。')
     else: flash('パスワードが違います。削除はキャンセルされました。')
     return redirect(url_for('schedule'))
@@ -1617,10 +2824,9 @@ def delete_all_schedules():
     if request.form.get('password') == 'delete':
         try:
             season = get_current_season()
-            games = Game.query.filter_by(season_id=season.id).all()
-            for g in games:
-                PlayerStat.query.filter_by(game_id=g.id).delete()
-                db.session.delete(g)
+            delete_games_cascade(Game.season_id == season.id)
+            refresh_team_standings(season.id)
+            refresh_player_totals(season.id)
             db.session.commit()
             flash('現在のシーズン全日程と試合結果が削除されました。')
         except Exception as e: db.session.rollback(); flash(f'削除中にエラーが発生しました: {e}')
@@ -1652,7 +2858,10 @@ def forfeit_game(game_id):
     game.away_score = 0
     
     # 既存のスタッツを消去
+    affected_player_ids = season_stat_player_ids(game_ids=[game_id])
     PlayerStat.query.filter_by(game_id=game_id).delete()
+    refresh_team_standings(game.season_id, [game.home_team_id, game.away_team_id])
+    refresh_player_totals(game.season_id, affected_player_ids)
     
     db.session.commit()
     flash('不戦勝として試合結果を記録しました。')
@@ -1695,6 +2904,7 @@ def admin_vote_dashboard():
                 Vote.query.filter_by(vote_config_id=config.id).delete()
                 db.session.delete(config)
                 db.session.commit()
+                vote_tallies.discard(config.id)
                 flash('削除しました。')
         elif action == 'hide_from_home':
             config = VoteConfig.query.get(request.form.get('config_id'))
@@ -1733,7 +2943,184 @@ def admin_vote_review(config_id):
     grouped_results = defaultdict(list)
     for r in results: grouped_results[r.category].append(r)
     ties = {cat: (len([i.score for i in items]) != len(set([i.score for i in items]))) for cat, items in grouped_results.items()}
-    return render_template('admin_vote_review.html', config=config, grouped_results=grouped_results, ties=ties)
+    # 受付中の途中経過 (プロセス内の集計。ポジションの振り分け前の、カテゴリごとの合計点)
+    live = defaultdict(list)
+    for (category, player_id), score in vote_tallies.get(config.id).items(): live[category].append((score, player_id))
+    live = {category: sorted(entries, key=lambda e: (-e[0], e[1]))[:VOTE_LIVE_TALLY_ROWS] for category, entries in sorted(live.items())}
+    live_ids = {pid for entries in live.values() for _, pid in entries}
+    players = {p.id: p for p in Player.query.options(db.joinedload(Player.team)).filter(Player.id.in_(live_ids))} if live_ids else {}
+    live_tallies = {category: [(players.get(pid), score) for score, pid in entries] for category, entries in live.items()}
+    return render_template('admin_vote_review.html', config=config, grouped_results=grouped_results, ties=ties, live_tallies=live_tallies)
+
+# --- 投票の候補者 ---
+# awards の出場率による絞り込みと weekly / monthly の上位5人は、試合結果が変わるまで同じなので
+# 選手IDだけを集計キャッシュ (season_cached) に置き、GET と POST で使い回す。
+# 選手の追加・復帰・移籍やチームの活動状態の変更は試合結果の版では分からないので、ロスターの指紋もキーに含める。
+# 選手は毎回そのIDで読み直す (名前などの変更はすぐ反映される)
+AWARDS_MIN_GAMES_RATIO = 0.7  # 最も試合数の多いチームの試合数に対する、必要な出場試合数の割合
+VOTE_TOP_PLAYERS = 5
+
+def roster_fingerprint():
+    """ 活動中の選手 (ID・所属) とチーム (ID・リーグ) の構成のハッシュ。どちらも数百行なので毎回読む """
+    players = db.session.execute(db.select(Player.id, Player.team_id).where(Player.is_active == True).order_by(Player.id)).all()
+    teams = db.session.execute(db.select(Team.id, Team.league).where(Team.is_active == True).order_by(Team.id)).all()
+    return hashlib.sha1(repr((players, teams)).encode()).hexdigest()
+
+def awards_eligible_player_ids(season_id):
+    """ 出場試合数が (活動中のチームの最多試合数 × 0.7) 以上の選手ID (チーム順・名前順)。試合が無ければ全員 """
+    def build():
+        finished = and_(Game.is_finished == True, Game.season_id == season_id)
+        appearances = db.union_all(db.select(Game.home_team_id.label('team_id')).where(finished),
+                                   db.select(Game.away_team_id.label('team_id')).where(finished)).subquery()
+        team_games = db.select(func.count().label('games')).select_from(appearances)\
+            .join(Team, Team.id == appearances.c.team_id).where(Team.is_active == True)\
+            .group_by(appearances.c.team_id).subquery()
+        max_games = db.select(func.coalesce(func.max(team_games.c.games), 0)).scalar_subquery()
+        player_games = db.select(PlayerStat.player_id, func.count().label('games'))\
+            .join(Game, Game.id == PlayerStat.game_id).where(Game.season_id == season_id)\
+            .group_by(PlayerStat.player_id).subquery()
+        return tuple(db.session.scalars(
+            db.select(Player.id).join(Team, Team.id == Player.team_id)
+            .outerjoin(player_games, player_games.c.player_id == Player.id)
+            .where(Player.is_active == True,
+                   or_(max_games == 0, func.coalesce(player_games.c.games, 0) >= max_games * AWARDS_MIN_GAMES_RATIO))
+            .order_by(Team.id, Player.name)).all())
+    return season_cached('vote_awards_eligible', season_id, roster_fingerprint(), build)
+
+def top_impact_player_ids(season_id, start_date, end_date):
+    """ 期間内の impact score (1試合平均) 上位の選手ID をリーグごとに返す {リーグ名: (ID, ...)} """
+    def build():
+        impact = (func.sum(PlayerStat.pts) + func.sum(PlayerStat.reb) + func.sum(PlayerStat.ast) + func.sum(PlayerStat.stl) + func.sum(PlayerStat.blk) - func.sum(PlayerStat.turnover) - (func.sum(PlayerStat.fga) - func.sum(PlayerStat.fgm)) - (func.sum(PlayerStat.fta) - func.sum(PlayerStat.ftm))) / func.count(PlayerStat.game_id)
+        scored = db.select(Player.id.label('player_id'), Team.league.label('league'), impact.label('impact'))\
+            .join(PlayerStat, Player.id == PlayerStat.player_id).join(Team, Player.team_id == Team.id)\
+            .join(Game, PlayerStat.game_id == Game.id)\
+            .where(game_period_clause(start_date, end_date), Game.season_id == season_id, Player.is_active == True)\
+            .group_by(Player.id, Team.league).subquery()
+        ranked = db.select(scored.c.league, scored.c.player_id, func.row_number().over(
+            partition_by=scored.c.league, order_by=(scored.c.impact.desc(), scored.c.player_id)).label('row_num')).subquery()
+        top = defaultdict(list)
+        for league, player_id in db.session.execute(
+                db.select(ranked.c.league, ranked.c.player_id).where(ranked.c.row_num <= VOTE_TOP_PLAYERS)
+                .order_by(ranked.c.league, ranked.c.row_num)).all():
+            top[league].append(player_id)
+        return {league: tuple(ids) for league, ids in top.items()}
+    return season_cached('vote_top_impact', season_id, (start_date, end_date, roster_fingerprint()), build)
+
+def load_players_by_ids(ids):
+    """ IDの順に活動中の選手を読み込む (チームも一緒に) """
+    if not ids: return []
+    players = {p.id: p for p in Player.query.options(db.joinedload(Player.team)).filter(Player.id.in_(ids), Player.is_active == True)}
+    return [players[pid] for pid in ids if pid in players]
+
+def league_players(league):
+    return Player.query.join(Team).filter(Team.league == league, Player.is_active == True).order_by(Player.name).all()
+
+def vote_candidates(config):
+    """ 投票フォームの候補 (Aリーグ, Bリーグ, 全体) """
+    if config.vote_type in ('weekly', 'monthly'):
+        if not config.start_date or not config.end_date: return league_players('Aリーグ'), league_players('Bリーグ'), []
+        top = top_impact_player_ids(config.season_id, config.start_date, config.end_date)
+        # 期間内に試合が無いリーグは全選手から選ぶ
+        players_a = load_players_by_ids(top.get('Aリーグ')) or league_players('Aリーグ')
+        players_b = load_players_by_ids(top.get('Bリーグ')) or league_players('Bリーグ')
+        return players_a, players_b, []
+    if config.vote_type == 'awards':
+        return [], [], load_players_by_ids(awards_eligible_player_ids(config.season_id))
+    if config.vote_type == 'all_star':
+        return [], [], Player.query.join(Team).filter(Player.is_active == True).order_by(Team.id, Player.name).all()
+    return [], [], []
+
+# --- 投票の受付 ---
+# 1人分の投票 (投票用紙) は {(カテゴリ, 点数): 選手ID}。送信のたびに差分だけを書き換える (同じ内容の再送は何も変えない)。
+# 同じ投票イベントへの書き込みは、最初に投票イベントごとの受付番号 (SystemSetting) を進めることで順番に行う
+# (PostgreSQL は行ロック、SQLite は書き込みロック)。受付番号はプロセス内の集計が最新かどうかの判定にも使う
+def _ballot_version_key(config_id): return f'ballot_version_{config_id}'
+
+def _upsert(model):
+    """ 実行中のDBの INSERT ... ON CONFLICT が使える insert() """
+    if db.engine.dialect.name == 'postgresql': return postgresql_insert(model)
+    return sqlite_insert(model)
+
+def get_ballot_version(config_id):
+    # セッションに読み込み済みの値ではなく、毎回DBの値を見る
+    value = db.session.scalar(db.select(SystemSetting.value).where(SystemSetting.key == _ballot_version_key(config_id)))
+    return int(value) if value else 0
+
+class VoteTallies:
+    """ 投票イベントごとの {(カテゴリ, 選手ID): 合計点} をプロセス内に持ち、このプロセスが受け付けた投票の差分で更新する。
+        受付番号がずれていたら (他のワーカーが受け付けた) DBから集計し直す """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tallies = {}  # config_id -> (受付番号, Counter)
+
+    def get(self, config_id):
+        version = get_ballot_version(config_id)
+        with self._lock:
+            entry = self._tallies.get(config_id)
+            if entry and entry[0] == version: return dict(entry[1])
+        counts = Counter({(category, player_id): score for category, player_id, score in db.session.execute(
+            db.select(Vote.category, Vote.player_id, func.sum(Vote.rank_value))
+            .where(Vote.vote_config_id == config_id).group_by(Vote.category, Vote.player_id)).all()})
+        # 数えている間に受付があれば、どの番号の集計か分からないので手元には残さない
+        if get_ballot_version(config_id) != version: return dict(counts)
+        with self._lock:
+            current = self._tallies.get(config_id)
+            if not current or current[0] <= version: self._tallies[config_id] = (version, counts)
+        return dict(counts)
+
+    def apply(self, config_id, version, delta):
+        """ 受付番号 version の投票の差分を足す。手元の集計が1つ前の番号でなければ捨てて、次に読むときに集計し直す """
+        with self._lock:
+            entry = self._tallies.get(config_id)
+            if not entry or entry[0] != version - 1:
+                self._tallies.pop(config_id, None)
+                return
+            counts = entry[1]
+            counts.update(delta)
+            for key in [k for k, v in counts.items() if v == 0]: del counts[key]
+            self._tallies[config_id] = (version, counts)
+
+    def discard(self, config_id):
+        with self._lock: self._tallies.pop(config_id, None)
+
+vote_tallies = VoteTallies()
+VOTE_LIVE_TALLY_ROWS = 5  # 途中経過でカテゴリごとに表示する人数
+# SQLite は書き込みが1本だけで、ロック待ちは間隔を広げながらの再試行になり待ち時間が大きくばらつく。プロセス内では順番待ちにする
+_sqlite_ballot_lock = threading.Lock()
+
+def submit_ballot(config_id, user_id, ballot):
+    """ user_id の投票を ballot ({(カテゴリ, 点数): 選手ID}) に置き換えてコミットし、プロセス内の集計に差分を反映する """
+    if db.engine.dialect.name == 'sqlite':
+        with _sqlite_ballot_lock: return _submit_ballot(config_id, user_id, ballot)
+    return _submit_ballot(config_id, user_id, ballot)
+
+def _submit_ballot(config_id, user_id, ballot):
+    key = _ballot_version_key(config_id)
+    setting = SystemSetting.__table__
+    version = int(db.session.execute(
+        _upsert(SystemSetting).values(key=key, value='1')
+        .on_conflict_do_update(index_elements=['key'], set_={'value': db.cast(db.cast(setting.c.value, db.Integer) + 1, db.String)})
+        .returning(setting.c.value)).scalar_one())
+    mine = and_(Vote.vote_config_id == config_id, Vote.user_id == user_id)
+    previous = {(category, rank_value): player_id for category, rank_value, player_id in
+                db.session.execute(db.select(Vote.category, Vote.rank_value, Vote.player_id).where(mine)).all()}
+    stale = [slot for slot in previous if slot not in ballot]
+    if stale:
+        db.session.execute(db.delete(Vote).where(mine, db.tuple_(Vote.category, Vote.rank_value).in_(stale)))
+    changed = [{'vote_config_id': config_id, 'user_id': user_id, 'category': category, 'rank_value': rank_value, 'player_id': player_id}
+               for (category, rank_value), player_id in ballot.items() if previous.get((category, rank_value)) != player_id]
+    if changed:
+        stmt = _upsert(Vote)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['vote_config_id', 'user_id', 'category', 'rank_value'],
+            set_={'player_id': stmt.excluded.player_id}), changed)
+    db.session.commit()
+
+    delta = Counter()
+    for (category, rank_value), player_id in previous.items(): delta[(category, player_id)] -= rank_value
+    for (category, rank_value), player_id in ballot.items(): delta[(category, player_id)] += rank_value
+    vote_tallies.apply(config_id, version, {k: v for k, v in delta.items() if v})
+    return version
 
 @app.route('/vote/<int:config_id>', methods=['GET', 'POST'])
 @login_required
@@ -1742,42 +3129,23 @@ def vote_page(config_id):
     if not config.is_open and not current_user.is_admin: flash('この投票は現在受け付けていません。'); return redirect(url_for('index'))
     existing_vote = Vote.query.filter_by(vote_config_id=config_id, user_id=current_user.id).first()
     if existing_vote and request.method == 'GET': flash('すでにこのイベントには投票済みです。'); return redirect(url_for('index'))
-    eligible_players_a = []; eligible_players_b = []; eligible_players = [] 
-    if config.vote_type in ['weekly', 'monthly']:
-        start_date = config.start_date; end_date = config.end_date
-        if not start_date or not end_date:
-            eligible_players_a = Player.query.join(Team).filter(Team.league == 'Aリーグ', Player.is_active==True).order_by(Player.name).all()
-            eligible_players_b = Player.query.join(Team).filter(Team.league == 'Bリーグ', Player.is_active==True).order_by(Player.name).all()
-        else:
-            impact_score = (func.sum(PlayerStat.pts) + func.sum(PlayerStat.reb) + func.sum(PlayerStat.ast) + func.sum(PlayerStat.stl) + func.sum(PlayerStat.blk) - func.sum(PlayerStat.turnover) - (func.sum(PlayerStat.fga) - func.sum(PlayerStat.fgm)) - (func.sum(PlayerStat.fta) - func.sum(PlayerStat.ftm))) / func.count(PlayerStat.game_id)
-            def get_top5_by_league(league_name):
-                return db.session.query(Player).join(PlayerStat, Player.id == PlayerStat.player_id).join(Team, Player.team_id == Team.id).join(Game, PlayerStat.game_id == Game.id).filter(Game.game_date >= start_date, Game.game_date <= end_date, Team.league == league_name, Game.season_id == config.season_id, Player.is_active == True).group_by(Player.id).having(func.count(PlayerStat.game_id) >= 1).order_by(db.desc(impact_score)).limit(5).all()
-            eligible_players_a = get_top5_by_league("Aリーグ"); eligible_players_b = get_top5_by_league("Bリーグ")
-            if not eligible_players_a: eligible_players_a = Player.query.join(Team).filter(Team.league == 'Aリーグ', Player.is_active==True).all()
-            if not eligible_players_b: eligible_players_b = Player.query.join(Team).filter(Team.league == 'Bリーグ', Player.is_active==True).all()
-    elif config.vote_type == 'awards':
-        teams = Team.query.filter_by(is_active=True).all(); max_games_played = 0
-        for t in teams:
-            count = Game.query.filter((Game.is_finished == True) & ((Game.home_team_id == t.id) | (Game.away_team_id == t.id)) & (Game.season_id == config.season_id)).count()
-            if count > max_games_played: max_games_played = count
-        limit_games = max_games_played * 0.7
-        all_players = Player.query.join(Team).filter(Player.is_active==True).order_by(Team.id, Player.name).all()
-        for p in all_players:
-            p_games = PlayerStat.query.join(Game).filter(PlayerStat.player_id==p.id, Game.season_id==config.season_id).count()
-            if max_games_played == 0 or p_games >= limit_games: eligible_players.append(p)
-    elif config.vote_type == 'all_star':
-        eligible_players = Player.query.join(Team).filter(Player.is_active==True).order_by(Team.id, Player.name).all()
+    eligible_players_a, eligible_players_b, eligible_players = vote_candidates(config)
     if request.method == 'POST':
         try:
-            Vote.query.filter_by(vote_config_id=config_id, user_id=current_user.id).delete()
-            if config.vote_type == 'weekly':
-                pid_a = request.form.get('weekly_mvp_a'); pid_b = request.form.get('weekly_mvp_b')
-                if pid_a: db.session.add(Vote(vote_config_id=config.id, user_id=current_user.id, player_id=pid_a, category="Weekly MVP A League"))
-                if pid_b: db.session.add(Vote(vote_config_id=config.id, user_id=current_user.id, player_id=pid_b, category="Weekly MVP B League"))
-            elif config.vote_type == 'monthly':
-                pid_a = request.form.get('monthly_mvp_a'); pid_b = request.form.get('monthly_mvp_b')
-                if pid_a: db.session.add(Vote(vote_config_id=config.id, user_id=current_user.id, player_id=pid_a, category="Monthly MVP A League"))
-                if pid_b: db.session.add(Vote(vote_config_id=config.id, user_id=current_user.id, player_id=pid_b, category="Monthly MVP B League"))
+            # 候補一覧 (GET と同じキャッシュ) に無い選手への投票は受け付けない
+            allowed_a = {str(p.id) for p in eligible_players_a}; allowed_b = {str(p.id) for p in eligible_players_b}
+            allowed = {str(p.id) for p in eligible_players}
+            if config.vote_type in ('weekly', 'monthly'):
+                submitted = [(request.form.get(f'{config.vote_type}_mvp_a'), allowed_a), (request.form.get(f'{config.vote_type}_mvp_b'), allowed_b)]
+            else:
+                submitted = [(value, allowed) for value in request.form.values()]
+            if any(value and value not in ids for value, ids in submitted):
+                db.session.rollback(); flash('対象外の選手が含まれています。'); return redirect(url_for('vote_page', config_id=config_id))
+            ballot = {}
+            if config.vote_type in ('weekly', 'monthly'):
+                for side in ('a', 'b'):
+                    pid = request.form.get(f'{config.vote_type}_mvp_{side}')
+                    if pid: ballot[(f"{config.vote_type.capitalize()} MVP {side.upper()} League", 1)] = int(pid)
             else:
                 for key, value in request.form.items():
                     if value and value != "":
@@ -1790,38 +3158,70 @@ def vote_page(config_id):
                             elif 'mvp' in key: category = 'MVP'
                             elif 'dpoy' in key: category = 'DPOY'
                         elif config.vote_type == 'all_star': category = key.replace('_', ' ')
-                        db.session.add(Vote(vote_config_id=config.id, user_id=current_user.id, player_id=player_id, category=category, rank_value=rank_point))
-            db.session.commit(); flash('投票を受け付けました！'); return redirect(url_for('index'))
+                        ballot[(category, rank_point)] = player_id
+            submit_ballot(config.id, current_user.id, ballot)
+            flash('投票を受け付けました！'); return redirect(url_for('index'))
         except Exception as e: db.session.rollback(); flash(f'エラーが発生しました: {e}'); return redirect(url_for('vote_page', config_id=config_id))
     return render_template('vote_form.html', config=config, eligible_players_a=eligible_players_a, eligible_players_b=eligible_players_b, players=eligible_players)
 
 # --- 4. 集計コアロジック ---
+# 順位ごとに保存する awards の All JPL の区分 (4位以下は保存しない)
+ALL_JPL_TEAMS = {1: ' 1st Team', 2: ' 2nd Team', 3: ' 3rd Team'}
+
 def calculate_vote_results(config_id):
-    config = VoteConfig.query.get(config_id)
-    VoteResult.query.filter_by(vote_config_id=config_id).delete()
-    votes = Vote.query.filter_by(vote_config_id=config_id).all()
-    tally = defaultdict(lambda: defaultdict(int)); player_pos_votes = defaultdict(lambda: defaultdict(int))
-    for v in votes:
-        if config.vote_type in ['all_star', 'awards'] and ('All JPL' in v.category or 'League' in v.category):
-            pos = v.category.split(' ')[-1]; player_pos_votes[v.player_id][pos] += v.rank_value; player_pos_votes[v.player_id]['total'] += v.rank_value
-        else: tally[v.category][v.player_id] += v.rank_value
-    if config.vote_type in ['all_star', 'awards']:
-        for pid, pos_data in player_pos_votes.items():
-            if 'total' in pos_data:
-                total = pos_data.pop('total'); best_pos = max(pos_data, key=pos_data.get)
-                if config.vote_type == 'all_star': p = Player.query.get(pid); cat = f"{p.team.league} {best_pos}"
-                else: cat = f"All JPL {best_pos}"
-                tally[cat][pid] = total
-    for category, scores in tally.items():
-        ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
-        for i, (pid, score) in enumerate(ranked):
-            rank = i + 1; save_cat = category
-            if config.vote_type == 'awards' and 'All JPL' in category:
-                if rank == 1: save_cat += " 1st Team"
-                elif rank == 2: save_cat += " 2nd Team"
-                elif rank == 3: save_cat += " 3rd Team"
-                else: continue 
-            db.session.add(VoteResult(vote_config_id=config_id, category=save_cat, player_id=pid, score=score, rank=rank))
+    """ 投票を集計して VoteResult を作り直す。集計・順位付けはSQLで行い、結果は INSERT ... SELECT の1文で書き込む。
+        all_star / awards のポジション別の票は選手ごとに合計し、最も票の多いポジション (同数なら先に投票されたもの) の枠に入れる """
+    config = db.session.get(VoteConfig, config_id)
+    VoteResult.query.filter_by(vote_config_id=config.id).delete(synchronize_session=False)
+    in_config = Vote.vote_config_id == config.id
+    positional = or_(Vote.category.contains('All JPL'), Vote.category.contains('League')) \
+        if config.vote_type in ('all_star', 'awards') else db.false()
+
+    # 同じ選手の中では投票の早い順 (最初の票のID) を同点の並びに使う (以前の Python での集計と同じ順位になる)
+    plain = db.select(Vote.category.label('category'), Vote.player_id.label('player_id'),
+                      func.sum(Vote.rank_value).label('score'), func.min(Vote.id).label('first_vote'))\
+        .where(in_config, ~positional).group_by(Vote.category, Vote.player_id)
+    sources = [plain]
+
+    if config.vote_type in ('all_star', 'awards'):
+        # カテゴリ名の最後の語がポジション。カテゴリの種類は少ないので対応表を CASE にする
+        categories = db.session.scalars(db.select(Vote.category).where(in_config, positional).distinct()).all()
+        if categories:
+            position = case({c: c.split(' ')[-1] for c in categories}, value=Vote.category)
+            by_position = db.select(Vote.player_id.label('player_id'), position.label('position'),
+                                    func.sum(Vote.rank_value).label('score'), func.min(Vote.id).label('first_vote'))\
+                .where(in_config, positional).group_by(Vote.player_id, position).subquery()
+            best = db.select(
+                by_position.c.player_id, by_position.c.position,
+                func.sum(by_position.c.score).over(partition_by=by_position.c.player_id).label('total'),
+                func.min(by_position.c.first_vote).over(partition_by=by_position.c.player_id).label('first_vote'),
+                func.row_number().over(partition_by=by_position.c.player_id,
+                                       order_by=(by_position.c.score.desc(), by_position.c.first_vote)).label('pick')
+            ).subquery()
+            if config.vote_type == 'all_star':
+                label = func.coalesce(Team.league, 'None') + ' ' + best.c.position
+            else:
+                label = db.literal('All JPL ') + best.c.position
+            sources.append(
+                db.select(label.label('category'), best.c.player_id, best.c.total.label('score'), best.c.first_vote)
+                .select_from(best).join(Player, Player.id == best.c.player_id).join(Team, Team.id == Player.team_id)
+                .where(best.c.pick == 1))
+
+    tallied = db.union_all(*sources).subquery() if len(sources) > 1 else plain.subquery()
+    ranked = db.select(
+        tallied.c.category, tallied.c.player_id, tallied.c.score,
+        func.row_number().over(partition_by=tallied.c.category,
+                               order_by=(tallied.c.score.desc(), tallied.c.first_vote)).label('rank')
+    ).subquery()
+    category, condition = ranked.c.category, db.true()
+    if config.vote_type == 'awards':
+        all_jpl = ranked.c.category.contains('All JPL')
+        category = case(*[(and_(all_jpl, ranked.c.rank == r), ranked.c.category + suffix) for r, suffix in ALL_JPL_TEAMS.items()],
+                        else_=ranked.c.category)
+        condition = or_(~all_jpl, ranked.c.rank <= len(ALL_JPL_TEAMS))
+    db.session.execute(db.insert(VoteResult).from_select(
+        ['vote_config_id', 'category', 'player_id', 'score', 'rank'],
+        db.select(db.literal(config.id), category, ranked.c.player_id, ranked.c.score, ranked.c.rank).where(condition)))
     db.session.commit()
 
 # --- メインページ ---
@@ -1829,28 +3229,25 @@ def calculate_vote_results(config_id):
 def index():
     view_sid = get_view_season_id()
     
-    # 1. 順位表データの取得
-    overall_standings = calculate_standings(view_sid)
-    league_a_standings = calculate_standings(view_sid, league_filter="Aリーグ")
-    league_b_standings = calculate_standings(view_sid, league_filter="Bリーグ")
+    # 1. 順位表データの取得 (総合・各リーグを1回の集計で)
+    overall_standings, league_standings = calculate_league_standings(view_sid)
     
     # ★★★ 追加修正: トップページの全順位表で、得失点差を「平均」に変換する ★★★
-    # 総合、Aリーグ、Bリーグの3つのリストを順番に処理します
-    for standings_list in [overall_standings, league_a_standings, league_b_standings]:
-        for stat in standings_list:
-            # 試合数を計算 (勝ち + 負け)
-            games_count = stat.get('wins', 0) + stat.get('losses', 0)
-            
-            if games_count > 0:
-                # 合計得失点差 ÷ 試合数 = 平均得失点差
-                stat['diff'] = round(stat['diff'] / games_count, 1)
-            else:
-                stat['diff'] = 0
+    # リーグ別の行は総合と同じ辞書なので、総合側を1回変換すれば全表に反映されます
+    for stat in overall_standings:
+        # 試合数を計算 (勝ち + 負け)
+        games_count = stat.get('wins', 0) + stat.get('losses', 0)
+        
+        if games_count > 0:
+            # 合計得失点差 ÷ 試合数 = 平均得失点差
+            stat['diff'] = round(stat['diff'] / games_count, 1)
+        else:
+            stat['diff'] = 0
     # ★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★
 
     stats_leaders = get_stats_leaders(view_sid)
-    closest_game = Game.query.filter(Game.season_id == view_sid, Game.is_finished == False).order_by(Game.game_date.asc()).first()
-    upcoming_games = Game.query.filter(Game.season_id == view_sid, Game.is_finished == False, Game.game_date == closest_game.game_date).order_by(Game.start_time.asc()).all() if closest_game else []
+    closest_game = Game.query.filter(Game.season_id == view_sid, Game.is_finished == False, Game.game_datetime.isnot(None)).order_by(Game.game_datetime.asc()).first()
+    upcoming_games = Game.query.filter(Game.season_id == view_sid, Game.is_finished == False, game_period_clause(closest_game.game_date, closest_game.game_date)).order_by(Game.game_datetime.asc(), Game.id.asc()).all() if closest_game else []
     news_items = News.query.order_by(News.created_at.desc()).limit(5).all()
     one_hour_ago = datetime.now() - timedelta(hours=1)
     latest_result_game = Game.query.filter(Game.season_id == view_sid, Game.is_finished == True, Game.result_input_time >= one_hour_ago).order_by(Game.result_input_time.desc()).first()
@@ -1882,7 +3279,7 @@ def index():
     ticker_content = ticker_text_obj.value if ticker_text_obj else ""
     show_ticker = True if ticker_active_obj and ticker_active_obj.value == 'true' and ticker_content else False
 
-    return render_template('index.html', overall_standings=overall_standings, league_a_standings=league_a_standings, league_b_standings=league_b_standings, leaders=stats_leaders, upcoming_games=upcoming_games, news_items=news_items, latest_result=latest_result_game, all_teams=all_teams, weekly_candidates_a=weekly_candidates_a, weekly_candidates_b=weekly_candidates_b, monthly_candidates_a=monthly_candidates_a, monthly_candidates_b=monthly_candidates_b, show_mvp=show_mvp, active_votes=active_votes, published_votes=published_votes, bracket=bracket_data, show_playoff=show_playoff, show_ticker=show_ticker, ticker_content=ticker_content)
+    return render_template('index.html', overall_standings=overall_standings, league_standings=league_standings, leaders=stats_leaders, upcoming_games=upcoming_games, news_items=news_items, latest_result=latest_result_game, all_teams=all_teams, weekly_candidates_a=weekly_candidates_a, weekly_candidates_b=weekly_candidates_b, monthly_candidates_a=monthly_candidates_a, monthly_candidates_b=monthly_candidates_b, show_mvp=show_mvp, active_votes=active_votes, published_votes=published_votes, bracket=bracket_data, show_playoff=show_playoff, show_ticker=show_ticker, ticker_content=ticker_content)
 
 @app.route('/stats')
 def stats_page():
@@ -1906,30 +3303,313 @@ def stats_page():
 
     individual_stats = db.session.query(
         Player.id.label('player_id'), Player.name.label('player_name'), Team.id.label('team_id'), Team.name.label('team_name'),
-        func.count(PlayerStat.game_id).label('games_played'), func.avg(PlayerStat.pts).label('avg_pts'),
-        func.avg(PlayerStat.ast).label('avg_ast'), func.avg(PlayerStat.reb).label('avg_reb'),
-        func.avg(PlayerStat.stl).label('avg_stl'), func.avg(PlayerStat.blk).label('avg_blk'),
-        func.avg(PlayerStat.foul).label('avg_foul'), func.avg(PlayerStat.turnover).label('avg_turnover'),
-        func.avg(PlayerStat.fgm).label('avg_fgm'), func.avg(PlayerStat.fga).label('avg_fga'),
-        func.avg(PlayerStat.three_pm).label('avg_three_pm'), func.avg(PlayerStat.three_pa).label('avg_three_pa'),
-        func.avg(PlayerStat.ftm).label('avg_ftm'), func.avg(PlayerStat.fta).label('avg_fta'),
-        case((func.sum(PlayerStat.fga) > 0, (func.sum(PlayerStat.fgm) * 100.0 / func.sum(PlayerStat.fga))), else_=0).label('fg_pct'),
-        case((func.sum(PlayerStat.three_pa) > 0, (func.sum(PlayerStat.three_pm) * 100.0 / func.sum(PlayerStat.three_pa))), else_=0).label('three_p_pct'),
-        case((func.sum(PlayerStat.fta) > 0, (func.sum(PlayerStat.ftm) * 100.0 / func.sum(PlayerStat.fta))), else_=0).label('ft_pct')
-    ).join(Player, PlayerStat.player_id == Player.id).join(Team, Player.team_id == Team.id)\
-     .join(Game, PlayerStat.game_id == Game.id).filter(Game.season_id == view_sid)\
-     .group_by(Player.id, Team.id, Team.name).all()
+        PlayerSeasonTotals.games_played.label('games_played'), _totals_avg('pts', 'avg_pts'),
+        _totals_avg('ast', 'avg_ast'), _totals_avg('reb', 'avg_reb'),
+        _totals_avg('stl', 'avg_stl'), _totals_avg('blk', 'avg_blk'),
+        _totals_avg('foul', 'avg_foul'), _totals_avg('turnover', 'avg_turnover'),
+        _totals_avg('fgm', 'avg_fgm'), _totals_avg('fga', 'avg_fga'),
+        _totals_avg('three_pm', 'avg_three_pm'), _totals_avg('three_pa', 'avg_three_pa'),
+        _totals_avg('ftm', 'avg_ftm'), _totals_avg('fta', 'avg_fta'),
+        _totals_pct('fgm', 'fga', 'fg_pct'), _totals_pct('three_pm', 'three_pa', 'three_p_pct'), _totals_pct('ftm', 'fta', 'ft_pct')
+    ).join(Player, PlayerSeasonTotals.player_id == Player.id).join(Team, Player.team_id == Team.id)\
+     .filter(PlayerSeasonTotals.season_id == view_sid).all()
      
     return render_template('stats.html', team_stats=team_stats, individual_stats=individual_stats)
 
+@app.route('/api/leaders')
+def api_leaders():
+    """ リーダーボードのJSON (?category=fg_pct&offset=0&limit=20&min_games=3) """
+    view_sid = get_view_season_id()
+    category = request.args.get('category', 'pts')
+    if category not in LEADERBOARD_CATEGORIES: return jsonify({'error': f'未対応のカテゴリです: {category}'}), 400
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    min_games = max(request.args.get('min_games', 1, type=int), 1)
+    entries = get_leaderboards(view_sid, [category], limit=limit, offset=offset, min_games=min_games)[category]
+    return jsonify({
+        'category': category, 'label': LEADERBOARD_CATEGORIES[category]['label'],
+        'offset': offset, 'limit': limit, 'min_games': min_games,
+        'leaders': [entry._asdict() for entry in entries],
+        'next_offset': offset + limit if len(entries) == limit else None
+    })
+
 @app.route('/regulations')
 def regulations(): return render_template('regulations.html')
 
 @app.cli.command('init-db')
 def init_db_command():
     db.create_all()
+    run_migrations()
     print('Initialized the database.')
 
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """ 未適用のマイグレーションを適用する (何度実行しても同じ結果になる) """
+    applied = run_migrations()
+    for version, description in applied: print(f'v{version} を適用しました: {description}')
+    if not applied: print('適用するマイグレーションはありません。')
+    print(f'現在のスキーマバージョン: v{get_schema_version()} (最新 v{LATEST_SCHEMA_VERSION})')
+
+def _is_scratch_database():
+    """ 計測用に壊してよいDB: SQLite かつ 既定の database.db 以外 (DATABASE_URL で一時ファイルを指定したもの) """
+    url = db.engine.url
+    if url.get_backend_name() != 'sqlite': return False
+    if not url.database or url.database == ':memory:': return True
+    return os.path.realpath(url.database) != os.path.realpath(os.path.join(basedir, 'database.db'))
+
+def _drop_search_indexes():
+    """ ベンチマーク比較用: SEARCH_INDEXES_V2 のうち現在あるものだけを外し、外した分の (名前, テーブル, カラム) を返す。
+        スキーマのバージョンは変えない (戻すのは _restore_search_indexes) """
+    existing = {(ix['name'], table) for table in {t for _, t, _ in SEARCH_INDEXES_V2} for ix in inspect(db.engine).get_indexes(table)}
+    dropped = [entry for entry in SEARCH_INDEXES_V2 if (entry[0], entry[1]) in existing]
+    with db.engine.begin() as conn:
+        for name, _, _ in dropped: conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    return dropped
+
+def _restore_search_indexes(dropped):
+    with db.engine.begin() as conn:
+        for name, table, columns in dropped: _create_index_if_missing(conn, name, table, columns)
+
+def _time_pages(urls, rounds):
+    """ 各URLを rounds 回取得し、(URL, 中央値ms, 最大ms) のリストを返す """
+    client = app.test_client()
+    results = []
+    for url in urls:
+        client.get(url)  # 初回のキャッシュ作成分は除外
+        timings = []
+        for _ in range(rounds):
+            started = time.perf_counter()
+            response = client.get(url)
+            timings.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200: raise click.ClickException(f'{url}: HTTP {response.status_code}')
+        timings.sort()
+        results.append((url, timings[len(timings) // 2], timings[-1]))
+    return results
+
+@app.cli.command('bench-pages')
+@click.option('--rounds', default=20, show_default=True, help='URLごとの計測回数')
+@click.option('--team-id', type=int, default=None, help='計測する /team/<id> (省略時は試合数が最多のチーム)')
+@click.option('--player-id', type=int, default=None, help='計測する /player/<id> (省略時は出場数が最多の選手)')
+@click.option('--compare-indexes', is_flag=True, help='v2 の複合インデックスを一旦外して計測し、戻してから再計測する (一時的な SQLite のDBでのみ)')
+def bench_pages_command(rounds, team_id, player_id, compare_indexes):
+    """ /schedule, /team/<id>, /player/<id> の応答時間を計測する """
+    if compare_indexes and not _is_scratch_database():
+        raise click.ClickException('--compare-indexes はインデックスを外すため、DATABASE_URL で一時的な SQLite のDBを指定したときだけ実行できます。')
+    run_migrations()
+    if team_id is None:
+        team_id = db.session.query(Game.home_team_id).group_by(Game.home_team_id).order_by(func.count(Game.id).desc()).limit(1).scalar()
+    if player_id is None:
+        player_id = db.session.query(PlayerStat.player_id).group_by(PlayerStat.player_id).order_by(func.count(PlayerStat.id).desc()).limit(1).scalar()
+    if team_id is None or player_id is None: raise click.ClickException('計測対象の試合データがありません。')
+    urls = ['/schedule', f'/team/{team_id}', f'/player/{player_id}']
+    print(f'試合 {Game.query.count()} 件 / スタッツ {PlayerStat.query.count()} 件 / {rounds} 回計測 (中央値, 最大)')
+
+    runs = []
+    if compare_indexes:
+        db.session.close()
+        dropped = _drop_search_indexes()
+        try:
+            runs.append(('インデックスなし', _time_pages(urls, rounds)))
+        finally:
+            db.session.close()
+            _restore_search_indexes(dropped)
+    runs.append((f'v{get_schema_version()}', _time_pages(urls, rounds)))
+    for label, results in runs:
+        print(f'[{label}]')
+        for url, median, worst in results: print(f'  {url:<16} {median:8.1f} ms {worst:8.1f} ms')
+
+def _standings_snapshot(standings):
+    """ 比較用に順位表の各行からチームオブジェクトを外す """
+    return {row['team'].id: {k: v for k, v in row.items() if k != 'team'} for row in standings}
+
+@app.cli.command('rebuild-standings')
+def rebuild_standings_command():
+    """ TeamSeasonStanding / PlayerSeasonTotals を生データから作り直し、順位表は低速パスの計算結果と照合する """
+    db.create_all()
+    for season in Season.query.order_by(Season.id).all():
+        expected = _standings_snapshot(compute_standings(season.id))
+        stored = _standings_snapshot(calculate_standings(season.id))
+        drifted = sorted(tid for tid in set(expected) | set(stored) if expected.get(tid) != stored.get(tid))
+        if drifted: print(f'[{season.name}] 保存済み集計のずれ: team_id={drifted}')
+
+        TeamSeasonStanding.query.filter_by(season_id=season.id).delete()
+        refresh_team_standings(season.id)
+        db.session.commit()
+
+        rebuilt = _standings_snapshot(calculate_standings(season.id))
+        status = 'OK' if rebuilt == expected else 'MISMATCH'
+        print(f'[{season.name}] {len(rebuilt)} チームを再構築しました: {status}')
+
+        PlayerSeasonTotals.query.filter_by(season_id=season.id).delete()
+        refresh_player_totals(season.id)
+        db.session.commit()
+        print(f'[{season.name}] 選手シーズン合計 {PlayerSeasonTotals.query.filter_by(season_id=season.id).count()} 件を再構築しました')
+
+@app.cli.command('bench-schedule')
+@click.option('--leagues', default='8x8,16x16,17x15,24x24', show_default=True, help='Aリーグ×Bリーグのチーム数 (カンマ区切り)')
+@click.option('--times', 'n_times', default=2, show_default=True, help='1日の時間枠の数')
+@click.option('--weekdays', default='1,3,5', show_default=True, help='開催曜日 (0=月)')
+@click.option('--seconds', default=3.0, show_default=True, help='最適化の時間予算 (秒)')
+@click.option('--seed', default=1, show_default=True)
+def bench_schedule_command(leagues, n_times, weekdays, seconds, seed):
+    """ 現行の総当たり生成と、最適化後の日程の所要時間・ペナルティを比較する (DBは使わない) """
+    BenchTeam = namedtuple('BenchTeam', ['id', 'name'])
+    selected_weekdays = [int(d) for d in weekdays.split(',')]
+    start_date = date(2026, 4, 1)
+    for spec in leagues.split(','):
+        size_a, size_b = (int(n) for n in spec.lower().split('x'))
+        league_a = [BenchTeam(i + 1, f'A{i + 1}') for i in range(size_a)]
+        league_b = [BenchTeam(size_a + i + 1, f'B{i + 1}') for i in range(size_b)]
+
+        started = time.perf_counter()
+        final_rounds, phases = build_season_rounds(league_a, league_b)
+        generate_ms = (time.perf_counter() - started) * 1000
+        slots = schedule_slot_calendar(len(final_rounds), start_date, selected_weekdays, n_times)
+        optimizer = ScheduleOptimizer(final_rounds, phases, slots, seed=seed)
+        optimized = optimizer.optimize(time_budget=seconds)
+
+        # 対戦カードが変わっていないこと・1ラウンドに同じチームが2試合入っていないことを確認
+        def cards(rounds): return sorted(tuple(sorted((h.id, a.id))) for rm in rounds for h, a in rm)
+        double_booked = sum(len(rm) * 2 - len({t.id for pair in rm for t in pair}) for rm in optimized)
+        valid = cards(final_rounds) == cards(optimized) and double_booked == 0
+
+        games = sum(len(rm) for rm in final_rounds)
+        print(f'[{size_a}x{size_b}] {games} 試合 / {len(final_rounds)} ラウンド / 生成 {generate_ms:.1f} ms / '
+              f'最適化 {optimizer.elapsed:.2f} 秒 ({optimizer.iterations} 回) / 検証 {"OK" if valid else "NG"}')
+        print(f'  現行    {optimizer.initial_report}')
+        print(f'  最適化後 {optimizer.report()}')
+
+# 読み取りで起きやすい崩れ (似た文字の取り違え・文字の欠落/重複)
+_OCR_LOOKALIKES = {'O': '0', '0': 'O', 'I': '1', '1': 'I', 'l': 'I', 'B': '8', '8': 'B', 'S': '5', '5': 'S', 'Z': '2', 'G': '6'}
+
+def _ocr_noise(name, rng):
+    chars = list(name)
+    for _ in range(rng.choice([0, 1, 1, 2])):
+        i = rng.randrange(len(chars))
+        op = rng.random()
+        if op < 0.6 and chars[i] in _OCR_LOOKALIKES: chars[i] = _OCR_LOOKALIKES[chars[i]]
+        elif op < 0.8 and len(chars) > 4: del chars[i]
+        else: chars.insert(i, chars[i])
+    return ''.join(chars)
+
+@app.cli.command('bench-matcher')
+@click.option('--roster', default=15, show_default=True, help='1チームの選手数')
+@click.option('--rounds', default=300, show_default=True, help='試行回数')
+@click.option('--seed', default=1, show_default=True)
+def bench_matcher_command(roster, rounds, seed):
+    """ 2チーム分のロスターに対する選手名照合の所要時間と正解率を測る (DBは使わない) """
+    rng = random.Random(seed)
+    words = ['ZERO', 'KII', 'SHADOW', 'BLAZE', 'NOVA', 'RYU', 'KING', 'SLIM', 'BIG', 'JAPAN', 'MAMBA', 'OG', 'TAKA', 'SORA', 'LUX']
+    build_ms, match_ms, correct, total = [], [], 0, 0
+    for _ in range(rounds):
+        names = set()
+        while len(names) < roster * 2:
+            names.add('-'.join(rng.sample(words, rng.choice([1, 2, 2, 3]))) + rng.choice(['', str(rng.randrange(100))]))
+        entries = [(i + 1, name, 'home' if i < roster else 'away') for i, name in enumerate(sorted(names))]
+
+        # 両チーム5人ずつ + 重なった画像による同じ行の重複 + 読み取りのゴミ行
+        starters = rng.sample(entries[:roster], 5) + rng.sample(entries[roster:], 5)
+        rows = [dict({k: rng.randrange(20) for k in ANALYSIS_STAT_KEYS}, name=_ocr_noise(name, rng), _pid=pid)
+                for pid, name, _ in starters]
+        rows += [dict(r) for r in rng.sample(rows, 3)]
+        rows.append(dict({k: 0 for k in ANALYSIS_STAT_KEYS}, name='#@%', _pid=None))
+        rng.shuffle(rows)
+
+        started = time.perf_counter()
+        index = RosterNameIndex(entries)
+        build_ms.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        result = match_box_score_rows(index, rows)
+        match_ms.append((time.perf_counter() - started) * 1000)
+        for row, matched in zip(rows, result['rows']):
+            total += 1
+            correct += matched['player_id'] == row['_pid']
+
+    def pct(values, p): return sorted(values)[min(len(values) - 1, int(len(values) * p))]
+    print(f'ロスター {roster}×2 / {rounds} 回 / 1回あたり {len(rows)} 行')
+    print(f'  索引の作成 平均 {sum(build_ms) / rounds:.2f} ms / p95 {pct(build_ms, 0.95):.2f} ms')
+    print(f'  照合       平均 {sum(match_ms) / rounds:.2f} ms / p95 {pct(match_ms, 0.95):.2f} ms / 最大 {max(match_ms):.2f} ms')
+    print(f'  正解率 {correct / total * 100:.1f}% ({correct}/{total} 行)')
+
+@app.cli.command('bench-votes')
+@click.option('--voters', default=200, show_default=True, help='模擬する投票者の数')
+@click.option('--concurrency', default=16, show_default=True, help='同時に送信するスレッド数')
+@click.option('--resubmits', default=2, show_default=True, help='1人が同じ投票を送る回数 (二重送信の再現)')
+@click.option('--seed', default=1, show_default=True)
+def bench_votes_command(voters, concurrency, resubmits, seed):
+    """ 一時的なアワード投票に多数の投票者が同時に送信し、応答時間・重複行・途中経過の集計を確かめる (終了後に片付ける) """
+    run_migrations()
+    rng = random.Random(seed)
+    player_ids = [pid for (pid,) in db.session.query(Player.id).filter(Player.is_active == True).all()]
+    if len(player_ids) < 3: raise click.ClickException('投票対象の選手がいません。')
+    categories = ['MVP', 'DPOY', 'ROY']
+    def random_ballot():
+        ballot = {}
+        for category in categories:
+            for rank_value, pid in zip((5, 3, 1), rng.sample(player_ids, 3)): ballot[(category, rank_value)] = pid
+        return ballot
+
+    tag = uuid.uuid4().hex[:8]
+    config = VoteConfig(title=f'bench-votes {tag}', vote_type='awards', is_open=False)
+    db.session.add(config)
+    users = [User(username=f'bench_voter_{tag}_{i}', role='user') for i in range(voters)]
+    db.session.add_all(users)
+    db.session.commit()
+    config_id, user_ids = config.id, [u.id for u in users]
+    try:
+        def submit(user_id, ballot):
+            with app.app_context():
+                started = time.perf_counter()
+                submit_ballot(config_id, user_id, ballot)
+                return (time.perf_counter() - started) * 1000
+
+        def run_round(jobs):
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                timings = list(pool.map(lambda job: submit(*job), jobs))
+            return timings, time.perf_counter() - started
+
+        def pct(values, p): return sorted(values)[min(len(values) - 1, int(len(values) * p))]
+        vote_tallies.get(config_id)  # 途中経過を読み込んだ状態から始める
+
+        # 1回目: 全員が同じ投票を resubmits 回ずつ、順番を混ぜて同時に送る / 2回目: 半数が1枠だけ選び直して送る
+        ballots = {uid: random_ballot() for uid in user_ids}
+        first = [(uid, ballots[uid]) for uid in user_ids for _ in range(resubmits)]
+        rng.shuffle(first)
+        second = []
+        for uid in rng.sample(user_ids, voters // 2):
+            ballot = dict(ballots[uid])
+            slot = rng.choice(list(ballot))
+            ballot[slot] = rng.choice([pid for pid in player_ids if pid not in ballot.values()])
+            ballots[uid] = ballot
+            second.append((uid, ballot))
+
+        print(f'投票者 {voters} 人 / 同時 {concurrency} スレッド / {db.engine.dialect.name}')
+        for label, jobs in (('一斉送信', first), ('選び直し', second)):
+            timings, elapsed = run_round(jobs)
+            print(f'  {label} {len(jobs):5d} 件 {elapsed:6.2f} 秒 ({len(jobs) / elapsed:7.1f} 件/秒) / '
+                  f'平均 {sum(timings) / len(timings):6.1f} ms / p95 {pct(timings, 0.95):6.1f} ms / 最大 {max(timings):6.1f} ms')
+
+        db.session.expire_all()
+        duplicates = db.session.query(Vote.user_id).filter_by(vote_config_id=config_id).group_by(
+            Vote.user_id, Vote.category, Vote.rank_value).having(func.count(Vote.id) > 1).count()
+        rows = Vote.query.filter_by(vote_config_id=config_id).count()
+        expected = Counter()
+        for ballot in ballots.values():
+            for (category, rank_value), pid in ballot.items(): expected[(category, pid)] += rank_value
+        live = vote_tallies.get(config_id)
+        vote_tallies.discard(config_id)
+        recount = vote_tallies.get(config_id)
+        print(f'  重複行 {duplicates} 件 / 投票行 {rows} 件 (期待値 {voters * len(categories) * 3})')
+        print(f'  途中経過 {"OK" if live == recount == dict(expected) else "MISMATCH"} ({len(live)} 件の (カテゴリ, 選手))')
+    finally:
+        Vote.query.filter_by(vote_config_id=config_id).delete()
+        SystemSetting.query.filter_by(key=_ballot_version_key(config_id)).delete()
+        VoteConfig.query.filter_by(id=config_id).delete()
+        User.query.filter(User.id.in_(user_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        vote_tallies.discard(config_id)
+
 # --- ★追加: 選手比較機能 ---
 @app.route('/compare', methods=['GET', 'POST'])
 def compare_players():
@@ -1966,15 +3646,14 @@ def compare_players():
 def _get_player_avg_stats(player_id, season_id):
     """ 指定選手の平均スタッツを取得するヘルパー関数 """
     stats = db.session.query(
-        func.avg(PlayerStat.pts).label('pts'),
-        func.avg(PlayerStat.reb).label('reb'),
-        func.avg(PlayerStat.ast).label('ast'),
-        func.avg(PlayerStat.stl).label('stl'),
-        func.avg(PlayerStat.blk).label('blk'),
-        case((func.sum(PlayerStat.fga) > 0, (func.sum(PlayerStat.fgm) * 100.0 / func.sum(PlayerStat.fga))), else_=0).label('fg_pct'),
-        case((func.sum(PlayerStat.three_pa) > 0, (func.sum(PlayerStat.three_pm) * 100.0 / func.sum(PlayerStat.three_pa))), else_=0).label('three_p_pct')
-    ).join(Game, PlayerStat.game_id == Game.id)\
-      .filter(PlayerStat.player_id == player_id, Game.season_id == season_id).first()
+        _totals_avg('pts', 'pts'),
+        _totals_avg('reb', 'reb'),
+        _totals_avg('ast', 'ast'),
+        _totals_avg('stl', 'stl'),
+        _totals_avg('blk', 'blk'),
+        _totals_pct('fgm', 'fga', 'fg_pct'),
+        _totals_pct('three_pm', 'three_pa', 'three_p_pct')
+    ).filter(PlayerSeasonTotals.player_id == player_id, PlayerSeasonTotals.season_id == season_id).first()
     
     # Noneの場合は0を返す辞書を作成
     if not stats:
@@ -1990,28 +3669,12 @@ def _get_player_avg_stats(player_id, season_id):
         'three_p_pct': float(stats.three_p_pct or 0)
     }
 
-# --- ★緊急用: DBカラム強制追加ルート (image_url用) ---
+# --- ★緊急用: DBカラム強制追加ルート (image_url用、旧URL互換) ---
 @app.route('/admin/fix_db_image')
 @login_required
 @admin_required
 def fix_db_image_column():
-    try:
-        with db.engine.connect() as conn:
-            trans = conn.begin()
-            try:
-                # playerテーブルに image_url カラムを追加
-                conn.execute(text("ALTER TABLE player ADD COLUMN image_url VARCHAR(255)"))
-                print("Added image_url column.")
-                flash('Playerテーブルに image_url カラムを追加しました。')
-            except Exception as e:
-                print(f"image_url column might already exist: {e}")
-                flash(f'カラム追加スキップ（既に存在する可能性があります）: {e}')
-            
-            trans.commit()
-    except Exception as e:
-        flash(f'DB操作エラー: {e}')
-    
-    return redirect(url_for('index'))
+    return fix_db_schema()
 
 
 # --- ★追加: 試合パスワード変更機能 ---
@@ -2046,20 +3709,11 @@ def upload_player_image(player_id):
         file = request.files['player_image']
         if file and file.filename != '' and allowed_file(file.filename):
             try:
-                # 古い画像があれば削除 (チームロゴと重複しないように注意が必要だが、基本は上書きでOK)
-                if player.image_url and 'nba2k_jpl_cards' in player.image_url:
-                    try:
-                        public_id = "nba2k_jpl_cards/" + os.path.splitext(player.image_url.split('/')[-1])[0]
-                        cloudinary.uploader.destroy(public_id)
-                    except: pass
-
-                # Cloudinaryへアップロード (幅500pxにリサイズして容量節約)
-                upload_result = cloudinary.uploader.upload(
-                    file, 
-                    folder="nba2k_jpl_cards/players",
-                    width=500, crop="limit"
-                )
-                player.image_url = upload_result.get('secure_url')
+                # 幅500pxに縮小して容量節約。古い画像は新しい画像の保存が済んでから削除する
+                # (チームロゴなど、選手画像用のフォルダ以外のURLは消さない)
+                old_url = player.image_url if player.image_url and 'nba2k_jpl_cards' in player.image_url else None
+                player.image_url = save_media(file.stream, folder="nba2k_jpl_cards/players", max_width=500,
+                                              columns=[(Player, 'image_url')], replaces=old_url)
                 db.session.commit()
                 flash(f'選手「{player.name}」の画像を更新しました。')
             except Exception as e:
@@ -2069,41 +3723,173 @@ def upload_player_image(player_id):
     
     return redirect(url_for('player_detail', player_id=player_id))
 
-# app.py の analyze_stats_image 関数をこれに置き換え
-
-# app.py の analyze_stats_image 関数
-
-# app.py の analyze_stats_image 関数
-
-# app.py の analyze_stats_image 関数
-
-@app.route('/api/analyze_stats', methods=['POST'])
-@login_required
-def analyze_stats_image():
-    files = request.files.getlist('image')
-    if not files or all(f.filename == '' for f in files):
-        return jsonify({'error': '画像が選択されていません'}), 400
-
-    # APIキー設定（そのまま）
-    api_keys = [k for k in [os.environ.get('GOOGLE_API_KEY'), os.environ.get('GOOGLE_API_KEY_2'), os.environ.get('GOOGLE_API_KEY_3')] if k]
-    if not api_keys: return jsonify({'error': 'APIキー設定なし'}), 500
-
-    # 画像処理（そのまま：カラーで渡す）
-    pil_images = []
-    uploaded_urls = []
-    try:
-        for file in files:
-            upload_result = cloudinary.uploader.upload(file)
-            uploaded_urls.append(upload_result['secure_url'])
-            file.seek(0)
-            pil_images.append(Image.open(file))
-    except Exception as e:
-        return jsonify({'error': f'画像処理エラー: {str(e)}'}), 500
-
-    # ==========================================
-    # ★変更点：デバッグ用のプロンプト
-    # ==========================================
-    prompt_text = """
+# --- 読み取った選手名とロスターの照合 ---
+# 画像から読み取ったゲーマータグ (読み取りの揺れを含む) を試合の両チームの選手に割り当てる。
+# 正規化した名前の文字 n-gram の転置インデックスで候補を絞り、編集距離で信頼度を付ける
+NAME_MATCH_MIN_CONFIDENCE = 0.4  # これ未満は割り当てない (従来の画面側の判定と同じ)
+NAME_MATCH_CANDIDATES = 3  # 行ごとに返す候補の数
+NAME_MATCH_SHORTLIST = 8  # 編集距離を計算する候補の数 (共有 n-gram の多い順)
+NAME_MATCH_SAME_PLAYER = 0.8  # 同じ選手の候補になった名前同士がこれ以上似ていれば同一人物の揺れとみなす
+ROSTER_INDEX_CACHE_MAX_ENTRIES = 128
+ANALYSIS_STAT_KEYS = ('pts', 'reb', 'ast', 'stl', 'blk', 'foul', 'to', 'fgm', 'fga', '3pm', '3pa', 'ftm', 'fta')
+# 読み取りで混同しやすい文字を寄せる (小文字化の後に適用。ロスター側にも同じ変換をかける)
+_NAME_CONFUSABLES = str.maketrans({'1': 'i', 'l': 'i', '|': 'i', '0': 'o', '8': 'b', '5': 's', '2': 'z', '6': 'g'})
+_roster_index_cache = {}
+
+def normalize_gamertag(name):
+    s = unicodedata.normalize('NFKC', str(name or '')).lower()
+    return re.sub(r'[-_ .]', '', s).translate(_NAME_CONFUSABLES)
+
+def name_ngrams(s, n=2):
+    padded = f'^{s}$'
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+def edit_distance(a, b):
+    """ レーベンシュタイン距離 (Myers / Hyyrö のビット並列法: 短い方の文字をビットに割り当て、長い方を1文字ずつ進める) """
+    if len(a) > len(b): a, b = b, a
+    if not a: return len(b)
+    peq = {}
+    for i, c in enumerate(a): peq[c] = peq.get(c, 0) | (1 << i)
+    full = (1 << len(a)) - 1
+    last = 1 << (len(a) - 1)
+    pv, mv, score = full, 0, len(a)
+    for c in b:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        if ph & last: score += 1
+        elif mh & last: score -= 1
+        ph = ((ph << 1) | 1) & full
+        mh = (mh << 1) & full
+        pv = mh | (~(xv | ph) & full)
+        mv = ph & xv
+    return score
+
+def name_similarity(a, b):
+    """ 正規化済みの名前同士の類似度 (0〜1)。
+        片方がもう片方を含む場合 (列幅で名前が切れた場合など) は長さの比に応じて最大 0.9 まで上げる """
+    if not a or not b: return 0.0
+    shorter, longer = sorted((len(a), len(b)))
+    score = (longer - edit_distance(a, b)) / longer
+    if a in b or b in a: score = max(score, 0.6 + 0.3 * shorter / longer)
+    return score
+
+class RosterNameIndex:
+    """ 選手名の n-gram 転置インデックス。entries は (選手ID, 名前, 'home' / 'away') のタプル """
+    def __init__(self, entries):
+        self.entries = tuple(entries)
+        self.names = [normalize_gamertag(name) for _, name, _ in self.entries]
+        self.grams = [name_ngrams(name) for name in self.names]
+        self.postings = defaultdict(list)
+        for idx, grams in enumerate(self.grams):
+            for gram in grams: self.postings[gram].append(idx)
+        self._memo = {}
+
+    def search(self, name):
+        """ [(信頼度, entries の添字)] を信頼度の高い順に返す (同じ名前は覚えておく) """
+        query = normalize_gamertag(name)
+        if query not in self._memo:
+            if len(self._memo) >= 512: self._memo.clear()
+            grams = name_ngrams(query)
+            shared = defaultdict(int)
+            for gram in grams:
+                for idx in self.postings.get(gram, ()): shared[idx] += 1
+            # Dice 係数の上位だけ編集距離を計算する
+            shortlist = sorted(shared, key=lambda idx: -2 * shared[idx] / (len(grams) + len(self.grams[idx])))[:NAME_MATCH_SHORTLIST]
+            scored = sorted(((name_similarity(query, self.names[idx]), idx) for idx in shortlist), key=lambda p: (-p[0], p[1]))
+            self._memo[query] = scored[:NAME_MATCH_CANDIDATES]
+        return self._memo[query]
+
+def get_roster_index(game):
+    """ 試合の両チームの現役選手の索引。ロスターの内容 (ID・名前・所属) をキーにキャッシュする """
+    rows = (db.session.query(Player.id, Player.name, Player.team_id)
+            .filter(Player.team_id.in_([game.home_team_id, game.away_team_id]),
+                    or_(Player.is_active.is_(None), Player.is_active == True))
+            .order_by(Player.id).all())
+    entries = tuple((pid, name, 'home' if team_id == game.home_team_id else 'away') for pid, name, team_id in rows)
+    index = _roster_index_cache.get(entries)
+    if index is None:
+        if len(_roster_index_cache) >= ROSTER_INDEX_CACHE_MAX_ENTRIES: _roster_index_cache.clear()
+        index = _roster_index_cache[entries] = RosterNameIndex(entries)
+    return index
+
+def _stat_int(value):
+    try: return int(float(value))
+    except (TypeError, ValueError): return 0
+
+def match_box_score_rows(index, rows):
+    """ 読み取った行をロスターの選手に割り当て、同じ選手の行をまとめる。
+        画像の重なりで同じ数値の行が複数ある場合は1つだけ数え、数値が違う行 (回線落ちで分かれたリザルト) は合算する。
+        戻り値: {'rows': 行ごとの候補と割り当て, 'box_score': 選手ごとの合計 (最初に出てきた順)} """
+    rows = [r for r in rows if isinstance(r, dict)]
+    keys = [normalize_gamertag(r.get('name')) for r in rows]
+    candidates = [index.search(r.get('name')) for r in rows]
+
+    # 正規化後の名前ごとにまとめ、同じ選手が最有力の名前同士がよく似ていれば揺れとして1人にまとめる
+    groups, group_of = [], {}
+    for i, key in enumerate(keys):
+        if key in group_of: continue
+        top = candidates[i][0][1] if candidates[i] else None
+        for g in groups:
+            if top is not None and g['top'] == top and name_similarity(key, g['keys'][0]) >= NAME_MATCH_SAME_PLAYER:
+                g['keys'].append(key); group_of[key] = g
+                break
+        else:
+            group_of[key] = {'n': len(groups), 'first': i, 'top': top, 'keys': [key]}
+            groups.append(group_of[key])
+
+    # 信頼度の高い組から1選手ずつ割り当てる (1人の選手に別人の行がまとまらないように)
+    pairs = sorted(((conf, g['first'], g['n'], idx) for g in groups
+                    for conf, idx in candidates[g['first']] if conf >= NAME_MATCH_MIN_CONFIDENCE),
+                   key=lambda p: (-p[0], p[1]))
+    assigned, taken = {}, set()
+    for conf, _, n, idx in pairs:
+        if n in assigned or idx in taken: continue
+        assigned[n] = (idx, conf); taken.add(idx)
+
+    def describe(idx, conf):
+        pid, name, side = index.entries[idx]
+        return {'player_id': pid, 'player_name': name, 'side': side, 'confidence': round(conf, 3)}
+
+    row_results, totals = [], {}
+    for i, row in enumerate(rows):
+        n = group_of[keys[i]]['n']
+        result = {'name': row.get('name'), 'player_id': None, 'confidence': 0.0, 'duplicate': False,
+                  'candidates': [describe(idx, conf) for conf, idx in candidates[i]]}
+        if n in assigned:
+            idx, conf = assigned[n]
+            result.update(describe(idx, conf))
+            values = tuple(_stat_int(row.get(k)) for k in ANALYSIS_STAT_KEYS)
+            entry = totals.setdefault(idx, dict(describe(idx, conf), rows=[], seen=set(), stats=dict.fromkeys(ANALYSIS_STAT_KEYS, 0)))
+            if values in entry['seen']:
+                result['duplicate'] = True
+            else:
+                entry['seen'].add(values)
+                for k, v in zip(ANALYSIS_STAT_KEYS, values): entry['stats'][k] += v
+            entry['rows'].append(i)
+        row_results.append(result)
+
+    box_score = sorted(totals.values(), key=lambda e: e['rows'][0])
+    for entry in box_score: del entry['seen']
+    return {'rows': row_results, 'box_score': box_score}
+
+# --- スタッツ画像解析ジョブ ---
+# アップロードはジョブIDをすぐ返し、解析はワーカースレッドで行う (結果は /api/analyze_stats/<job_id> をポーリング)
+ANALYSIS_MAX_WORKERS = int(os.environ.get('ANALYSIS_MAX_WORKERS', 2))
+ANALYSIS_JOB_STALE_SECONDS = 600  # この時間 更新がない実行中ジョブは中断扱い (ワーカーの再起動など)
+ANALYSIS_JOB_KEEP_DAYS = 1
+ANALYSIS_UPLOAD_WORKERS = int(os.environ.get('ANALYSIS_UPLOAD_WORKERS', 6))
+ANALYSIS_IMAGE_MAX_EDGE = 2048  # モデルに渡す画像の長辺 (px)。表の文字が読める範囲で小さくする
+# 解析に使うモデル ('gemini' / 'fake')。テストでは FakeModelClient のインスタンスを直接入れてもよい
+app.config.setdefault('ANALYSIS_MODEL_CLIENT', os.environ.get('ANALYSIS_MODEL_CLIENT', 'gemini'))
+# Cloudinary 未設定の環境では画像の保存を省いて解析だけ行う
+app.config.setdefault('ANALYSIS_UPLOAD_IMAGES', bool(os.environ.get('CLOUDINARY_CLOUD_NAME')))
+# サーバーレス環境 (Vercel など) は応答後にスレッドが止まるので、リクエスト内で実行する
+app.config.setdefault('ANALYSIS_JOBS_INLINE', bool(os.environ.get('ANALYSIS_JOBS_INLINE') or os.environ.get('VERCEL')))
+
+STATS_ANALYSIS_PROMPT = """
     あなたはバスケットボールのスタッツ集計AIです。
     提供された【全ての画像】から、見えている【全ての選手行】を読み取り、JSONデータに変換してください。
 
@@ -2146,43 +3932,730 @@ def analyze_stats_image():
             }
         ]
     }
-    """
+"""
+
+class ModelQuotaError(Exception):
+    """ 全てのAPIキーが利用制限に達した """
+
+# --- APIキーのプール ---
+# プロセス内で共有し、キーごとに成功数・応答時間・利用制限の回数と状態を持つ。
+# 正常なキーのうち最後に使ったのが古いものから使い、利用制限(429)に当たったキーはしばらく休ませる。
+# キーやサーバー側の失敗が続いたキーは回路を開いて外し、時間が経ったら1件だけ試して戻すか決める
+ANALYSIS_KEY_COOLDOWN_SECONDS = 60  # 利用制限に当たったキーを休ませる秒数 (続けて当たるたびに倍)
+ANALYSIS_KEY_COOLDOWN_MAX_SECONDS = 3600
+ANALYSIS_KEY_FAILURE_THRESHOLD = 3  # 続けてこの回数失敗したら回路を開く
+ANALYSIS_KEY_OPEN_SECONDS = 300
+
+class ApiKeyState:
+    """ APIキー1つ分の状態と集計 """
+    def __init__(self, label, key):
+        self.label = label; self.key = key
+        self.successes = 0; self.failures = 0; self.quota_errors = 0
+        self.total_latency = 0.0
+        self.consecutive_quota = 0; self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.circuit_open = False; self.open_until = 0.0; self.probing = False
+        self.last_used = 0; self.last_error = ''
+
+class ApiKeyPool:
+    def __init__(self, keys, clock=time.monotonic):
+        """ keys: (表示名, キー) のリスト。clock はテストで差し替えられるようにしておく """
+        self.keys = [ApiKeyState(label, key) for label, key in keys]
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._turn = 0  # 使った順番 (最後に使ったのが古いキーから回すため)
+
+    def _status(self, state, now):
+        if state.circuit_open:
+            return 'half_open' if now >= state.open_until and not state.probing else 'open'
+        return 'cooldown' if now < state.cooldown_until else 'healthy'
+
+    def checkout(self):
+        """ 使えるキーを良い順に1つずつ返す (正常なキーを先に、回路の試し打ちは最後に回す) """
+        tried = set()
+        while True:
+            with self._lock:
+                now = self.clock()
+                ready = [s for s in self.keys if s.label not in tried and self._status(s, now) in ('healthy', 'half_open')]
+                if not ready: return
+                state = min(ready, key=lambda s: (self._status(s, now) == 'half_open', s.last_used))
+                if self._status(state, now) == 'half_open': state.probing = True
+                self._turn += 1
+                state.last_used = self._turn
+                tried.add(state.label)
+            yield state
+
+    def record_success(self, state, latency):
+        with self._lock:
+            state.successes += 1; state.total_latency += latency
+            state.consecutive_quota = state.consecutive_failures = 0
+            state.circuit_open = state.probing = False
+
+    def record_quota(self, state, error):
+        with self._lock:
+            state.quota_errors += 1; state.consecutive_quota += 1
+            wait = min(ANALYSIS_KEY_COOLDOWN_SECONDS * 2 ** (state.consecutive_quota - 1), ANALYSIS_KEY_COOLDOWN_MAX_SECONDS)
+            state.cooldown_until = self.clock() + wait
+            # 利用制限の応答が返る = キー自体は生きているので回路は閉じる
+            state.circuit_open = state.probing = False
+            state.last_error = str(error)[:200]
+
+    def record_failure(self, state, error):
+        with self._lock:
+            state.failures += 1; state.consecutive_failures += 1
+            if state.probing or state.consecutive_failures >= ANALYSIS_KEY_FAILURE_THRESHOLD:
+                state.circuit_open = True
+                state.open_until = self.clock() + ANALYSIS_KEY_OPEN_SECONDS
+            state.probing = False
+            state.last_error = str(error)[:200]
+
+    def release(self, state):
+        """ 画像や応答の問題で失敗した場合 (キーは応答しているので状態だけ戻す) """
+        with self._lock:
+            state.consecutive_failures = 0
+            state.circuit_open = state.probing = False
+
+    def reset(self):
+        with self._lock:
+            for s in self.keys:
+                s.cooldown_until = 0.0; s.consecutive_quota = s.consecutive_failures = 0
+                s.circuit_open = s.probing = False
+
+    def snapshot(self):
+        """ 管理画面用の集計 (キーは末尾4文字だけ出す) """
+        with self._lock:
+            now = self.clock()
+            return [{
+                'label': s.label, 'key': '…' + s.key[-4:], 'status': self._status(s, now),
+                'successes': s.successes, 'failures': s.failures, 'quota_errors': s.quota_errors,
+                'avg_latency': round(s.total_latency / s.successes, 2) if s.successes else None,
+                'wait_seconds': int(max(s.cooldown_until - now, s.open_until - now if s.circuit_open else 0, 0)),
+                'last_error': s.last_error,
+            } for s in self.keys]
+
+def google_api_keys_from_env():
+    """ GOOGLE_API_KEY, GOOGLE_API_KEY_2, GOOGLE_API_KEY_3 ... を番号順に集める """
+    found = []
+    for name, value in os.environ.items():
+        m = re.fullmatch(r'GOOGLE_API_KEY(?:_(\d+))?', name)
+        if m and value: found.append((int(m.group(1) or 1), name, value))
+    return [(name, value) for _, name, value in sorted(found)]
+
+_api_key_pool = None
+_api_key_pool_lock = threading.Lock()
+
+def get_api_key_pool():
+    global _api_key_pool
+    with _api_key_pool_lock:
+        if _api_key_pool is None: _api_key_pool = ApiKeyPool(google_api_keys_from_env())
+        return _api_key_pool
+
+def classify_model_error(e):
+    """ 'quota' (利用制限: 休ませて次のキー) / 'key' (キー・サーバー側の失敗: 回路に数えて次のキー) /
+        'request' (画像や応答の問題: 他のキーでも同じなのでそのまま失敗) """
+    message = str(e).lower()
+    if isinstance(e, (ModelQuotaError, google_exceptions.TooManyRequests)) or '429' in message or 'quota' in message:
+        return 'quota'
+    if isinstance(e, (google_exceptions.PermissionDenied, google_exceptions.Unauthenticated, google_exceptions.ServerError,
+                      google_exceptions.DeadlineExceeded, ConnectionError, TimeoutError)) or 'api key' in message:
+        return 'key'
+    return 'request'
+
+class PooledModelClient:
+    """ キーのプールからキーを選んでモデルを呼ぶ共通部分 (サブクラスが call_with_key を実装する) """
+    def __init__(self, pool):
+        self.pool = pool
+
+    def is_configured(self): return bool(self.pool.keys)
+
+    def analyze(self, prompt, images):
+        key_error = None
+        for state in self.pool.checkout():
+            print(f"--- {state.label} で解析開始 ---")
+            started = time.perf_counter()
+            try:
+                data = self.call_with_key(state.key, prompt, images)
+            except Exception as e:
+                print(f"エラー: {e}")
+                kind = classify_model_error(e)
+                if kind == 'quota': self.pool.record_quota(state, e); continue
+                if kind == 'key': self.pool.record_failure(state, e); key_error = e; continue
+                self.pool.release(state)
+                raise
+            self.pool.record_success(state, time.perf_counter() - started)
+            return data
+        if key_error: raise key_error
+        raise ModelQuotaError('利用制限超過')
+
+class GeminiModelClient(PooledModelClient):
+    """ Gemini で画像(PNG のバイト列)を解析する。images には画像の区切りの見出し(文字列)を混ぜてもよい。
+        前処理済みの PNG をそのまま送る。APIキーごとに GenerativeServiceClient を1つずつ持つ (プロセス全体の設定は使わない) """
+    model_name = 'gemini-3-pro-preview'
+
+    def __init__(self, pool=None):
+        super().__init__(pool or get_api_key_pool())
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+
+    def _client_for_key(self, api_key):
+        with self._clients_lock:
+            if api_key not in self._clients:
+                self._clients[api_key] = glm.GenerativeServiceClient(client_options={'api_key': api_key})
+            return self._clients[api_key]
+
+    def call_with_key(self, api_key, prompt, images):
+        parts = [glm.Part(text=prompt)] + [
+            glm.Part(text=data) if isinstance(data, str) else glm.Part(inline_data=glm.Blob(mime_type='image/png', data=data))
+            for data in images]
+        response = self._client_for_key(api_key).generate_content(glm.GenerateContentRequest(
+            model=f'models/{self.model_name}', contents=[glm.Content(role='user', parts=parts)]))
+        if not response.candidates: raise RuntimeError(f'応答がありません: {response.prompt_feedback}')
+        text = ''.join(part.text for part in response.candidates[0].content.parts)
+        data = json.loads(text.replace("```json", "").replace("```", ""))
+        # ログに「AIが見た生の文字」を表示する
+        print("\n========== AIの視界（デバッグログ） ==========")
+        for line in data.get('debug_raw_text', []):
+            print(f"認識: {line}")
+        print("============================================\n")
+        return data
+
+class FakeModelClient(PooledModelClient):
+    """ オフライン確認用のモデル。固定の応答 (関数なら response(prompt, images) の戻り値) を返す。
+        error を渡すと全キーで、key_errors={キー: 例外} を渡すとそのキーでだけ例外を送出する """
+    model_name = 'fake'
+
+    def __init__(self, response=None, delay=0.0, error=None, keys=('fake',), key_errors=None, clock=time.monotonic):
+        super().__init__(ApiKeyPool([(k, k) for k in keys], clock=clock))
+        self.response = response if response is not None else {'debug_raw_text': [], 'players': []}
+        self.delay = delay
+        self.error = error
+        self.key_errors = dict(key_errors or {})
+        self.calls = 0
+        self.used_keys = []
+
+    def call_with_key(self, api_key, prompt, images):
+        self.calls += 1
+        self.used_keys.append(api_key)
+        if self.delay: time.sleep(self.delay)
+        error = self.key_errors.get(api_key, self.error)
+        if error: raise error
+        response = self.response(prompt, images) if callable(self.response) else self.response
+        return json.loads(json.dumps(response))
+
+ANALYSIS_MODEL_CLIENTS = {'gemini': GeminiModelClient, 'fake': FakeModelClient}
+_analysis_model_clients = {}
+_analysis_model_clients_lock = threading.Lock()
+
+def get_analysis_model_client():
+    """ 名前で指定されたクライアントはプロセス内で使い回す (キーの状態とモデルを保持するため) """
+    client = app.config['ANALYSIS_MODEL_CLIENT']
+    if not isinstance(client, str): return client
+    with _analysis_model_clients_lock:
+        if client not in _analysis_model_clients: _analysis_model_clients[client] = ANALYSIS_MODEL_CLIENTS[client]()
+        return _analysis_model_clients[client]
+
+_analysis_executor = None
+_analysis_executor_lock = threading.Lock()
+
+def get_analysis_executor():
+    """ ワーカースレッドのプールは初回のジョブで作る (gunicorn の fork 前に作らないため) """
+    global _analysis_executor
+    with _analysis_executor_lock:
+        if _analysis_executor is None:
+            _analysis_executor = ThreadPoolExecutor(max_workers=ANALYSIS_MAX_WORKERS, thread_name_prefix='analysis')
+        return _analysis_executor
+
+def _update_analysis_job(job_id, **fields):
+    fields['updated_at'] = datetime.utcnow()
+    AnalysisJob.query.filter_by(id=job_id).update(fields, synchronize_session=False)
+    db.session.commit()
 
-    for i, current_key in enumerate(api_keys):
+def trim_uniform_border(img, tolerance=24):
+    """ 画面の黒帯など、四隅と同じ色の外周を切り落としてボックススコアの表部分に寄せる """
+    bg = Image.new(img.mode, img.size, img.getpixel((0, 0)))
+    mask = ImageChops.difference(img, bg).convert('L').point(lambda v: 255 if v > tolerance else 0)
+    bbox = mask.getbbox()
+    return img.crop(bbox) if bbox else img
+
+def prepare_analysis_image(data):
+    """ モデルに渡す画像を作る: 長辺を縮め、向きを直し、余白を切り落として PNG で再エンコードする
+        (数字の読み取りを誤らないよう、縮小後は可逆で保存する) """
+    img = Image.open(io.BytesIO(data))
+    img.draft('RGB', (ANALYSIS_IMAGE_MAX_EDGE, ANALYSIS_IMAGE_MAX_EDGE))  # JPEG は縮小しながらデコードする
+    img.thumbnail((ANALYSIS_IMAGE_MAX_EDGE, ANALYSIS_IMAGE_MAX_EDGE), Image.LANCZOS)
+    img = trim_uniform_border(ImageOps.exif_transpose(img).convert('RGB'))
+    buf = io.BytesIO()
+    img.save(buf, 'PNG')
+    return buf.getvalue()
+
+_analysis_upload_executor = None
+
+def get_analysis_upload_executor():
+    """ 画像保存用のスレッドプール (解析ジョブのプールとは分けて、ジョブが自分の待つ保存で枠を塞がないようにする) """
+    global _analysis_upload_executor
+    with _analysis_executor_lock:
+        if _analysis_upload_executor is None:
+            _analysis_upload_executor = ThreadPoolExecutor(max_workers=ANALYSIS_UPLOAD_WORKERS, thread_name_prefix='analysis-upload')
+        return _analysis_upload_executor
+
+def _upload_analysis_image(job_id, index, data, urls, lock):
+    """ 元画像を1枚保存し、保存済みのURLを途中経過としてジョブに書き込む """
+    # 解析ジョブ自体がバックグラウンドなので、キューを通さずに保存先へ直接保存する
+    url = get_media_storage().save(io.BytesIO(data))
+    with lock:
+        urls[index] = url
+        with app.app_context():
+            _update_analysis_job(job_id, image_urls=",".join(u for u in urls if u))
+    return time.perf_counter()
+
+# --- 解析結果のキャッシュ ---
+# 正規化(前処理)後の画像の内容ハッシュ + プロンプトの版 + モデル名 をキーに、解析結果をDBに保存する。
+# 同じスクリーンショットの再送ではモデルを呼ばず(APIキーの枠も使わず)、保存済みの画像URLごと返す
+STATS_ANALYSIS_PROMPT_VERSION = 1  # STATS_ANALYSIS_PROMPT を変えたら上げる
+ANALYSIS_CACHE_TTL = timedelta(days=7)
+ANALYSIS_CACHE_MAX_ENTRIES = 500
+
+def analysis_cache_key(prepared, model_name):
+    """ 画像の順番に依らないよう、1枚ごとのハッシュを並べ替えてからまとめる """
+    digests = sorted(hashlib.sha256(data).hexdigest() for data in prepared)
+    material = '|'.join([f'v{STATS_ANALYSIS_PROMPT_VERSION}', model_name] + digests)
+    return hashlib.sha256(material.encode()).hexdigest()
+
+def get_cached_analysis(key):
+    """ 期限内のキャッシュがあれば (解析結果, 画像URL) を返す """
+    entry = db.session.get(AnalysisCache, key)
+    if not entry: return None
+    now = datetime.utcnow()
+    if entry.created_at < now - ANALYSIS_CACHE_TTL:
+        db.session.delete(entry); db.session.commit()
+        return None
+    entry.hits = (entry.hits or 0) + 1
+    entry.last_used_at = now
+    db.session.commit()
+    return json.loads(entry.result), entry.image_url or ''
+
+def drop_cached_analysis(key):
+    """ キャッシュを消す (やり直しの解析では古い結果を残さない) """
+    try:
+        AnalysisCache.query.filter_by(key=key).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"解析キャッシュ削除エラー: {e}")
+
+def store_cached_analysis(key, result, image_url):
+    """ 解析結果を保存し、期限切れと上限を超えた分 (最後に使われたのが古い順) を消す。
+        選手の行が1つも無い結果 (読み取りミス) は保存しない (同じ画像の再送で解析し直せるように) """
+    if not any(isinstance(row, dict) and row for row in result.get('players') or []): return
+    now = datetime.utcnow()
+    try:
+        AnalysisCache.query.filter(AnalysisCache.created_at < now - ANALYSIS_CACHE_TTL).delete(synchronize_session=False)
+        entry = db.session.get(AnalysisCache, key) or AnalysisCache(key=key)
+        entry.result = json.dumps(result, ensure_ascii=False)
+        entry.image_url = image_url
+        entry.created_at = entry.last_used_at = now
+        db.session.add(entry)
+        db.session.flush()
+        overflow = AnalysisCache.query.count() - ANALYSIS_CACHE_MAX_ENTRIES
+        if overflow > 0:
+            oldest = db.session.query(AnalysisCache.key).order_by(AnalysisCache.last_used_at).limit(overflow)
+            AnalysisCache.query.filter(AnalysisCache.key.in_(oldest.scalar_subquery())).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        # 同じ画像のジョブが同時に保存した場合など。キャッシュに入らないだけなので解析結果はそのまま返す
+        db.session.rollback()
+        print(f"解析キャッシュ保存エラー: {e}")
+
+def start_analysis_uploads(job_id, images):
+    """ 元画像の保存をスレッドプールに積む。戻り値は (保存ごとに埋まるURLのリスト, Future のリスト) """
+    urls = [None] * len(images)
+    if not app.config['ANALYSIS_UPLOAD_IMAGES']: return urls, []
+    lock = threading.Lock()
+    pool = get_analysis_upload_executor()
+    return urls, [pool.submit(_upload_analysis_image, job_id, i, data, urls, lock) for i, data in enumerate(images)]
+
+def wait_analysis_uploads(job_id, uploads, timings, started):
+    """ 元画像の保存を1枚ずつ待つ。保存に失敗した画像はログと timings['upload_errors'] に残すだけで、
+        解析結果は捨てない (保存した画像は表示用。URLのリストには成功した分だけが入っている) """
+    finished = []; errors = 0
+    for future in uploads:
         try:
-            genai.configure(api_key=current_key)
-            
-            # モデル：使えるものを使う（一旦 1.5 Pro または 1.5 Flash）
-            # ※ 2.5 はまだ存在しない可能性が高いので、安定の 1.5 Pro 推奨
-            model = genai.GenerativeModel('gemini-3-pro-preview') 
-            
-            print(f"--- キー{i+1} 解析開始 ---")
-            
-            response = model.generate_content([prompt_text] + pil_images)
-            
-            # 結果取得
-            result_text = response.text.replace("```json", "").replace("```", "")
-            data = json.loads(result_text)
-            
-            # ★ここでログに「AIが見た生の文字」を表示する
-            print("\n========== AIの視界（デバッグログ） ==========")
-            for line in data.get('debug_raw_text', []):
-                print(f"認識: {line}")
-            print("============================================\n")
+            finished.append(future.result())
+        except Exception as e:
+            errors += 1
+            print(f"解析ジョブ {job_id}: 画像の保存に失敗しました: {e}")
+    if finished: timings['upload'] = round(max(finished) - started, 3)
+    if errors: timings['upload_errors'] = errors
+
+def finish_analysis_job(job_id, result, urls, game_id, timings, started, cached=False):
+    """ 試合が分かっていればロスターと照合し (ロスターは変わるのでキャッシュには含めない)、結果をジョブに書き込む """
+    game = db.session.get(Game, game_id) if game_id else None
+    if game:
+        t = time.perf_counter()
+        result.update(match_box_score_rows(get_roster_index(game), result.get('players') or []))
+        timings['match'] = round(time.perf_counter() - t, 4)
+    result['image_url'] = ",".join(u for u in urls if u)
+    result['cached'] = bool(cached)
+    timings['total'] = round(time.perf_counter() - started, 3)
+    print(f"解析ジョブ {job_id}: {'キャッシュ ' if cached else ''}{timings}")
+    _update_analysis_job(job_id, status='done', stage='完了', timings=json.dumps(timings),
+                         result=json.dumps(result, ensure_ascii=False))
+
+def fail_analysis_job(job_id, error, timings=None, started=None):
+    db.session.rollback()
+    if timings is not None and started is not None: timings['total'] = round(time.perf_counter() - started, 3)
+    print(f"解析ジョブ {job_id}: {error} {timings or ''}")
+    _update_analysis_job(job_id, status='error', stage='', error=error, timings=json.dumps(timings or {}))
+
+def run_analysis_job(job_id, images, client, use_cache=True, game_id=None):
+    """ 画像(バイト列のリスト)を前処理・解析・保存し、進捗と結果をジョブに書き込む。
+        同じ画像の解析結果がキャッシュにあればモデルを呼ばずに返す。
+        保存はスレッドプールで並列に行い、モデルの推論はその間に進める """
+    with app.app_context():
+        timings = {}
+        started = time.perf_counter()
+        try:
+            try:
+                _update_analysis_job(job_id, status='running', stage='画像を最適化中')
+                prepared = [prepare_analysis_image(data) for data in images]
+                timings['preprocess'] = round(time.perf_counter() - started, 3)
+                cache_key = analysis_cache_key(prepared, getattr(client, 'model_name', type(client).__name__))
+                if not use_cache: drop_cached_analysis(cache_key)
+                cached = get_cached_analysis(cache_key) if use_cache else None
+                if cached:
+                    result, image_url = cached
+                    _update_analysis_job(job_id, image_urls=image_url)
+                    finish_analysis_job(job_id, result, image_url.split(','), game_id, timings, started, cached=True)
+                    return
+
+                urls, uploads = start_analysis_uploads(job_id, images)
+                _update_analysis_job(job_id, stage='AIが解析中')
+                t = time.perf_counter()
+                try:
+                    result = client.analyze(STATS_ANALYSIS_PROMPT, prepared)
+                except ModelQuotaError:
+                    raise
+                except Exception as e:
+                    raise RuntimeError(f'解析エラー: {str(e)}') from e
+                finally:
+                    timings['inference'] = round(time.perf_counter() - t, 3)
+            except ModelQuotaError:
+                fail_analysis_job(job_id, '利用制限超過', timings, started)
+                return
+            except RuntimeError as e:
+                fail_analysis_job(job_id, str(e), timings, started)
+                return
+            except Exception as e:
+                fail_analysis_job(job_id, f'画像処理エラー: {str(e)}', timings, started)
+                return
+            if uploads: _update_analysis_job(job_id, stage='画像の保存を待っています')
+            wait_analysis_uploads(job_id, uploads, timings, started)
+            store_cached_analysis(cache_key, result, ",".join(u for u in urls if u))
+            finish_analysis_job(job_id, result, urls, game_id, timings, started)
+        except Exception as e:
+            # 状態の書き込み自体に失敗した場合はログだけ残す (ポーリング側で中断扱いになる)
+            db.session.rollback()
+            print(f"解析ジョブ {job_id} エラー: {e}")
+
+def analysis_job_payload(job):
+    payload = {
+        'job_id': job.id, 'status': job.status, 'stage': job.stage or '',
+        'image_count': job.image_count,
+        'image_urls': [u for u in (job.image_urls or '').split(',') if u],
+        'timings': json.loads(job.timings) if job.timings else {},
+    }
+    if job.status == 'done' and job.result:
+        payload.update(json.loads(job.result))
+    if job.status == 'error':
+        payload['error'] = job.error or '解析エラー'
+    return payload
+
+@app.route('/api/analyze_stats', methods=['POST'])
+@login_required
+def analyze_stats_image():
+    """ 画像を受け付けてジョブを登録し、ジョブIDをすぐに返す """
+    files = request.files.getlist('image')
+    images = [data for data in (f.read() for f in files if f.filename != '') if data]
+    if not images:
+        return jsonify({'error': '画像が選択されていません'}), 400
 
-            data['image_url'] = ",".join(uploaded_urls)
-            return jsonify(data)
+    client = get_analysis_model_client()
+    if not client.is_configured(): return jsonify({'error': 'APIキー設定なし'}), 500
 
-        except Exception as e:
-            print(f"エラー: {e}")
-            if "429" in str(e) or "quota" in str(e).lower(): continue
-            return jsonify({'error': f'解析エラー: {str(e)}'}), 500
+    # 古いジョブはここで片付ける
+    AnalysisJob.query.filter(AnalysisJob.created_at < datetime.utcnow() - timedelta(days=ANALYSIS_JOB_KEEP_DAYS)).delete(synchronize_session=False)
+    game = db.session.get(Game, request.form.get('game_id', type=int) or 0)
+    job = AnalysisJob(id=uuid.uuid4().hex, user_id=current_user.id, game_id=game.id if game else None,
+                      status='queued', stage='順番待ち', image_count=len(images))
+    db.session.add(job)
+    db.session.commit()
+    job_id = job.id
+
+    use_cache = not request.form.get('refresh')  # 読み取りミスのやり直しはキャッシュを使わない
+    if app.config['ANALYSIS_JOBS_INLINE']:
+        run_analysis_job(job_id, images, client, use_cache, job.game_id)
+        db.session.expire_all()
+    else:
+        get_analysis_executor().submit(run_analysis_job, job_id, images, client, use_cache, job.game_id)
+
+    job = db.session.get(AnalysisJob, job_id)
+    payload = analysis_job_payload(job)
+    payload['status_url'] = url_for('analyze_stats_job', job_id=job_id)
+    return jsonify(payload), 202
+
+@app.route('/api/analyze_stats/<job_id>')
+@login_required
+def analyze_stats_job(job_id):
+    """ 解析ジョブの状態と途中経過 (保存済みの画像URL) / 結果を返す """
+    job = db.session.get(AnalysisJob, job_id)
+    if not job:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+    if job.user_id != current_user.id and not current_user.is_admin:
+        return jsonify({'error': '権限がありません'}), 403
+    if job.status in ('queued', 'running') and job.updated_at < datetime.utcnow() - timedelta(seconds=ANALYSIS_JOB_STALE_SECONDS):
+        _update_analysis_job(job.id, status='error', stage='', error='解析が中断されました。もう一度お試しください')
+        db.session.refresh(job)
+    response = jsonify(analysis_job_payload(job))
+    response.cache_control.no_store = True
+    return response
+
+@app.route('/api/games/<int:game_id>/match_players', methods=['POST'])
+@login_required
+def match_players_api(game_id):
+    """ 読み取った行 {"players": [{name, pts, ...}]} を試合の両チームの選手に割り当てて返す """
+    game = Game.query.get_or_404(game_id)
+    rows = (request.get_json(silent=True) or {}).get('players')
+    if not isinstance(rows, list): return jsonify({'error': 'players がありません'}), 400
+    return jsonify(match_box_score_rows(get_roster_index(game), rows))
+
+@app.route('/admin/analysis_keys', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def admin_analysis_keys():
+    """ 解析用APIキーの状態と集計 (キーの状態はプロセスごとに持つので、表示しているプロセスの分) """
+    client = get_analysis_model_client()
+    pool = getattr(client, 'pool', None)
+    if request.method == 'POST' and pool:
+        pool.reset()
+        flash('APIキーの休止と回路の遮断を解除しました。')
+        return redirect(url_for('admin_analysis_keys'))
+    cache_entries, cache_hits = db.session.query(func.count(AnalysisCache.key), func.coalesce(func.sum(AnalysisCache.hits), 0)).one()
+    return render_template('admin_analysis_keys.html', keys=pool.snapshot() if pool else [],
+                           model_name=getattr(client, 'model_name', ''), pid=os.getpid(),
+                           cache_entries=cache_entries, cache_hits=cache_hits)
+
+# --- 試合日ごとの一括取り込み ---
+# 複数試合のスクリーンショットをまとめて受け取り、試合ごとのジョブ (batch_id 共通) として解析する。
+# キャッシュに無い試合は数試合ずつ1回のモデル呼び出しにまとめ、結果は確認後に edit_game と同じ書き込み処理で一括登録する
+ANALYSIS_BATCH_MAX_IMAGES = 8  # 1回のモデル呼び出しに入れる画像の上限 (入力トークン)
+ANALYSIS_BATCH_MAX_GAMES = 4  # 1回のモデル呼び出しに入れる試合の上限 (出力トークン: 1試合 約10行 × 14項目)
+AI_STAT_COLUMNS = {'pts': 'pts', 'reb': 'reb', 'ast': 'ast', 'stl': 'stl', 'blk': 'blk', 'foul': 'foul', 'to': 'turnover',
+                   'fgm': 'fgm', 'fga': 'fga', '3pm': 'three_pm', '3pa': 'three_pa', 'ftm': 'ftm', 'fta': 'fta'}
+
+STATS_BATCH_PROMPT = STATS_ANALYSIS_PROMPT + """
+    【複数試合の一括解析】
+    画像は試合ごとに「=== 試合 G1 ===」のような見出しの後に並んでいます。
+    見出しが変わったら別の試合です。試合をまたいで行を混ぜず、上の形式を試合ごとに出力してください。
+
+    出力フォーマット（JSONのみ）:
+    {
+        "games": [
+            { "game": "G1", "debug_raw_text": [ ... ], "players": [ ... ] }
+        ]
+    }
+    """
+
+def pack_games_for_model(sizes, max_images=None, max_games=None):
+    """ {キー: 画像枚数} を、1回の呼び出しの上限 (画像枚数・試合数) に収まるよう枚数の多い順に詰める (First Fit Decreasing)。
+        上限より多い画像の試合は単独で1回にする """
+    max_images = max_images or ANALYSIS_BATCH_MAX_IMAGES
+    max_games = max_games or ANALYSIS_BATCH_MAX_GAMES
+    packs = []
+    for key in sorted(sizes, key=lambda k: -sizes[k]):
+        for pack in packs:
+            if len(pack['keys']) < max_games and pack['images'] + sizes[key] <= max_images:
+                pack['keys'].append(key); pack['images'] += sizes[key]
+                break
+        else:
+            packs.append({'keys': [key], 'images': sizes[key]})
+    return [pack['keys'] for pack in packs]
+
+def run_matchday_batch(jobs, client, use_cache=True):
+    """ jobs: [(ジョブID, 試合ID, 画像のバイト列のリスト)]。試合ごとに前処理・キャッシュ確認・保存を行い、
+        残りを pack_games_for_model でまとめてモデルに渡して、試合ごとの結果をそれぞれのジョブに書き込む """
+    with app.app_context():
+        pending = {}
+        for job_id, game_id, images in jobs:
+            timings = {}; started = time.perf_counter()
+            try:
+                _update_analysis_job(job_id, status='running', stage='画像を最適化中')
+                prepared = [prepare_analysis_image(data) for data in images]
+                timings['preprocess'] = round(time.perf_counter() - started, 3)
+                cache_key = analysis_cache_key(prepared, getattr(client, 'model_name', type(client).__name__))
+                if not use_cache: drop_cached_analysis(cache_key)
+                cached = get_cached_analysis(cache_key) if use_cache else None
+                if cached:
+                    result, image_url = cached
+                    _update_analysis_job(job_id, image_urls=image_url)
+                    finish_analysis_job(job_id, result, image_url.split(','), game_id, timings, started, cached=True)
+                    continue
+                urls, uploads = start_analysis_uploads(job_id, images)
+                _update_analysis_job(job_id, stage='AIの順番待ち')
+                pending[job_id] = dict(game_id=game_id, prepared=prepared, cache_key=cache_key, urls=urls,
+                                       uploads=uploads, timings=timings, started=started)
+            except Exception as e:
+                fail_analysis_job(job_id, f'画像処理エラー: {str(e)}', timings, started)
+
+        for pack in pack_games_for_model({job_id: len(p['prepared']) for job_id, p in pending.items()}):
+            labels = {f'G{n + 1}': job_id for n, job_id in enumerate(pack)}
+            parts = []
+            for label, job_id in labels.items():
+                parts.append(f'=== 試合 {label} ===')
+                parts.extend(pending[job_id]['prepared'])
+                _update_analysis_job(job_id, stage=f'AIが解析中 ({len(pack)}試合をまとめて解析)')
+            t = time.perf_counter()
+            try:
+                response = client.analyze(STATS_BATCH_PROMPT, parts); error = None
+            except ModelQuotaError:
+                response = None; error = '利用制限超過'
+            except Exception as e:
+                response = None; error = f'解析エラー: {str(e)}'
+            elapsed = round(time.perf_counter() - t, 3)
+            by_label = {str(g.get('game')): g for g in ((response or {}).get('games') or []) if isinstance(g, dict)}
+
+            for label, job_id in labels.items():
+                p = pending[job_id]
+                p['timings'].update(inference=elapsed, packed_games=len(pack))
+                try:
+                    game_result = by_label.get(label)
+                    if error or game_result is None:
+                        fail_analysis_job(job_id, error or '解析結果にこの試合が含まれていません', p['timings'], p['started'])
+                        continue
+                    result = {'debug_raw_text': game_result.get('debug_raw_text') or [], 'players': game_result.get('players') or []}
+                    wait_analysis_uploads(job_id, p['uploads'], p['timings'], p['started'])
+                    # 1試合ずつの解析と同じキーで保存するので、後で試合画面から同じ画像を送ってもモデルは呼ばない
+                    store_cached_analysis(p['cache_key'], result, ",".join(u for u in p['urls'] if u))
+                    finish_analysis_job(job_id, result, p['urls'], p['game_id'], p['timings'], p['started'])
+                except Exception as e:
+                    fail_analysis_job(job_id, f'画像処理エラー: {str(e)}', p['timings'], p['started'])
+
+def box_score_submission(game, box_score):
+    """ 照合済みの box_score を apply_box_score に渡す {player_id: (team_id, {カラム: 値})} にする (並び順はチームごとの出現順) """
+    submitted = {}; order = defaultdict(int)
+    for entry in box_score:
+        team_id = game.home_team_id if entry['side'] == 'home' else game.away_team_id
+        values = {column: _stat_int(entry['stats'].get(key)) for key, column in AI_STAT_COLUMNS.items()}
+        values['sort_order'] = order[team_id]; order[team_id] += 1
+        submitted[entry['player_id']] = (team_id, values)
+    return submitted
+
+def matchday_games(day):
+    """ 現在のシーズンで day に行われる試合 (日時順) """
+    season = get_current_season()
+    query = Game.query.options(db.joinedload(Game.home_team), db.joinedload(Game.away_team))\
+        .filter(game_period_clause(day, day))
+    if season: query = query.filter(Game.season_id == season.id)
+    return query.order_by(Game.game_datetime.asc(), Game.id.asc()).all()
+
+@app.route('/admin/matchday_import')
+@login_required
+@admin_required
+def matchday_import():
+    """ 試合日を選び、試合ごとにスクリーンショットを選んでまとめて解析する画面 """
+    day = request.args.get('date')
+    if not parse_game_datetime(day):
+        # 指定が無ければ、結果未入力の試合がある最も近い日 (無ければ今日)
+        season = get_current_season()
+        nearest = Game.query.filter(Game.is_finished == False, Game.game_datetime.isnot(None),
+                                    Game.game_datetime <= datetime.now() + timedelta(days=1))
+        if season: nearest = nearest.filter(Game.season_id == season.id)
+        nearest = nearest.order_by(Game.game_datetime.desc()).first()
+        day = nearest.game_datetime.strftime('%Y-%m-%d') if nearest else date.today().strftime('%Y-%m-%d')
+    return render_template('matchday_import.html', day=day, games=matchday_games(day))
+
+@app.route('/api/matchday_import', methods=['POST'])
+@login_required
+@admin_required
+def matchday_import_api():
+    """ 試合ごとの画像 (フィールド名 images_<試合ID>) を受け取り、試合ごとのジョブを登録して一括解析を始める。
+        リクエストの大きさの上限があるため、画面側は数試合ずつ同じ batch_id で送ってくる """
+    batch_id = request.form.get('batch_id') or uuid.uuid4().hex
+    if not re.fullmatch(r'[0-9a-f]{32}', batch_id): return jsonify({'error': '不正な batch_id です'}), 400
+    images_by_game = {}
+    for field in request.files:
+        m = re.fullmatch(r'images_(\d+)', field)
+        if not m: continue
+        images = [data for data in (f.read() for f in request.files.getlist(field) if f.filename != '') if data]
+        if images: images_by_game[int(m.group(1))] = images
+    games = Game.query.filter(Game.id.in_(images_by_game)).all() if images_by_game else []
+    if not games: return jsonify({'error': '画像が選択されていません'}), 400
+
+    client = get_analysis_model_client()
+    if not client.is_configured(): return jsonify({'error': 'APIキー設定なし'}), 500
+
+    jobs = []
+    for game in games:
+        job = AnalysisJob(id=uuid.uuid4().hex, user_id=current_user.id, game_id=game.id, batch_id=batch_id,
+                          status='queued', stage='順番待ち', image_count=len(images_by_game[game.id]))
+        db.session.add(job)
+        jobs.append((job.id, game.id, images_by_game[game.id]))
+    db.session.commit()
+
+    use_cache = not request.form.get('refresh')
+    if app.config['ANALYSIS_JOBS_INLINE']:
+        run_matchday_batch(jobs, client, use_cache)
+    else:
+        get_analysis_executor().submit(run_matchday_batch, jobs, client, use_cache)
+    return jsonify({'batch_id': batch_id, 'jobs': [job_id for job_id, _, _ in jobs],
+                    'review_url': url_for('matchday_import_review', batch_id=batch_id)}), 202
+
+@app.route('/admin/matchday_import/<batch_id>', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def matchday_import_review(batch_id):
+    """ 一括解析の結果を試合ごとに確認し、選んだ試合を edit_game と同じ書き込み処理でまとめて登録する """
+    jobs = AnalysisJob.query.filter_by(batch_id=batch_id).order_by(AnalysisJob.created_at).all()
+    if not jobs: return redirect(url_for('matchday_import'))
+    # 同じ試合を送り直した場合は新しい方だけ使う
+    latest = {}
+    for job in jobs: latest[job.game_id] = job
+    games = {g.id: g for g in Game.query.options(db.joinedload(Game.home_team), db.joinedload(Game.away_team))
+             .filter(Game.id.in_(list(latest))).all()}
+
+    if request.method == 'POST':
+        selected = set(request.form.getlist('job_id'))
+        committed = []
+        for game_id, job in latest.items():
+            if job.id not in selected or job.status != 'done' or game_id not in games: continue
+            result = json.loads(job.result)
+            if not result.get('box_score'): continue
+            game = games[game_id]
+            apply_box_score(game, box_score_submission(game, result['box_score']))
+            if result.get('image_url'): game.result_image_url = result['image_url']
+            job.status = 'committed'; job.stage = '登録済み'; job.updated_at = datetime.utcnow()
+            committed.append(f'{game.away_team.name} vs {game.home_team.name}')
+        db.session.commit()
+        flash(f'{len(committed)}試合の結果を登録しました。' if committed else '登録する試合が選ばれていません。')
+        return redirect(url_for('matchday_import_review', batch_id=batch_id))
+
+    entries = []
+    for game_id, job in latest.items():
+        if game_id not in games: continue
+        payload = analysis_job_payload(job)
+        if job.status == 'committed' and job.result: payload.update(json.loads(job.result))
+        entries.append({'game': games[game_id], 'job': job, 'data': payload,
+                        'issues': [r for r in payload.get('rows', []) if r['player_id'] is None or (not r['duplicate'] and r['confidence'] < 0.7)]})
+    entries.sort(key=lambda e: (e['game'].game_datetime or datetime.max, e['game'].id))
+    pending = any(e['job'].status in ('queued', 'running') for e in entries)
+    # まとめて解析した試合数から、実際のモデル呼び出し回数を数える
+    model_calls = round(sum(1 / e['data']['timings']['packed_games'] for e in entries if e['data']['timings'].get('packed_games')))
+    return render_template('matchday_import_review.html', batch_id=batch_id, entries=entries, pending=pending,
+                           model_calls=model_calls)
 
-    return jsonify({'error': '利用制限超過'}), 429
 @app.before_request
 def count_access():
-    # 静的ファイル（画像やCSS）へのアクセスはカウントしない
-    if request.endpoint and 'static' in request.endpoint:
+    # 静的ファイル（画像やCSS）へのアクセスはカウントしない (保存画像・縮小版も同じ。セッションに触れると共有キャッシュに載らない)
+    if request.endpoint and ('static' in request.endpoint or request.endpoint in ('media_file', 'image_variant')):
         return
 
     # 今日の日付を取得